@@ -9,70 +9,38 @@
 import pandas as pd, numpy as np, matplotlib.pyplot as plt, rasterio as rio, glob
 from osgeo import gdal
 from tqdm.notebook import tqdm as td 
+from resample import resampleRasters
+from grid_check import checkGrids, assertAligned
 
 
 
 # %% [markdown]
-## Read files 
-# 1 Get list of files 
+## Get filenames
+# (the rasters themselves are only opened by gdal below, window by window, never read whole)
 rasBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*Before.tif")
 rasAfterNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*After.tif")
 
-# 2 Read them into dictionaries
-rasBefore = {}
-for i in range(len(rasBeforeNames)):
-    rasBefore[i] = rio.open(rasBeforeNames[i]).read(1)
-rasAfter = {}
-for i in range(len(rasAfterNames)):
-    rasAfter[i] = rio.open(rasAfterNames[i]).read(1)
-
 
 
 # %% [markdown]
 ## Resample 
-for i in td(range(len(rasBeforeNames)), desc='Resampling'):
-    temp = gdal.Open(rasAfterNames[i])
-    result = gdal.Warp(
-        destNameOrDestDS=rasBeforeNames[i].split('.tif')[0]+'_Resampled'+'.tif',
-        srcDSOrSrcDSTab=rasBeforeNames[i],
-        width=temp.RasterXSize,
-        height=temp.RasterYSize
-        # xRes=temp.GetGeoTransform()[1],
-        # yRes=temp.GetGeoTransform()[5],
-    )
-    result=None
+# (warps run in parallel; outputs newer than their inputs and already of the 'after' size are skipped)
+outNames = [name.split('.tif')[0]+'_Resampled'+'.tif' for name in rasBeforeNames]
+nWorkers = 2  # warps at a time (the cores are shared between them)
+warpMemoryMB = 512  # gdal warp memory of each warp
+force = False  # resample even if the outputs are up to date
+resampled = resampleRasters(rasBeforeNames, rasAfterNames, outNames, nWorkers=nWorkers, warpMemoryMB=warpMemoryMB, force=force)
+resampled
 
 
 
 # %% [markdown] 
 ## Validate
-# 1 Get the list of output rasters (i.e. resampled 'before' rasters)
-outputRasters = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*_Resampled.tif")
-
-# 2 Define dataframes to compare the  resampled-'before' and 'after' rasters 
-dfBefore = pd.DataFrame(columns=['width', 'height', 'xRes','yRes'], index=range(10))
-dfAfter = pd.DataFrame(columns=['width', 'height', 'xRes','yRes'], index=range(10))
-
-# 3 Get raster attributes into dataframes
-for i in td(range(len(outputRasters)), desc='Verifying'):
-
-    # 3.1 Read the raster into temp file
-    temp1 = gdal.Open(outputRasters[i])
-    temp2 = gdal.Open(rasAfterNames[i])
-
-    # 3.2 Get the attributes of 'before_resampled' rasters
-    dfBefore.width[i] = temp1.RasterXSize 
-    dfBefore.height[i] = temp1.RasterYSize
-    dfBefore.xRes[i] = temp1.GetGeoTransform()[1]
-    dfBefore.yRes[i] = temp1.GetGeoTransform()[5]
+# (grids of the resampled-'before' and 'after' rasters compared pairwise, from the raster headers only)
+report = checkGrids({'After': rasAfterNames, 'Before_Resampled': outNames})
+assertAligned(report)
+report
 
-    # 3.2 Get the attributes of 'after' rasters
-    dfAfter.width[i] = temp1.RasterXSize 
-    dfAfter.height[i] = temp1.RasterYSize
-    dfAfter.xRes[i] = temp1.GetGeoTransform()[1]
-    dfAfter.yRes[i] = temp1.GetGeoTransform()[5]
 
-# 4 Compare the two dataframes
-dfBefore == dfAfter
 
 # %%
@@ -1,14 +1,17 @@
 # %% [markdown]
 ## About 
-# >1. This code prepares 'before' and 'after' slope and aspect maps of regions 1-10
+# >1. This code prepares 'before' and 'after' slope and aspect maps of regions 1-10 (and optionally hillshade and curvature maps)
 
 
 
 # %% [markdown]
 ## Libraries 
-import pandas as pd, numpy as np, matplotlib.pyplot as plt, rasterio as rio, glob, richdem as rd
+import pandas as pd, numpy as np, matplotlib.pyplot as plt, rasterio as rio, glob, os
 from osgeo import gdal
 from tqdm.notebook import tqdm as td 
+from terrain import terrainAttributes
+from grid_check import checkGrids, assertAligned
+import raster_cache
 
 
 
@@ -16,56 +19,35 @@ from tqdm.notebook import tqdm as td
 ## Get filenames 
 rasBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*Before_Resampled.tif")
 rasAfterNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*After.tif")
+assertAligned(checkGrids({'After': rasAfterNames, 'Before_Resampled': rasBeforeNames}))  # fail early on misaligned inputs
 
 
 
 # %% [markdown]
-## Prepare slope maps from 'before' and 'after' dems
-outDir = "../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/01_Slope_Maps/"
-for i in td(range(len(rasBeforeNames)), desc='Preparing slope maps'):
-
-    # 1 Load dem 
-    demBefore = rd.LoadGDAL(rasBeforeNames[i])  
-    demAfter = rd.LoadGDAL(rasAfterNames[i])
-
-    # 2 Remove nodata values from calculation
-    demBefore[demBefore<0] = np.nan
-    demAfter[demAfter<0] = np.nan
-
-    # 3 Set outfiles names 
-    slopeBeforeName = outDir+rasBeforeNames[i].split('\\')[-1].split('.')[0]+'_slope.tif'
-    slopeAfterName = outDir+rasAfterNames[i].split('\\')[-1].split('.')[0]+'_slope.tif'
-    
-    # 4 Get maps
-    slopeBefore = rd.TerrainAttribute(demBefore, attrib='slope_degrees')  
-    rd.SaveGDAL(filename=slopeBeforeName, rda=slopeBefore)  # save map
-    slopeAfter = rd.TerrainAttribute(demAfter, attrib='slope_degrees')  
-    rd.SaveGDAL(filename=slopeAfterName, rda=slopeAfter)  
-
-
-
-# %% [markdown]
-## Prepare aspect maps from 'before' and 'after' dems
-outDir = "../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/02_Aspect_Maps/"
-for i in td(range(len(rasBeforeNames)), desc='Preparing slope maps'):
-
-    # 1 Load dem 
-    demBefore = rd.LoadGDAL(rasBeforeNames[i])  
-    demAfter = rd.LoadGDAL(rasAfterNames[i])
-
-    # 2 Remove nodata values from calculation
-    demBefore[demBefore<0] = np.nan
-    demAfter[demAfter<0] = np.nan
-
-    # 3 Set outfiles names 
-    aspectBeforeName = outDir+rasBeforeNames[i].split('\\')[-1].split('.')[0]+'_aspect.tif'
-    aspectAfterName = outDir+rasAfterNames[i].split('\\')[-1].split('.')[0]+'_aspect.tif'
-    
-    # 4 Get maps
-    aspectBefore = rd.TerrainAttribute(demBefore, attrib='aspect')
-    rd.SaveGDAL(filename=aspectBeforeName, rda=aspectBefore)
-    aspectAfter = rd.TerrainAttribute(demAfter, attrib='aspect')
-    rd.SaveGDAL(filename=aspectAfterName, rda=aspectAfter)
+## Prepare slope and aspect maps from 'before' and 'after' dems
+# (each dem is read once, in strips, and both maps are written from the same pass)
+slopeDir = "../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/01_Slope_Maps/"
+aspectDir = "../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/02_Aspect_Maps/"
+hillshadeDir = None  # set a folder to also write hillshade maps
+curvatureDir = None  # set a folder to also write curvature maps
+memBudgetMB = 256  # memory for the strips computed at a time
+rasterCacheDir = "../12_Raster_Cache/"  # rasters are decoded once into this folder and memory-mapped by every later stage and script
+raster_cache.enable(rasterCacheDir, maxSizeMB=20000)  # least recently used rasters are evicted beyond this size
+nWorkers = 4  # threads computing strips in parallel
+for i in td(range(len(rasBeforeNames)), desc='Preparing slope and aspect maps'):
+    for demName in [rasBeforeNames[i], rasAfterNames[i]]:
+
+        # 1 Set outfiles names ('np.nan' is assigned to no-data pixels when the dem is read)
+        baseName = os.path.splitext(os.path.basename(demName))[0]
+        outNames = {
+            'slope': slopeDir+baseName+'_slope.tif',
+            'aspect': aspectDir+baseName+'_aspect.tif',
+            'hillshade': hillshadeDir+baseName+'_hillshade.tif' if hillshadeDir else None,
+            'curvature': curvatureDir+baseName+'_curvature.tif' if curvatureDir else None,
+        }
+
+        # 2 Get maps
+        terrainAttributes(demName, outNames, memBudgetMB=memBudgetMB, nWorkers=nWorkers)
 
 
 
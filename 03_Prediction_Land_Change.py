@@ -3,6 +3,7 @@
 # This code does the following:
 # > 1. Creates relationship between before and after flood LULC conditions 
 # > 2. Predicts after LULC conditions based on before conditions over the test data
+# > 3. Predicts post GLOF elevation maps of whole areas (or of new 'before' DEMs) with the trained models
 
 
 
@@ -12,89 +13,130 @@ import pandas as pd, numpy as np, matplotlib.pyplot as plt, rasterio as rio, glo
 from osgeo import gdal
 from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeRegressor
-from tqdm.notebook import tqdm as td 
+from tqdm.notebook import tqdm as td
+from land_change import runAreas
+from features import buildAreaFeatures, splitXy
+from sampling import sampleCurve
+from block_cv import blockCrossValidate
+from regressors import benchmarkBackends
+from forecast import predictRaster
+from error_store import readErrors
+from grid_check import checkGrids, assertAligned
+from outliers import loadMask
+import joblib, os, profiling, raster_cache
 start = time.time()
+profileDir = "../10_Profiles/03/"  # time, CPU, memory, I/O and pixels/s of every stage are recorded here
+profiling.enable(profileDir)
 
 
 
 # %% [markdown]
-## Read 'before' and 'after' DEMs into dictionaries
-# 1 Get file names
-rasBeforeNames = glob.glob(r"..\02_Data\03_Processed_Data\02_Rasters\01_Clipped_Areas\*Resampled.tif")
-rasAfterNames = glob.glob(r"..\02_Data\03_Processed_Data\02_Rasters\01_Clipped_Areas\*After.tif")  
+## Get 'before' and 'after' DEM names
+# (the DEMs are streamed window by window below, one area at a time, instead of being read whole into dictionaries)
+rasBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*Resampled.tif")
+rasAfterNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*After.tif")
+assertAligned(checkGrids({'After': rasAfterNames, 'Before_Resampled': rasBeforeNames}))  # fail early on misaligned inputs
+memBudgetMB = 256  # memory for the raster windows read at a time
+rasterCacheDir = "../12_Raster_Cache/"  # rasters are decoded once into this folder and memory-mapped by every later stage and script
+raster_cache.enable(rasterCacheDir, maxSizeMB=20000)  # least recently used rasters are evicted beyond this size
 
-# 2.1 Define empty dictionaries
-rasBefore = {}                                          
-rasAfter = {}
-
-# 2.2 Read files into dictionaries 
-for i in range(len(rasBeforeNames)):                    
-    rasBefore[i] = rio.open(rasBeforeNames[i]).read(1)  
-    rasAfter[i] = rio.open(rasAfterNames[i]).read(1) 
-    
 
 
 # %% [markdown]
-## Assign 'np.nan' to no-data pixels
-for i in range(len(rasBeforeNames)):
-    rasBefore[i][rasBefore[i]<0] = np.nan
-    rasAfter[i][rasAfter[i]<0] = np.nan
+## Terrain features
+# (slope/aspect of the 'before' DEMs from 02, and relief/roughness of their 3x3 neighbourhoods, added to the row/col/elevation features)
+extras = []  # any of 'Slope', 'Aspect', 'Relief', 'Roughness' ([] = row, col and elevation only)
+slopeBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/01_Slope_Maps/*Before_Resampled_slope.tif")
+aspectBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/02_Aspect_Maps/*Before_Resampled_aspect.tif")
+terrainNames = [{'Slope': slopeBeforeNames[i], 'Aspect': aspectBeforeNames[i]} for i in range(len(slopeBeforeNames))] if slopeBeforeNames else None
+if terrainNames:
+    assertAligned(checkGrids({'Before_Resampled': rasBeforeNames, 'Slope_Before': slopeBeforeNames, 'Aspect_Before': aspectBeforeNames}))
+featureDir = "../09_Features/"  # feature matrices of unchanged inputs are memory-mapped from here instead of rebuilt
 
 
 
 # %% [markdown]
 ## Predict post GLOF conditions
-for i in td(range(len(rasBeforeNames)), desc='Saving results'):
-
-    # 1 Prepare 'X' and 'y'
-    # 1.1 Get the row, col in array form
-    X = pd.DataFrame()
-    row = np.zeros((rasBefore[i].shape[0], rasBefore[i].shape[1]))
-    col = np.zeros((rasBefore[i].shape[0], rasBefore[i].shape[1]))
-    for a in range(rasBefore[i].shape[0]):
-        for b in range(rasBefore[i].shape[1]):
-            row[a,b] = a
-            col[a,b] = b
-
-    # 1.2 Get the row, col into 'X'
-    X['Row'] = row.flatten('F')  
-    X['Col'] = col.flatten('F') 
-
-    # 1.3 Add 'before' Land elevation values to 'X'
-    X['Land_Before'] = rasBefore[i].flatten('F')
-
-    # 1.4 Prepare 'y'
-    y = pd.DataFrame()
-    y['Land_After'] = rasAfter[i].flatten('F')
-
-
-    # 2 Remove NaNs from 'X' and 'y'
-    # 2.1 Combine 'X' and 'y' to remove nans
-    Xy = X.merge(y, left_index=True, right_index=True)  
-    Xy.dropna(inplace=True)  
-    Xy.reset_index(drop=True, inplace=True)
-
-    # 2.2 Split back 'X' and 'y'
-    X = Xy[['Row', 'Col', 'Land_Before']]
-    y = Xy[['Land_After']]
-
-    # 3 Train and run and the models
-    # 3.1 Train model
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.30)
-    regressor = DecisionTreeRegressor(random_state=0)
-    regressor.fit(X_train,y_train)
-
-    # 3.2 Run model
-    yPred = regressor.predict(X_test)
-
-    # 3.3 Save results 
-    df = pd.DataFrame()
-    df['yPred'] = yPred
-    df['yTest'] = y_test['Land_After'].values
-    df['diff'] = df['yPred'] - df['yTest']
-    df.to_csv("../06_Excel_Files/{}_Area_{}_error.csv".format(str(i+1).zfill(2), str(i+1).zfill(2)))
-    
-    # 4 Error Analysis - Overall plot
+# (the areas are independent, so each one is trained, predicted and saved in its own worker process)
+nWorkers = None  # worker processes (None = one per core)
+memCapMB = None  # address-space cap of each worker process in MB, Linux only (None = no cap; it counts memory-mapped files, so use several GB, e.g. 16000)
+modelDir = "../07_Models/"  # model store; models of unchanged inputs are loaded from here instead of refitted
+maxStoreMB = 20000  # least recently used models are evicted beyond this size
+errorFormat = 'parquet'  # 'parquet' (compressed) or 'npy' (memory-mapped) error files
+exportCsv = False  # also export the errors as csv
+sampleSize = None  # train on a spatially stratified sample of this many pixels per area (None = all training pixels)
+backend = 'tree'  # regressor: 'tree', 'tree_limited', 'hist_gbm' or 'forest' (see regressors.py)
+os.makedirs(modelDir, exist_ok=True)
+results = runAreas(rasBeforeNames, rasAfterNames, nWorkers=nWorkers, memCapMB=memCapMB, memBudgetMB=memBudgetMB, modelDir=modelDir, maxStoreMB=maxStoreMB,
+                   errorFormat=errorFormat, exportCsv=exportCsv, sampleSize=sampleSize, backend=backend, extras=extras, terrainNames=terrainNames, featureDir=featureDir)
+results
+
+
+
+# %% [markdown]
+## Hold-out error vs training sample size
+# (fits one area on growing stratified samples, to pick a 'sampleSize' that trades little accuracy for a much cheaper fit)
+curveArea = 0  # area to check (0 = area 1)
+budgets = [10**4, 10**5, 10**6, 10**7]  # training pixels per fit (all training pixels are always added)
+X, y = splitXy(buildAreaFeatures(rasBeforeNames[curveArea], rasAfterNames[curveArea], memBudgetMB=memBudgetMB, extras=extras,
+                                 terrainNames=terrainNames[curveArea] if terrainNames else None, cacheDir=featureDir))
+curve = sampleCurve(X, y, budgets)
+curve
+
+
+
+# %% [markdown]
+## Regressor backends compared on one area
+# (fit time, predict throughput, model size and error of every backend on the same split of area 'curveArea' above)
+X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.30, random_state=0)
+backendsCompared = benchmarkBackends(X_train, y_train, X_test, y_test)
+del X, y, X_train, X_test, y_train, y_test
+backendsCompared
+
+
+
+# %% [markdown]
+## Spatial block cross-validation
+# (whole blocks of the row/col grid are held out, so neighbouring pixels are never on both sides of a split; folds run in parallel)
+cvDir = "../08_Cross_Validation/"  # features and folds are memory-mapped from here by the fold workers
+k = 5  # folds
+blockSize = 256  # block side in pixels
+cv = {}
+for i in td(range(len(rasBeforeNames)), desc='Cross-validating'):
+    cv[i+1] = blockCrossValidate(rasBeforeNames[i], rasAfterNames[i], cvDir+"Area_{}".format(str(i+1).zfill(2)), k=k, blockSize=blockSize, memBudgetMB=memBudgetMB,
+                                 extras=extras, terrainNames=terrainNames[i] if terrainNames else None)
+pd.concat(cv, names=['Area'])
+
+
+
+# %% [markdown]
+## Predict post GLOF elevation maps of the whole areas
+# (every valid 'before' pixel is predicted window by window; for a new pre-flood DEM pass it as 'beforeName' and leave out 'afterName')
+outDir = "../02_Data/03_Processed_Data/02_Rasters/03_Predicted_Maps/"
+os.makedirs(outDir, exist_ok=True)
+for i in td(range(len(results)), desc='Predicting maps'):
+    area = str(i+1).zfill(2)
+    predictRaster(
+        regressor=joblib.load(results['Model_File'][i], mmap_mode='r'),
+        beforeName=rasBeforeNames[i],
+        predName=outDir+"Area_{}_Predicted_After.tif".format(area),
+        afterName=rasAfterNames[i],
+        errorName=outDir+"Area_{}_Predicted_Error.tif".format(area),
+        memBudgetMB=memBudgetMB,
+        extras=extras,
+        terrainNames=terrainNames[i] if terrainNames else None,
+    )
+
+
+
+# %% [markdown]
+## Error analysis plots
+for i in td(range(len(results)), desc='Saving plots'):
+
+    # 1 Read the errors of the area
+    df = readErrors(results['Error_File'][i], ['yPred', 'yTest', 'diff'])
+
+    # 2 Error Analysis - Overall plot
     def plot1():
         plt.figure(dpi=100)
         df['diff'].plot(color='firebrick')
@@ -108,17 +150,14 @@ for i in td(range(len(rasBeforeNames)), desc='Saving results'):
         plt.close()
     # plot1()
 
-    # 5 Error Analysis - Overall plot after removing outliers
+    # 3 Error Analysis - Overall plot after removing outliers
     def plot2():
-        # 1 Remove outliers
+        # 1 Remove outliers (the mask is saved next to the error file and shared with 04)
         # 1.1 z-score method 
-        from scipy import stats
-        df1 = df['diff'][(np.abs(stats.zscore(df)) < 3).all(axis=1)].to_frame()
+        df1 = df[['diff']][loadMask(results['Error_File'][i], 'zscore', columns=['yPred', 'yTest', 'diff'])]
 
         # 1.2 quantile method (both give very similar results)
-        # q_low = df["diff"].quantile(0.01)
-        # q_hi  = df["diff"].quantile(0.99)
-        # df1 = df[(df["diff"] < q_hi) & (df["diff"] > q_low)]
+        # df1 = df[['diff']][loadMask(results['Error_File'][i], 'quantile', columns=['diff'], quantiles=(0.01, 0.99))]
 
         # 2 Plot
         plt.figure(dpi=100)
@@ -135,7 +174,7 @@ for i in td(range(len(rasBeforeNames)), desc='Saving results'):
         return df1
     # df1 = plot2()
 
-    # 6 Error Analysis - Plot of 100 random values before removing outliers
+    # 4 Error Analysis - Plot of 100 random values before removing outliers
     def plot3():
         # 1 Get 100 random rows
         df100 = df['diff'].sample(n=100).reset_index(drop=True)
@@ -153,7 +192,7 @@ for i in td(range(len(rasBeforeNames)), desc='Saving results'):
         plt.close()
     # plot3()
 
-    # 7 Error Analysis - Plot of 100 random values after removing outliers 
+    # 5 Error Analysis - Plot of 100 random values after removing outliers 
     def plot4():
 
 
@@ -175,7 +214,13 @@ for i in td(range(len(rasBeforeNames)), desc='Saving results'):
         
     # plot4()
 
-print('Time elapsed: ', np.round((time.time()-start)/60), 'mins')
+
+
+# %% [markdown]
+## Run report
+# (one row per stage and area, also saved as run_report.json / run_report.csv in 'profileDir')
+print('Time elapsed: ', np.round((time.time()-start)/60, 2), 'mins')
+profiling.runReport(profileDir)
 
 
 # %%
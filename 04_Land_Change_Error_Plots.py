@@ -17,149 +17,41 @@ from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeRegressor
 from tqdm.notebook import tqdm as td 
 from scipy import stats
+from error_store import listErrorFiles
+from plotting import renderAreas
+import profiling
 start = time.time()
+profileDir = "../10_Profiles/04/"  # time, CPU, memory, I/O and pixels/s of every stage are recorded here
+profiling.enable(profileDir)
 
 
 
 # %% [markdown]
-## Read files 
+## Get error file names
 # %% [code]
-csvFiles = glob.glob("../06_Excel_Files/*.csv")
-dc = {}
-for i in td(range(len(csvFiles)), desc='Reading files'):
-    dc[i] = pd.read_csv(csvFiles[i])
-    dc[i].drop(columns=['Unnamed: 0'], inplace=True)  # redundant col dropped
+errorFormat = 'parquet'  # format the errors were saved in by 03 ('parquet', 'npy' or 'csv')
+errorFiles = listErrorFiles("../06_Excel_Files/", errorFormat)
 
-    
 
-# %% [markdown]
-## Plot 1 - All values
-# %% [code]
-plt.rcParams["font.family"] = "Century Gothic"  # font of all plots set
-plt.rcParams['figure.dpi'] = 300  # dpi of all plots set
-for i in td(range(len(dc)), desc='Saving plots'):
-
-    # 1 Plot
-    plt.figure()
-    dc[i]['diff'].plot(color='firebrick')
-    plt.ylim([-0.8,0.8])
-    plt.title("Predicted vs actual elevation DEM values") 
-    plt.xlabel("Pixel number", fontweight='bold')  
-    plt.ylabel("Error (m)", fontweight='bold')
-    plt.grid(b=True, which='major', color='k', linestyle='--', alpha=0.50)
-    plt.grid(b=True, which='minor', color='k', linestyle='--', alpha=0.50)
-
-    # 2 Add annotation
-    x0, xmax = plt.xlim()
-    y0, ymax = plt.ylim()
-    data_width = xmax - x0
-    data_height = ymax - y0
-    plt.text(x0 + data_width, y0 + data_height,'({})'.format(string.ascii_lowercase[i:i+1]), size=14, bbox=dict(boxstyle="square",ec='k',fc='darkgray'))
 
-    # 3 Save fig
-    # plt.savefig("../05_Images/01_Land_Elevation_Changes/Area_{}_A_All.png".format(str(i+1).zfill(2)), bbox_inches='tight', facecolor='gainsboro')
-    # plt.close()
-
-
-    
 # %% [markdown]
-## Plot 2 - All values after outlier removal
-for i in td(range(len(dc)), desc='Saving plots'):
-
-    # 1 Remove outliers
-    # 1.1 z-score method 
-    # dftemp = dc[i]['diff'][(np.abs(stats.zscore(dc[i])) < 3).all(axis=1)].to_frame()
-
-    # 1.2 quantile method (both give very similar results)
-    q_low = dc[i]["diff"].quantile(0.01)
-    q_hi  = dc[i]["diff"].quantile(0.99)
-    dftemp = dc[i][(dc[i]["diff"] < q_hi) & (dc[i]["diff"] > q_low)]
-
-    # 2 Plot
-    plt.figure()
-    dftemp.plot(color='firebrick', legend=None)
-    plt.ylim([-0.2,0.2])
-    plt.title("Predicted vs actual DEM values") 
-    plt.xlabel("Pixel number", fontweight='bold')  
-    plt.ylabel("Error (m)", fontweight='bold')
-    plt.grid(b=True, which='major', color='k', linestyle='--', alpha=0.50)
-    plt.grid(b=True, which='minor', color='k', linestyle='--', alpha=0.50)
-
-    # 3 Add annotation
-    x0, xmax = plt.xlim()
-    y0, ymax = plt.ylim()
-    data_width = xmax - x0
-    data_height = ymax - y0
-    plt.text(x0 + data_width, y0 + data_height,'({})'.format(string.ascii_lowercase[i:i+1]), size=14, bbox=dict(boxstyle="square",ec='k',fc='darkgray'))
-
-    # 4 Save fig
-    plt.savefig("../05_Images/01_Land_Elevation_Changes/Area_{}_B_All_Filtered.png".format(str(i+1).zfill(2)), bbox_inches='tight', facecolor='gainsboro')
-    plt.close()
-
-
-
-# %% [markdown]
-## Plot 3 - 100 random values
-for i in td(range(len(dc)), desc='Saving plots'):
-
-    # 1 Get 100 random rows
-    df100 = dc[i]['diff'].sample(n=100).reset_index(drop=True)
-
-    # 2 Plot the above random rows
-    plt.figure()
-    plt.ylim([-0.04,0.04])
-    df100.plot(color='k')
-    plt.title("Errors for 100 random samples") 
-    plt.xlabel("Pixel number", fontweight='bold')  
-    plt.ylabel("Error (m)", fontweight='bold')
-    plt.grid(b=True, which='major', color='k', linestyle='--', alpha=0.50)
-    plt.grid(b=True, which='minor', color='k', linestyle='--', alpha=0.50)
-
-    # 3 Add annotation
-    x0, xmax = plt.xlim()
-    y0, ymax = plt.ylim()
-    data_width = xmax - x0
-    data_height = ymax - y0
-    plt.text(x0 + data_width, y0 + data_height,'({})'.format(string.ascii_lowercase[i:i+1]), size=14, bbox=dict(boxstyle="square",ec='k',fc='darkgray'))
+## Plots 1-4 - All values, all values after outlier removal, 100 random values, 100 random values after outlier removal
+# (each area's errors are read once for all four plots; areas are drawn in parallel, and skipped while their errors are unchanged)
+# %% [code]
+outDir = "../05_Images/01_Land_Elevation_Changes/"
+nWorkers = None  # worker processes (None = one per core)
+maxPoints = 4000  # long error series are drawn as a min/max envelope of this many points
+force = False  # redraw even if the errors are unchanged
+plots = renderAreas(errorFiles, outDir, nWorkers=nWorkers, dpi=300, fontFamily="Century Gothic", maxPoints=maxPoints, force=force)
+plots
 
-    # 4 Save fig
-    plt.savefig("../05_Images/01_Land_Elevation_Changes/Area_{}_C_100.png".format(str(i+1).zfill(2)), bbox_inches='tight', facecolor='gainsboro')
-    plt.close()
 
 
-    
 # %% [markdown]
-## Plot 4 - 100 random values after outlier removal
-for i in td(range(len(dc)), desc='Saving plots'):
-
-    # 1 Get 100 random rows
-    # 1.1 Clean the original dataframes as in Plots -2 
-    dftemp = dc[i]['diff'][(np.abs(stats.zscore(dc[i])) < 3).all(axis=1)].to_frame()
-
-    # 1.2 Take 100 random sample rows
-    df100Clean = dftemp.sample(n=100).reset_index(drop=True)
-
-    # 2 Plot the above random rows
-    plt.figure()
-    df100Clean.plot(color='k', legend=None)
-    plt.ylim([-0.03,0.03])
-    plt.title("Errors for 100 random samples after filtering") 
-    plt.xlabel("Pixel number", fontweight='bold')  
-    plt.ylabel("Error (m)", fontweight='bold')
-    plt.grid(b=True, which='major', color='k', linestyle='--', alpha=0.50)
-    plt.grid(b=True, which='minor', color='k', linestyle='--', alpha=0.50)
-
-    # 3 Add annotation
-    x0, xmax = plt.xlim()
-    y0, ymax = plt.ylim()
-    data_width = xmax - x0
-    data_height = ymax - y0
-    plt.text(x0 + data_width, y0 + data_height,'({})'.format(string.ascii_lowercase[i:i+1]), size=14, bbox=dict(boxstyle="square",ec='k',fc='darkgray'))
-
-    # 4 Save fig
-    plt.savefig("../05_Images/01_Land_Elevation_Changes/Area_{}_D_100_filtered.png".format(str(i+1).zfill(2)), bbox_inches='tight', facecolor='gainsboro')
-    plt.close()
-
+## Run report
+# (one row per stage and area, also saved as run_report.json / run_report.csv in 'profileDir')
+print('Time elapsed: ', np.round((time.time()-start)/60, 2), 'mins')
+profiling.runReport(profileDir)
 
 
 
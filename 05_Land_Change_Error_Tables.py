@@ -13,40 +13,35 @@ from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeRegressor
 from tqdm.notebook import tqdm as td 
 from scipy import stats
+from error_store import listErrorFiles, iterErrorChunks
+from stream_stats import streamStats
+import profiling, raster_cache
 start = time.time()
-from sklearn.cluster import KMeans
+profileDir = "../10_Profiles/05/"  # time, CPU, memory, I/O and pixels/s of every stage are recorded here
+profiling.enable(profileDir)
+from compact_raster import landPixels
+from slope_clusters import clusterAreas
+from grid_check import checkGrids, assertAligned
 
 
 
 # %% [markdown]
-## Read error files 
-csvFiles = glob.glob("../06_Excel_Files/*.csv")
-dc = {}
-for i in td(range(len(csvFiles)), desc='Reading files'):
-    dc[i] = pd.read_csv(csvFiles[i])
-    dc[i].drop(columns=['Unnamed: 0'], inplace=True)  # redundant col dropped
+## Get error file names
+# (the errors are streamed chunk by chunk into the statistics below, never read whole)
+errorFormat = 'parquet'  # format the errors were saved in by 03 ('parquet', 'npy' or 'csv')
+errorFiles = listErrorFiles("../06_Excel_Files/", errorFormat)
 
     
 
 # %% [markdown]
-## Read 'before' and 'after' DEMs into dictionaries
-# 1 Get file names
-rasBeforeNames = glob.glob(r"..\02_Data\03_Processed_Data\02_Rasters\01_Clipped_Areas\*Resampled.tif")
-rasAfterNames = glob.glob(r"..\02_Data\03_Processed_Data\02_Rasters\01_Clipped_Areas\*After.tif")  
-
-# 2.1 Define empty dictionaries
-rasBefore = {}                                          
-rasAfter = {}
-
-# 2.2 Read files into dictionaries 
-for i in td(range(len(rasBeforeNames)), desc='Reading raster files'):                    
-    rasBefore[i] = rio.open(rasBeforeNames[i]).read(1)  
-    rasAfter[i] = rio.open(rasAfterNames[i]).read(1) 
-    
-# 2.3 Assign 'np.nan' to no-data pixels
-for i in td(range(len(rasBeforeNames)), desc='Setting np.nan values'):
-    rasBefore[i][rasBefore[i]<0] = np.nan
-    rasAfter[i][rasAfter[i]<0] = np.nan
+## Get 'before' and 'after' DEM names
+# (the DEMs are streamed window by window below instead of being read whole into dictionaries)
+rasBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*Resampled.tif")
+rasAfterNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/01_Clipped_Areas/*After.tif")
+assertAligned(checkGrids({'After': rasAfterNames, 'Before_Resampled': rasBeforeNames}))  # fail early on misaligned inputs
+memBudgetMB = 256  # memory for the raster windows read at a time
+rasterCacheDir = "../12_Raster_Cache/"  # rasters are decoded once into this folder and memory-mapped by every later stage and script
+raster_cache.enable(rasterCacheDir, maxSizeMB=20000)  # least recently used rasters are evicted beyond this size
 
 
 
@@ -56,25 +51,27 @@ for i in td(range(len(rasBeforeNames)), desc='Setting np.nan values'):
 df = pd.DataFrame(columns=['Land_Per_Before', 'Land_Per_After', 'Count', 'Min Error', 'Max Error', 'Mean Error', 'Std', 'Percentile25', 'Percentile50', 'Percentile75'], index=range(10))
 
 # 2 Get values into dataframe
-for i in td(range(len(dc)), desc='Preparing error table'):
+for i in td(range(len(errorFiles)), desc='Preparing error table'):
 
-    # 1 Land Percentage before GLOF
-    Land_Per_Before = (np.count_nonzero(~np.isnan(rasBefore[i]))/rasBefore[i].size)*100
-    df['Land_Per_Before'][i] = Land_Per_Before
+    # 1 Count land pixels before and after GLOF window by window (from the bit-packed validity masks)
+    landBefore, size = landPixels(rasBeforeNames[i], memBudgetMB)
+    landAfter, _ = landPixels(rasAfterNames[i], memBudgetMB)
 
-    # 2 Land Percentage after GLOF
-    Land_Per_After = (np.count_nonzero(~np.isnan(rasAfter[i]))/rasAfter[i].size)*100
-    df['Land_Per_After'][i] = Land_Per_After
+    # 2 Land Percentage before and after GLOF
+    df.loc[i, 'Land_Per_Before'] = (landBefore/size)*100
+    df.loc[i, 'Land_Per_After'] = (landAfter/size)*100
 
-    # 3 Error stats 
-    df['Count'][i] = dc[i].abs().describe().T['count'][-1] 
-    df['Min Error'][i] = dc[i].abs().describe().T['min'][-1] 
-    df['Max Error'][i] = dc[i].abs().describe().T['max'][-1] 
-    df['Mean Error'][i] = dc[i].abs().describe().T['mean'][-1] 
-    df['Std'][i] = dc[i].abs().describe().T['std'][-1] 
-    df['Percentile25'][i] = dc[i].abs().describe().T['25%'][-1] 
-    df['Percentile50'][i] = dc[i].abs().describe().T['50%'][-1] 
-    df['Percentile75'][i] = dc[i].abs().describe().T['75%'][-1] 
+    # 3 Error stats of the absolute errors, in one pass over the chunks of the 'diff' column
+    # (percentiles are within 0.1% of the exact ones)
+    errorStats = streamStats(iterErrorChunks(errorFiles[i], 'diff'), relativeAccuracy=0.001, transform=np.abs).describe()
+    df.loc[i, 'Count'] = errorStats['count']
+    df.loc[i, 'Min Error'] = errorStats['min']
+    df.loc[i, 'Max Error'] = errorStats['max']
+    df.loc[i, 'Mean Error'] = errorStats['mean']
+    df.loc[i, 'Std'] = errorStats['std']
+    df.loc[i, 'Percentile25'] = errorStats['25%']
+    df.loc[i, 'Percentile50'] = errorStats['50%']
+    df.loc[i, 'Percentile75'] = errorStats['75%']
 
 
     
@@ -83,28 +80,29 @@ for i in td(range(len(dc)), desc='Preparing error table'):
 # 1 Get file names
 slopeBeforeNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/01_Slope_Maps/*Before_Resampled_slope.tif")
 slopeAfterNames = glob.glob("../02_Data/03_Processed_Data/02_Rasters/02_Slope_And_Aspect_Maps/01_Slope_Maps/*After_slope.tif")
+assertAligned(checkGrids({'After': rasAfterNames, 'Slope_Before': slopeBeforeNames, 'Slope_After': slopeAfterNames}))
 
-# 2.1 Define empty dictionaries
-slopeBefore = {}                                          
-slopeAfter = {}
+# 2 Cluster the slope change (before - after) of every area, and get the error stats of every cluster
+# (k-means on a histogram of the slope change, so memory does not grow with the maps; labels go from slope loss to slope gain)
+clusterDir = "../02_Data/03_Processed_Data/02_Rasters/04_Slope_Change_Clusters/"  # one label raster per area
+nClusters = 4
+dfClusters = clusterAreas(slopeBeforeNames, slopeAfterNames, errorFiles, clusterDir, nClusters=nClusters, memBudgetMB=memBudgetMB)
+dfClusters
 
-# 2.2 Read files into dictionaries 
-for i in td(range(len(slopeBeforeNames)), desc='Reading files'):                    
-    slopeBefore[i] = rio.open(slopeBeforeNames[i]).read(1)  
-    slopeAfter[i] = rio.open(slopeAfterNames[i]).read(1) 
-    
 
-# %% [markdown]
-dfTemp = pd.DataFrame()
-dfTemp['Slope_Before'] = slopeBefore[0].flatten('F')
-dfTemp['Slope_After'] = slopeAfter[0].flatten('F')
-dfTemp['dff'] = dfTemp['Slope_Before'] - dfTemp['Slope_After']
-dfTemp.dropna(inplace=True)
+# %%
+# 3 Mean absolute error of every cluster of every area
+fig, ax = plt.subplots(dpi=100)
+for cluster, group in dfClusters.groupby('Cluster'):
+    ax.bar(group['Area'] + (cluster - (nClusters-1)/2) * 0.8/nClusters, group['mean'], width=0.8/nClusters, color=plt.cm.gist_rainbow(cluster/max(1, nClusters-1)), label="Cluster {}".format(cluster))
+ax.set_xlabel("Area", fontweight='bold')
+ax.set_ylabel("Mean absolute error (m)", fontweight='bold')
+ax.legend()
 
 
-# %%
-model=KMeans(4)
-model.fit(dfTemp.dff.values.reshape(-1,1))
-dfTemp['cl'] = model.labels_
-dfTemp['dff'].plot(c='cl', colormap='gist_rainbow')
-# %%
+
+# %% [markdown]
+## Run report
+# (one row per stage and area, also saved as run_report.json / run_report.csv in 'profileDir')
+print('Time elapsed: ', np.round((time.time()-start)/60, 2), 'mins')
+profiling.runReport(profileDir)
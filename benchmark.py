@@ -0,0 +1,275 @@
+## About
+# This module benchmarks the study on synthetic data, so changes can be timed without the Zenodo dataset:
+# > every area is a georeferenced 'before'/'after' DEM pair: fractal terrain (octaves of smooth noise), a meandering flood channel
+#   carved into the 'after' DEM with levees on its banks, and no-data regions (a ragged edge, a hole, and the water in the channel)
+# > the 'before' DEM is written at half resolution, as in the study, so the resampling stage has work to do
+# > each size is run through all stages of pipeline.py (01 resample, 02 terrain, 03 features/train/predict, 04 plots, 05 stats)
+#   with profiling on, and the time, CPU, memory and I/O of every stage is collected
+#   (every task runs in a new worker process, so its peak memory is not what an earlier task in the same worker left)
+# > the scaling exponent of every stage (time ~ pixels^k) is fitted across the sizes, and the results are compared to a saved baseline
+# Everything is generated strip by strip and runs offline on the CPU.
+#
+# Usage: python benchmark.py --sizes 1024 2048 4096 [--work-dir ../11_Benchmark] [--baseline baseline.json] [--save-baseline]
+
+
+
+## Libraries
+import pandas as pd, numpy as np, rasterio as rio, os, sys, json, time, shutil, platform, argparse, importlib.util
+from rasterio.transform import from_origin
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from pipeline import studyDirs, findAreas, buildTasks, runPipeline, stages
+import profiling
+
+
+
+noData = -9999.0  # negative, as the study's rasters (negative values are read as no-data)
+pixelSize = 0.05  # metres ('after' DEM; the 'before' DEM has twice this)
+crs = 'EPSG:32627'  # UTM 27N, as around Zackenberg
+
+
+
+## Smooth noise grids of the octaves of a fractal surface (the coarsest cell is half the raster, the finest 'minCell' pixels)
+def octaveGrids(size, seed=0, minCell=8):
+    rng = np.random.default_rng(seed)
+    grids, cell = [], size / 2
+    while cell >= minCell:
+        n = int(np.ceil(size / cell)) + 2
+        grids.append((cell, rng.standard_normal((n, n)).astype('float32')))
+        cell /= 2
+    return grids
+
+
+
+## Rows 'rowOff' to 'rowOff+nRows' of a fractal surface (amplitude ~ cell^hurst, std ~1; smoothstep-interpolated grids)
+def fractalStrip(grids, rowOff, nRows, width, hurst=0.8):
+    r, c = rowOff + np.arange(nRows), np.arange(width)
+    z = np.zeros((nRows, width), dtype='float32')
+    norm = np.sqrt(sum(cell**(2*hurst) for cell, _ in grids))
+    for cell, g in grids:
+        fr, fc = r / cell, c / cell
+        r0, c0 = fr.astype('int64'), fc.astype('int64')
+        tr, tc = (fr - r0)[:, None], (fc - c0)[None, :]
+        tr, tc = tr*tr*(3 - 2*tr), tc*tc*(3 - 2*tc)
+        top = g[r0][:, c0]*(1 - tc) + g[r0][:, c0+1]*tc
+        bottom = g[r0+1][:, c0]*(1 - tc) + g[r0+1][:, c0+1]*tc
+        z += (cell**hurst / norm) * (top*(1 - tr) + bottom*tr)
+    return z
+
+
+
+## Rows of a synthetic 'before'/'after' pair (no-data as 'noData')
+def studyStrip(grids, rowOff, nRows, size, seed=0, relief=15.0, base=50.0):
+    before = base + relief * fractalStrip(grids, rowOff, nRows, size)
+    r, c = (rowOff + np.arange(nRows))[:, None], np.arange(size)[None, :]
+
+    # 1 Flood channel: a meander carved ~3 m deep into the 'after' DEM, with ~0.5 m of deposits on its banks
+    center = size * (0.5 + 0.15*np.sin(2*np.pi*r / (size/1.5)))
+    halfWidth = size / 40
+    d = (c - center) / halfWidth
+    after = before - 3.0*np.exp(-d**2) + 0.5*np.exp(-(np.abs(d) - 2)**2)
+    after += np.random.default_rng([seed, rowOff]).normal(0, 0.05, after.shape).astype('float32')
+
+    # 2 No-data: a ragged right edge and a round hole in both DEMs, and the deepest water in the channel of the 'after' DEM
+    edge = size * (0.95 - 0.03*np.sin(2*np.pi*r / (size/3)))
+    hole = (r - 0.25*size)**2 + (c - 0.2*size)**2 < (0.06*size)**2
+    missing = (c > edge) | hole | (before <= 0)
+    before[missing] = noData
+    after[missing | (np.abs(d) < 0.3)] = noData
+    return before.astype('float32'), after.astype('float32')
+
+
+
+## Write the rasters of one synthetic area into the clipped-areas folder of a study
+# ('before' at half resolution, block-averaged, unless 'resampled' is set: then it is written on the 'after' grid as '*_Resampled.tif')
+def makeArea(clippedDir, i, size, seed=0, resampled=False, blockSize=256):
+    area = str(i+1).zfill(2)
+    profile = {'driver': 'GTiff', 'count': 1, 'dtype': 'float32', 'nodata': noData, 'crs': crs, 'tiled': True, 'blockxsize': blockSize,
+               'blockysize': blockSize, 'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER'}
+    transform = from_origin(510000 + 1000*i, 8270000, pixelSize, pixelSize)
+    beforeName = os.path.join(clippedDir, '{}_Area_Before{}.tif'.format(area, '_Resampled' if resampled else ''))
+    afterName = os.path.join(clippedDir, '{}_Area_After.tif'.format(area))
+    grids = octaveGrids(size, seed=seed+i)
+
+    # 1 Open the outputs
+    with rio.open(afterName, 'w', width=size, height=size, transform=transform, **profile) as after, \
+         rio.open(beforeName, 'w', width=size if resampled else size//2, height=size if resampled else size//2,
+                  transform=transform if resampled else transform * transform.scale(2), **profile) as before:
+
+        # 2 Write strip by strip (strips of whole output blocks, of an even number of rows)
+        for rowOff in range(0, size, blockSize):
+            nRows = min(blockSize, size - rowOff)
+            beforeStrip, afterStrip = studyStrip(grids, rowOff, nRows, size, seed=seed+i)
+            after.write(afterStrip, 1, window=rio.windows.Window(0, rowOff, size, nRows))
+            if resampled:
+                before.write(beforeStrip, 1, window=rio.windows.Window(0, rowOff, size, nRows))
+                continue
+
+            # 2.1 Half resolution: mean of every 2x2 block (no-data if any of the four is)
+            h, w = nRows // 2, size // 2
+            blocks = beforeStrip[:2*h, :2*w].reshape(h, 2, w, 2)
+            coarse = blocks.mean(axis=(1, 3))
+            coarse[(blocks == noData).any(axis=(1, 3))] = noData
+            before.write(coarse, 1, window=rio.windows.Window(0, rowOff//2, w, h))
+    return beforeName, afterName
+
+
+
+## Study folders of one size, with 'nAreas' synthetic areas (kept while the size and seed are unchanged)
+def makeStudy(root, size, nAreas=1, seed=0, resampled=False):
+    dirs = studyDirs(root)
+    os.makedirs(dirs['clipped'], exist_ok=True)
+    stampName = os.path.join(root, 'synthetic.json')
+    stamp = {'size': size, 'nAreas': nAreas, 'seed': seed, 'resampled': resampled}
+    if os.path.exists(stampName):
+        with open(stampName) as f:
+            if json.load(f) == stamp:
+                return dirs
+    for i in range(nAreas):
+        makeArea(dirs['clipped'], i, size, seed, resampled)
+    with open(stampName, 'w') as f:
+        json.dump(stamp, f)
+    return dirs
+
+
+
+## Run every stage on every size, with profiling on, and collect the cost of every stage
+def runBenchmark(workDir, sizes, nAreas=1, seed=0, nWorkers=None, memBudgetMB=256, sampleSize=None, backend='tree', log=print):
+    hasGdal = importlib.util.find_spec('osgeo') is not None
+    rows = []
+    for size in sizes:
+
+        # 1 Synthetic areas (the resampling stage needs gdal; without it the 'before' DEMs are generated on the 'after' grid)
+        root = os.path.join(workDir, 'size_{}'.format(size))
+        dirs = makeStudy(root, size, nAreas, seed, resampled=not hasGdal)
+        settings = {'extras': [], 'memBudgetMB': memBudgetMB, 'warpMemoryMB': 512, 'skipResample': not hasGdal, 'backend': backend,
+                    'sampleSize': sampleSize, 'errorFormat': 'parquet', 'nClusters': 4}
+        tasks = buildTasks(findAreas(dirs, skipResample=not hasGdal), dirs, settings)
+
+        # 2 Run all stages cold (no cached features, models or fingerprints from earlier runs)
+        for name in ['features', 'models', 'state']:
+            shutil.rmtree(dirs[name], ignore_errors=True)
+        profileDir = os.path.join(root, 'profile')
+        profiling.enable(profileDir)
+        start = time.perf_counter()
+        try:
+            runPipeline(tasks, dirs['state'], nWorkers=nWorkers, force=list(stages), log=lambda *args: None, freshWorkers=True)
+        finally:
+            profiling.disable()
+        totalSecs = time.perf_counter() - start
+
+        # 3 Cost of every stage (its tasks summed over the areas)
+        report = profiling.runReport(profileDir)
+        report = report[report['Stage'].str.startswith('task_')]
+        pixels = size * size * nAreas
+        for stageName, group in report.groupby('Stage', sort=False):
+            rows.append({'Size': size, 'Pixels': pixels, 'Stage': stageName[len('task_'):], 'Wall_Secs': group['Wall_Secs'].sum(),
+                         'CPU_Secs': group['CPU_Secs'].sum(), 'Peak_RSS_MB': group['Peak_RSS_MB'].max(), 'Read_MB': group['Read_MB'].sum(),
+                         'Written_MB': group['Written_MB'].sum(), 'Pixels_per_Sec': pixels / group['Wall_Secs'].sum()})
+        rows.append({'Size': size, 'Pixels': pixels, 'Stage': 'total', 'Wall_Secs': totalSecs, 'Peak_RSS_MB': report['Peak_RSS_MB'].max(),
+                     'Pixels_per_Sec': pixels / totalSecs})
+        log("{:>6} px  {:8.1f} s".format(size, totalSecs))
+    return pd.DataFrame(rows)
+
+
+
+## Scaling exponent of every stage: slope of log(time) against log(pixels) across the sizes (1 = linear)
+def scalingExponents(results):
+    rows = []
+    for stageName, group in results.groupby('Stage', sort=False):
+        if group['Size'].nunique() >= 2:
+            k = np.polyfit(np.log(group['Pixels']), np.log(group['Wall_Secs'].clip(lower=1e-6)), 1)[0]
+            m = np.polyfit(np.log(group['Pixels']), np.log(group['Peak_RSS_MB']), 1)[0]
+            rows.append({'Stage': stageName, 'Time_Exponent': k, 'Memory_Exponent': m})
+    return pd.DataFrame(rows, columns=['Stage', 'Time_Exponent', 'Memory_Exponent'])
+
+
+
+## Time and peak memory of every stage against the pixels of the study, on log-log axes
+def plotScaling(results, outName, dpi=150):
+    fig = Figure(figsize=(12, 5))
+    FigureCanvasAgg(fig)
+    axTime, axMemory = fig.add_subplot(1, 2, 1), fig.add_subplot(1, 2, 2)
+    for stageName, group in results.groupby('Stage', sort=False):
+        axTime.loglog(group['Pixels'], group['Wall_Secs'], marker='o', label=stageName)
+        axMemory.loglog(group['Pixels'], group['Peak_RSS_MB'], marker='o', label=stageName)
+    for ax, label in [(axTime, "Wall time (s)"), (axMemory, "Peak RSS (MB)")]:
+        ax.set_xlabel("Pixels", fontweight='bold')
+        ax.set_ylabel(label, fontweight='bold')
+        ax.grid(True, which='major', color='k', linestyle='--', alpha=0.50)
+    axTime.legend()
+    fig.savefig(outName, dpi=dpi, bbox_inches='tight')
+
+
+
+## Compare with a baseline: ratio of time and memory of every (size, stage), and regressions beyond 'tolerance'
+# (differences below 'minSecs' / 'minMB' are taken as noise, so short stages do not flag regressions)
+def compareBaseline(results, baseline, tolerance=0.25, minSecs=0.5, minMB=32):
+    merged = results.merge(baseline[['Size', 'Stage', 'Wall_Secs', 'Peak_RSS_MB']], on=['Size', 'Stage'], suffixes=('', '_Baseline'))
+    merged['Time_Ratio'] = merged['Wall_Secs'] / merged['Wall_Secs_Baseline']
+    merged['Memory_Ratio'] = merged['Peak_RSS_MB'] / merged['Peak_RSS_MB_Baseline']
+    slower = (merged['Time_Ratio'] > 1 + tolerance) & (merged['Wall_Secs'] - merged['Wall_Secs_Baseline'] > minSecs)
+    larger = (merged['Memory_Ratio'] > 1 + tolerance) & (merged['Peak_RSS_MB'] - merged['Peak_RSS_MB_Baseline'] > minMB)
+    merged['Regression'] = slower | larger
+    return merged[['Size', 'Stage', 'Wall_Secs', 'Wall_Secs_Baseline', 'Time_Ratio', 'Peak_RSS_MB', 'Peak_RSS_MB_Baseline', 'Memory_Ratio', 'Regression']]
+
+
+
+## Machine the results were measured on (baselines are only comparable on the same kind of machine)
+def machineInfo():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(), 'numpy': np.__version__,
+            'rasterio': rio.__version__, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+
+## Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark all stages of the study on synthetic DEMs")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 2048, 4096], help="side of the synthetic areas in pixels (1024 ... 20000)")
+    parser.add_argument('--areas', type=int, default=1, help="synthetic areas per size")
+    parser.add_argument('--work-dir', default=os.path.join('..', '11_Benchmark'), help="folder of the synthetic studies and the results")
+    parser.add_argument('--workers', type=int, default=None, help="tasks run at a time (default: one per core)")
+    parser.add_argument('--mem-budget', type=float, default=256, help="MB of raster windows read at a time by each task")
+    parser.add_argument('--sample-size', type=int, default=None, help="train on a stratified sample of this many pixels")
+    parser.add_argument('--backend', default='tree', help="regressor backend (see regressors.py)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=None, help="baseline results (json) to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="save these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="slowdown (or memory growth) reported as a regression")
+    args = parser.parse_args(argv)
+
+    # 1 Run
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = runBenchmark(args.work_dir, args.sizes, args.areas, args.seed, args.workers, args.mem_budget, args.sample_size, args.backend)
+    exponents = scalingExponents(results)
+    print(results.to_string(index=False))
+    print(exponents.to_string(index=False))
+
+    # 2 Save the results, scaling curves and machine
+    results.to_csv(os.path.join(args.work_dir, 'benchmark.csv'), index=False)
+    with open(os.path.join(args.work_dir, 'benchmark.json'), 'w') as f:
+        json.dump({'machine': machineInfo(), 'settings': vars(args), 'results': results.to_dict(orient='records'),
+                   'scaling': exponents.to_dict(orient='records')}, f, indent=1, default=float)
+    if results['Size'].nunique() >= 2:
+        plotScaling(results, os.path.join(args.work_dir, 'scaling.png'))
+
+    # 3 Compare with the baseline (exit code 1 on a regression), or save a new one
+    status = 0
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        comparison = compareBaseline(results, pd.DataFrame(saved['results']), args.tolerance)
+        print("Baseline from {} ({})".format(saved['machine']['created'], saved['machine']['platform']))
+        print(comparison.to_string(index=False))
+        status = int(comparison['Regression'].any())
+    if args.save_baseline:
+        baselineName = args.baseline or os.path.join(args.work_dir, 'baseline.json')
+        with open(baselineName, 'w') as f:
+            json.dump({'machine': machineInfo(), 'settings': vars(args), 'results': results.to_dict(orient='records')}, f, indent=1, default=float)
+        print("Baseline saved to", baselineName)
+    return status
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+## About
+# This module cross-validates an area model on spatial blocks instead of a random pixel split:
+# > the row/col grid is cut into square blocks, and whole blocks are dealt to 'k' folds, so that
+#   neighbouring pixels never end up on both sides of a split
+# > the feature matrix and the fold of every pixel are written once as .npy files, and the fold workers
+#   memory-map them instead of receiving copies
+# > every fold is fitted in its own worker process, and reports its error and timing
+
+
+
+## Libraries
+import pandas as pd, numpy as np, os, time
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.base import clone
+from sklearn.tree import DecisionTreeRegressor
+from features import buildAreaFeatures, splitXy
+
+
+
+## Fold of every pixel: blocks of 'blockSize' x 'blockSize' pixels dealt at random to 'k' folds
+def blockFolds(X, k=5, blockSize=256, seed=0):
+    row, col = X[:, 0].astype('int64') // blockSize, X[:, 1].astype('int64') // blockSize
+    blocks = np.unique(row * (col.max()+1) + col, return_inverse=True)[1]
+    nBlocks = blocks.max() + 1
+    if nBlocks < k:
+        raise ValueError("Only {} blocks of {} pixels for {} folds, use a smaller blockSize".format(nBlocks, blockSize, k))
+    foldOfBlock = np.random.default_rng(seed).permutation(nBlocks) % k
+    return foldOfBlock[blocks].astype('int8')
+
+
+
+## Fit and score one fold, from the memory-mapped features and folds
+def _runFold(featuresName, foldsName, fold, regressor):
+    Xy = np.load(featuresName, mmap_mode='r')
+    folds = np.load(foldsName, mmap_mode='r')
+    X, y = splitXy(Xy)
+    test = folds == fold
+
+    # 1 Fit on the other folds
+    start = time.time()
+    regressor = clone(regressor)
+    regressor.fit(X[~test], y[~test])
+    fitSecs = time.time() - start
+
+    # 2 Score on this fold
+    start = time.time()
+    diff = regressor.predict(X[test]) - y[test]
+    return {'Fold': fold+1, 'Train': int((~test).sum()), 'Test': int(test.sum()), 'Fit_Secs': fitSecs, 'Predict_Secs': time.time()-start,
+            'MAE': np.abs(diff).mean(), 'RMSE': np.sqrt((diff**2).mean())}
+
+
+
+## Spatial block cross-validation of one area
+def blockCrossValidate(beforeName, afterName, workDir, regressor=None, k=5, blockSize=256, seed=0, nWorkers=None, memBudgetMB=256, extras=(), terrainNames=None):
+    regressor = regressor if regressor is not None else DecisionTreeRegressor(random_state=0)
+    os.makedirs(workDir, exist_ok=True)
+
+    # 1 Write the features and folds once, for all workers to memory-map
+    featuresName, foldsName = os.path.join(workDir, 'features.npy'), os.path.join(workDir, 'folds.npy')
+    Xy = buildAreaFeatures(beforeName, afterName, memBudgetMB=memBudgetMB, memmapPath=featuresName, extras=extras, terrainNames=terrainNames)
+    np.save(foldsName, blockFolds(Xy, k, blockSize, seed))
+    Xy.flush()
+    del Xy
+
+    # 2 Run the folds in parallel
+    with ProcessPoolExecutor(max_workers=nWorkers or k) as pool:
+        futures = [pool.submit(_runFold, featuresName, foldsName, fold, regressor) for fold in range(k)]
+        return pd.DataFrame([future.result() for future in futures])
@@ -0,0 +1,258 @@
+## About
+# This module keeps a tile-level index of the rasters of repeated survey epochs in one sqlite file, so a new epoch
+# only recomputes the tiles whose inputs changed:
+# > every raster of an epoch is indexed in square tiles: a checksum of its values and no-data mask,
+#   min/max/mean elevation and valid fraction (a file indexed before, unchanged, is not read again)
+# > every output tile records the key of what it was computed from: the checksums of the input tiles under its bounds
+#   (grown by a halo, and found through the bounds, so inputs may be on another grid), the grids of the inputs and the output,
+#   and the settings
+# > the output of a new epoch starts as a copy of the previous epoch's (if it is on the same grid; else it starts empty),
+#   and only tiles whose key changed are recomputed;
+#   their index rows are updated as they are written, the others are carried over
+# > tiles and their statistics can be queried per raster, tile and epoch
+
+
+
+## Libraries
+import pandas as pd, numpy as np, rasterio as rio, sqlite3, hashlib, json, os, shutil, math, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window, bounds, from_bounds
+from rasterio.warp import transform_bounds
+from raster_io import readBand
+from compact_raster import CompactRaster
+from profiling import stage
+
+
+
+## Tables of the index
+schema = """
+CREATE TABLE IF NOT EXISTS rasters (epoch TEXT, raster TEXT, file TEXT, stamp TEXT, tile_size INTEGER, PRIMARY KEY (epoch, raster));
+CREATE TABLE IF NOT EXISTS tiles (epoch TEXT, raster TEXT, tile_row INTEGER, tile_col INTEGER, row_off INTEGER, col_off INTEGER, height INTEGER, width INTEGER,
+                                  checksum TEXT, min REAL, max REAL, mean REAL, valid_fraction REAL, PRIMARY KEY (epoch, raster, tile_row, tile_col));
+CREATE TABLE IF NOT EXISTS outputs (file TEXT, tile_row INTEGER, tile_col INTEGER, epoch TEXT, key TEXT, PRIMARY KEY (file, tile_row, tile_col));
+"""
+
+
+
+## Open (or create) the index (one connection per process; writers wait for each other)
+def openIndex(dbName):
+    os.makedirs(os.path.dirname(os.path.abspath(dbName)), exist_ok=True)
+    db = sqlite3.connect(dbName, timeout=300)
+    db.executescript(schema)
+    return db
+
+
+
+## Square tiles of a raster: (tile row, tile col) and window
+def tileWindows(height, width, tileSize=256):
+    for tileRow, rowOff in enumerate(range(0, height, tileSize)):
+        for tileCol, colOff in enumerate(range(0, width, tileSize)):
+            yield (tileRow, tileCol), Window(colOff, rowOff, min(tileSize, width-colOff), min(tileSize, height-rowOff))
+
+
+
+## Index row of one tile: checksum of the mask and values, elevation statistics and valid fraction
+# ('tile' as read by readBand, or as computed, with negative values then masked as readBand does)
+def tileRow(epoch, raster, tileId, window, tile, maskNegative=False):
+    tile = tile.astype('float32')
+    if maskNegative:
+        tile[tile<0] = np.nan
+    compact = CompactRaster.fromArray(tile)
+    values = compact.elevation()
+    checksum = hashlib.blake2b(compact.bits.tobytes() + values.tobytes(), digest_size=16).hexdigest()
+    low, high, mean = (float(values.min()), float(values.max()), float(values.mean(dtype='float64'))) if values.size else (None, None, None)
+    return (epoch, raster, *tileId, window.row_off, window.col_off, window.height, window.width, checksum, low, high, mean, compact.validFraction)
+
+
+
+## Size and modification time of a file (an indexed file with the same stamp is not read again)
+def _stamp(fileName):
+    stat = os.stat(fileName)
+    return json.dumps([stat.st_size, stat.st_mtime_ns])
+
+
+
+## Index the tiles of a raster for an epoch ('raster': its name in the index, the same in every epoch, e.g. 'Area_01_Before')
+def indexRaster(db, fileName, epoch, raster, tileSize=256, maskNegative=True):
+    known = db.execute('SELECT file, stamp, tile_size FROM rasters WHERE epoch=? AND raster=?', (epoch, raster)).fetchone()
+    if known != (os.path.abspath(fileName), _stamp(fileName), tileSize):
+
+        # 1 Read it tile by tile
+        rows = []
+        with stage('index', pixels=0) as record, rio.open(fileName) as src:
+            for tileId, window in tileWindows(*src.shape, tileSize):
+                rows.append(tileRow(epoch, raster, tileId, window, readBand(src, window, maskNegative)))
+                record['Pixels'] += window.height * window.width
+
+        # 2 Replace its rows
+        with db:
+            db.execute('DELETE FROM tiles WHERE epoch=? AND raster=?', (epoch, raster))
+            db.executemany('INSERT INTO tiles VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+            db.execute('INSERT OR REPLACE INTO rasters VALUES (?,?,?,?,?)', (epoch, raster, os.path.abspath(fileName), _stamp(fileName), tileSize))
+    return tileChecksums(db, epoch, raster)
+
+
+
+## Checksums of the tiles of an indexed raster: (tile row, tile col) -> checksum
+def tileChecksums(db, epoch, raster):
+    return {(r, c): checksum for r, c, checksum in db.execute('SELECT tile_row, tile_col, checksum FROM tiles WHERE epoch=? AND raster=?', (epoch, raster))}
+
+
+
+## Tiles of a raster that are new or changed since an earlier epoch
+def changedTiles(db, raster, epoch, previous):
+    return pd.read_sql("""SELECT t.* FROM tiles t LEFT JOIN tiles p ON p.epoch=? AND p.raster=t.raster AND p.tile_row=t.tile_row AND p.tile_col=t.tile_col
+                          WHERE t.epoch=? AND t.raster=? AND (p.checksum IS NULL OR p.checksum != t.checksum) ORDER BY t.tile_row, t.tile_col""",
+                       db, params=(previous, epoch, raster))
+
+
+
+## Index rows of the tiles (all epochs and rasters unless given)
+def tileStats(db, epoch=None, raster=None):
+    where = [(column, value) for column, value in (('epoch', epoch), ('raster', raster)) if value is not None]
+    sql = 'SELECT * FROM tiles' + (' WHERE ' + ' AND '.join('{}=?'.format(column) for column, _ in where) if where else '')
+    return pd.read_sql(sql + ' ORDER BY raster, epoch, tile_row, tile_col', db, params=[value for _, value in where])
+
+
+
+## Statistics of every raster in every epoch, from its tiles: land percentage, min, max and mean elevation
+def epochSummary(db, raster=None):
+    return pd.read_sql("""SELECT raster AS Raster, epoch AS Epoch, COUNT(*) AS Tiles, 100.0*SUM(valid_fraction*height*width)/SUM(height*width) AS Land_Per,
+                                 MIN(min) AS Min, MAX(max) AS Max, SUM(mean*valid_fraction*height*width)/SUM(valid_fraction*height*width) AS Mean
+                          FROM tiles {} GROUP BY raster, epoch ORDER BY raster, epoch""".format('WHERE raster=?' if raster else ''),
+                       db, params=[raster] if raster else [])
+
+
+
+## Grid of a raster (transform, shape and CRS), as hashed into the tile keys
+def _grid(transform, height, width, crs):
+    return [list(transform)[:6], height, width, crs.to_string() if crs else None]
+
+
+
+## Key of every tile of an output grid: settings + grids + checksums of the input tiles under its bounds (grown by 'halo' input pixels)
+def _tileKeys(db, epoch, inputs, profile, settings, halo, tileSize):
+
+    # 1 Grid and tile checksums of every input
+    grids = {}
+    for raster, fileName in sorted(inputs.items()):
+        known = db.execute('SELECT tile_size FROM rasters WHERE epoch=? AND raster=?', (epoch, raster)).fetchone()
+        if known is None:
+            raise ValueError("{} is not indexed for epoch {}".format(raster, epoch))
+        with rio.open(fileName) as src:
+            grids[raster] = (src.transform, src.crs, src.height, src.width, known[0], tileChecksums(db, epoch, raster),
+                             _grid(src.transform, src.height, src.width, src.crs))
+
+    # 2 Every key starts from the settings and the grids, so a moved or resized raster recomputes every tile
+    base = json.dumps({'settings': settings, 'output': _grid(profile['transform'], profile['height'], profile['width'], profile.get('crs')),
+                       'inputs': {raster: grid[-1] for raster, grid in grids.items()}}, sort_keys=True, default=str).encode()
+
+    # 3 Hash the checksums of the input tiles every output tile reads (its footprint taken to the CRS of the input if they differ)
+    keys = {}
+    for tileId, window in tileWindows(profile['height'], profile['width'], tileSize):
+        h = hashlib.blake2b(base, digest_size=16)
+        for raster, (transform, crs, height, width, inTileSize, checksums, _) in grids.items():
+            footprint = bounds(window, profile['transform'])
+            if crs and profile.get('crs') and crs != profile['crs']:
+                footprint = transform_bounds(profile['crs'], crs, *footprint)
+            win = from_bounds(*footprint, transform=transform)
+            top, left = max(0, math.floor(win.row_off + 1e-6) - halo), max(0, math.floor(win.col_off + 1e-6) - halo)
+            bottom = min(height, math.ceil(win.row_off + win.height - 1e-6) + halo)
+            right = min(width, math.ceil(win.col_off + win.width - 1e-6) + halo)
+            for r in range(top // inTileSize, (bottom-1) // inTileSize + 1):
+                for c in range(left // inTileSize, (right-1) // inTileSize + 1):
+                    h.update('{}:{}:{}:{};'.format(raster, r, c, checksums.get((r, c), '-')).encode())
+        keys[tileId] = (window, h.hexdigest())
+    return keys
+
+
+
+## Is a raster on the grid of 'profile' (same transform, shape and CRS)?
+def _onGrid(fileName, profile):
+    with rio.open(fileName) as src:
+        return _grid(src.transform, src.height, src.width, src.crs) == _grid(profile['transform'], profile['height'], profile['width'], profile.get('crs'))
+
+
+
+## Start an output of an epoch: a copy of the previous epoch's if it is on the same grid (with its keys and index rows), or an empty raster
+def _startOutput(db, epoch, outName, raster, profile, previousName):
+    if os.path.exists(outName):
+        if _onGrid(outName, profile):
+            return
+        os.remove(outName)  # written on another grid: start again
+    if previousName and os.path.exists(previousName) and _onGrid(previousName, profile):
+        shutil.copyfile(previousName, outName + '.tmp')
+        os.replace(outName + '.tmp', outName)
+        with db:
+            db.execute('DELETE FROM outputs WHERE file=?', (os.path.abspath(outName),))
+            db.execute('INSERT INTO outputs SELECT ?, tile_row, tile_col, epoch, key FROM outputs WHERE file=?', (os.path.abspath(outName), os.path.abspath(previousName)))
+            known = db.execute('SELECT epoch FROM rasters WHERE raster=? AND file=?', (raster, os.path.abspath(previousName))).fetchone()
+            if raster and known:
+                db.execute('DELETE FROM tiles WHERE epoch=? AND raster=?', (epoch, raster))
+                db.execute('INSERT INTO tiles SELECT ?, raster, tile_row, tile_col, row_off, col_off, height, width, checksum, min, max, mean, valid_fraction '
+                           'FROM tiles WHERE epoch=? AND raster=?', (epoch, known[0], raster))
+    else:
+        with rio.open(outName, 'w', **profile):
+            pass
+        with db:
+            db.execute('DELETE FROM outputs WHERE file=?', (os.path.abspath(outName),))
+            if raster:
+                db.execute('DELETE FROM tiles WHERE epoch=? AND raster=?', (epoch, raster))
+
+
+
+## Compute the tiles of the outputs of an epoch whose inputs changed, and return their ids
+# > 'inputs': name in the index -> file, all indexed for 'epoch'; 'outNames': output -> file, written with 'profile'
+# > 'compute(window)': output -> array of the window (called from 'nWorkers' threads, so it must open its own files)
+# > 'previousNames': the same outputs of an earlier epoch, copied as the starting point
+# > 'settings': everything else the values depend on (e.g. the model); a change recomputes every tile
+# > 'rasters': output -> its name in the index (the index rows of its recomputed tiles are updated, the others carried over;
+#   'maskNegative' as for indexRaster)
+def updateTiles(db, epoch, inputs, outNames, compute, profile, previousNames=None, settings=None, halo=0, tileSize=256, nWorkers=4, rasters=None, maskNegative=True):
+    previousNames, rasters = previousNames or {}, rasters or {}
+    keys = _tileKeys(db, epoch, inputs, profile, settings, halo, tileSize)
+
+    # 1 Start the outputs, and find the tiles whose key differs in any of them
+    for name, outName in outNames.items():
+        _startOutput(db, epoch, outName, rasters.get(name), profile, previousNames.get(name))
+    done = {}
+    for name, outName in outNames.items():
+        done[name] = {(r, c): key for r, c, key in db.execute('SELECT tile_row, tile_col, key FROM outputs WHERE file=?', (os.path.abspath(outName),))}
+    dirty = [tileId for tileId, (window, key) in keys.items() if any(done[name].get(tileId) != key for name in outNames)]
+
+    # 2 Compute them in threads, with at most two per worker waiting, and write them (and their index rows) as they finish
+    rows, outRows = [], []
+    dsts = {name: rio.open(outName, 'r+') for name, outName in outNames.items()}
+
+    def write(tileId, values):
+        window, key = keys[tileId]
+        for name, dst in dsts.items():
+            dst.write(values[name].astype(dst.dtypes[0], copy=False), 1, window=window)
+            outRows.append((os.path.abspath(outNames[name]), *tileId, epoch, key))
+            if rasters.get(name):
+                rows.append(tileRow(epoch, rasters[name], tileId, window, values[name], maskNegative))
+        record['Pixels'] += window.height * window.width
+
+    try:
+        with stage('update_tiles', pixels=0) as record, ThreadPoolExecutor(max_workers=nWorkers) as pool:
+            pending = deque()
+            for tileId in dirty:
+                pending.append((tileId, pool.submit(contextvars.copy_context().run, compute, keys[tileId][0])))
+                if len(pending) >= 2*nWorkers:
+                    tileId, future = pending.popleft()
+                    write(tileId, future.result())
+            while pending:
+                tileId, future = pending.popleft()
+                write(tileId, future.result())
+    finally:
+        for dst in dsts.values():
+            dst.close()
+
+    # 3 Record the keys, and the index rows of the recomputed tiles
+    with db:
+        db.executemany('INSERT OR REPLACE INTO outputs VALUES (?,?,?,?,?)', outRows)
+        db.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        for name, raster in rasters.items():
+            db.execute('INSERT OR REPLACE INTO rasters VALUES (?,?,?,?,?)', (epoch, raster, os.path.abspath(outNames[name]), _stamp(outNames[name]), tileSize))
+    return dirty
@@ -0,0 +1,122 @@
+## About
+# This module holds raster tiles compactly, instead of as float grids with NaN for no-data:
+# > only the values of the valid pixels are stored, as float32 (or as int16/int32 steps of 'scale' above the lowest value)
+# > validity is a bit-packed mask, 1 bit per pixel (a float64 grid with NaNs takes 64)
+# > flat indices, rows and cols of the valid pixels are worked out from the mask when first asked for, never stored as full grids
+# Rasters are walked window by window into such tiles, so no stage needs a dense grid of a whole area
+
+
+
+## Libraries
+import numpy as np, rasterio as rio
+from raster_io import readBand, stripWindows
+
+
+
+## Tile of a raster: values of the valid pixels in row-major order, plus a bit-packed validity mask
+class CompactRaster:
+
+    def __init__(self, values, bits, shape, rowOff=0, colOff=0, scale=None, offset=0.0):
+        self.values, self.bits, self.shape = values, bits, tuple(shape)
+        self.rowOff, self.colOff = rowOff, colOff
+        self.scale, self.offset = scale, offset
+        self._index = None
+
+
+    ## Pack a float tile (valid = not NaN unless 'valid' is given; 'scale': store the values as integer steps of this size)
+    @classmethod
+    def fromArray(cls, arr, rowOff=0, colOff=0, valid=None, scale=None):
+        if valid is None:
+            valid = ~np.isnan(arr)
+        tile = cls(None, np.packbits(valid, axis=None), arr.shape, rowOff, colOff)
+        values = arr.ravel()[tile.index]
+
+        # 1 Quantize, in int16 if the steps fit and int32 otherwise
+        if scale is not None and values.size:
+            offset = float(values.min())
+            steps = np.rint((values - offset) / scale)
+            dtype = 'int16' if steps.max() <= np.iinfo('int16').max else 'int32'
+            tile.values, tile.scale, tile.offset = steps.astype(dtype), scale, offset
+        else:
+            tile.values = values.astype('float32', copy=False)
+        return tile
+
+
+    ## Pixels of the tile, valid pixels and their fraction
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def nValid(self):
+        return self.values.size
+
+    @property
+    def validFraction(self):
+        return self.nValid / self.size if self.size else 0.0
+
+    ## Bytes held (values and mask, plus the indices once they were asked for)
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.bits.nbytes + (self._index.nbytes if self._index is not None else 0)
+
+
+    ## Validity mask as a boolean grid
+    def valid(self):
+        return np.unpackbits(self.bits, count=self.size).view(bool).reshape(self.shape)
+
+
+    ## Flat indices of the valid pixels within the tile (computed once, on first use; int32 where they fit)
+    @property
+    def index(self):
+        if self._index is None:
+            idx = np.flatnonzero(np.unpackbits(self.bits, count=self.size))
+            self._index = idx.astype('int32') if self.size < 2**31 else idx
+        return self._index
+
+    ## Rows and cols of the valid pixels in the whole raster
+    @property
+    def rows(self):
+        return self.index // self.shape[1] + self.rowOff
+
+    @property
+    def cols(self):
+        return self.index % self.shape[1] + self.colOff
+
+
+    ## Values of the valid pixels as float32
+    def elevation(self):
+        if self.scale is None:
+            return self.values
+        return (self.values * np.float32(self.scale) + np.float32(self.offset)).astype('float32', copy=False)
+
+
+    ## Values of another tile on the same grid at the valid pixels of this one
+    def take(self, arr):
+        return arr.ravel()[self.index]
+
+
+    ## Dense float32 grid, NaN where no-data
+    def dense(self):
+        arr = np.full(self.shape, np.nan, dtype='float32')
+        arr.ravel()[self.index] = self.elevation()
+        return arr
+
+
+
+## Walk a raster window by window as compact tiles
+def compactWindows(name, memBudgetMB=256, maskNegative=True, scale=None):
+    with rio.open(name) as src:
+        height, width = src.shape
+        for window in stripWindows(height, width, 1, memBudgetMB, src.block_shapes[0][0]):
+            yield window, CompactRaster.fromArray(readBand(src, window, maskNegative), window.row_off, window.col_off, scale=scale)
+
+
+
+## Land (valid) pixels and all pixels of a raster
+def landPixels(name, memBudgetMB=256):
+    nValid, size = 0, 0
+    for window, tile in compactWindows(name, memBudgetMB):
+        nValid += tile.nValid
+        size += tile.size
+    return nValid, size
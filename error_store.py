@@ -0,0 +1,110 @@
+## About
+# This module writes and reads the per-area prediction errors in a binary columnar format
+# (float32 values with the row/col of each pixel), instead of the text '_error.csv' files
+# > 'parquet': one compressed file, read by column and by row group (needs pyarrow)
+# > 'npy': a directory with one .npy file per column, read memory-mapped
+# > 'csv': text export, for spreadsheets
+
+
+
+## Libraries
+import pandas as pd, numpy as np, os, glob
+from profiling import stage
+
+
+
+## Columns of the error files
+errorColumns = ['Row', 'Col', 'yPred', 'yTest', 'diff']
+dtypes = {'Row': 'int32', 'Col': 'int32', 'yPred': 'float32', 'yTest': 'float32', 'diff': 'float32'}
+extensions = {'parquet': '.parquet', 'npy': '', 'csv': '.csv'}
+
+
+
+## Name of the error file of area 'i'
+def errorPath(outDir, i, fmt='parquet'):
+    return os.path.join(outDir, "{}_Area_{}_error{}".format(str(i+1).zfill(2), str(i+1).zfill(2), extensions[fmt]))
+
+
+
+## Format of an error file, from its name
+def errorFormat(name):
+    if name.endswith('.parquet'):
+        return 'parquet'
+    if name.endswith('.csv'):
+        return 'csv'
+    return 'npy'
+
+
+
+## List the error files of a directory, in area order
+def listErrorFiles(errDir, fmt='parquet'):
+    return sorted(glob.glob(os.path.join(errDir, '*_error' + extensions[fmt])))
+
+
+
+## Write the errors of an area
+def writeErrors(name, row, col, yPred, yTest, rowGroupSize=1000000):
+
+    # 1 Get the columns as float32/int32
+    values = {'Row': row, 'Col': col, 'yPred': yPred, 'yTest': yTest}
+    values = {c: np.asarray(v, dtype=dtypes[c]) for c, v in values.items()}
+    values['diff'] = values['yPred'] - values['yTest']
+
+    # 2 Write them in the format given by the name
+    with stage('write_errors', pixels=len(values['diff'])):
+        fmt = errorFormat(name)
+        if fmt == 'parquet':
+            pd.DataFrame(values).to_parquet(name, engine='pyarrow', compression='zstd', index=False, row_group_size=rowGroupSize)
+        elif fmt == 'csv':
+            pd.DataFrame(values).to_csv(name, index=False)
+        else:
+            os.makedirs(name, exist_ok=True)
+            for c in errorColumns:
+                np.save(os.path.join(name, c + '.npy'), values[c])
+    return name
+
+
+
+## Read some columns of an area as arrays ('npy' columns are memory-mapped, not read)
+def readErrorColumns(name, columns=None):
+    columns = columns or errorColumns
+    fmt = errorFormat(name)
+    if fmt == 'npy':
+        return {c: np.load(os.path.join(name, c + '.npy'), mmap_mode='r') for c in columns}
+    if fmt == 'parquet':
+        df = pd.read_parquet(name, engine='pyarrow', columns=columns)
+    else:
+        df = pd.read_csv(name, usecols=columns, dtype={c: dtypes[c] for c in columns})
+    return {c: df[c].values for c in columns}
+
+
+
+## Read some columns of an area as a DataFrame
+def readErrors(name, columns=None):
+    columns = columns or errorColumns
+    return pd.DataFrame(readErrorColumns(name, columns), columns=columns)
+
+
+
+## Walk some columns of an area chunk by chunk, as dicts of arrays (for passes that must not hold whole columns)
+def iterErrorColumns(name, columns=None, chunkSize=1000000):
+    columns = columns or errorColumns
+    fmt = errorFormat(name)
+    if fmt == 'npy':
+        values = {c: np.load(os.path.join(name, c + '.npy'), mmap_mode='r') for c in columns}
+        for pos in range(0, len(values[columns[0]]), chunkSize):
+            yield {c: np.asarray(v[pos:pos+chunkSize]) for c, v in values.items()}
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(name).iter_batches(batch_size=chunkSize, columns=columns):
+            yield {c: batch.column(c).to_numpy() for c in columns}
+    else:
+        for chunk in pd.read_csv(name, usecols=columns, dtype={c: dtypes[c] for c in columns}, chunksize=chunkSize):
+            yield {c: chunk[c].values for c in columns}
+
+
+
+## Walk a column of an area chunk by chunk (for statistics that must not hold the whole column)
+def iterErrorChunks(name, column='diff', chunkSize=1000000):
+    for chunk in iterErrorColumns(name, [column], chunkSize):
+        yield chunk[column]
@@ -0,0 +1,227 @@
+## About
+# This module assembles the (Row, Col, Land_Before, [terrain features], Land_After) matrix of all valid pixels of an area
+# straight from the no-data mask with index arithmetic, without full-size row/col grids or DataFrame copies
+# (each window is packed into a CompactRaster: float32 values of the valid pixels, a 1 bit validity mask, rows/cols computed on demand)
+# > 'Slope' and 'Aspect' are read from the slope/aspect maps of the 'before' DEM (02), in the same windows as the DEMs
+# > 'Relief' (max - min) and 'Roughness' (std) of the 3x3 neighbourhood are computed from the 'before' DEM on the fly
+# With a cache directory the matrix of an area is kept as a .npy file, keyed by the contents of its rasters and its features
+
+
+
+## Libraries
+import numpy as np, rasterio as rio, hashlib, os
+from contextlib import ExitStack
+from raster_io import readBand, stripWindows, haloWindow
+from model_store import fingerprint
+from profiling import stage
+from compact_raster import CompactRaster
+
+
+
+## Columns of the feature matrix ('X' is every column but the last, 'y' the last)
+featureColumns = ['Row', 'Col', 'Land_Before']
+targetColumn = 'Land_After'
+columns = featureColumns + [targetColumn]
+
+## Terrain features that can be added after the base features
+rasterFeatures = ['Slope', 'Aspect']  # read from the maps given in 'terrainNames'
+neighbourhoodFeatures = ['Relief', 'Roughness']  # computed from the 'before' DEM
+
+
+
+## Columns of the matrix with some terrain features added
+def featureNames(extras=()):
+    unknown = [name for name in extras if name not in rasterFeatures + neighbourhoodFeatures]
+    if unknown:
+        raise ValueError("Unknown features {}, expected some of {}".format(unknown, rasterFeatures + neighbourhoodFeatures))
+    return featureColumns + list(extras) + [targetColumn]
+
+
+
+## Relief and roughness of the 3x3 neighbourhood of every pixel of a window read with a one pixel halo
+def neighbourhood(dem, missing):
+
+    # 1 Pad the sides that fell outside the raster by repeating the edge pixels
+    top, bottom, left, right = missing
+    z = np.pad(dem, ((top, bottom), (left, right)), mode='edge')
+    height, width = z.shape[0]-2, z.shape[1]-2
+    center = z[1:-1, 1:-1]
+
+    # 2 Running max, min and moments of the neighbours about the center (no float32 cancellation on high DEMs)
+    # (no-data neighbours are skipped)
+    high, low = np.full((height, width), -np.inf, 'float32'), np.full((height, width), np.inf, 'float32')
+    count, total, squares = np.zeros((height, width), 'float32'), np.zeros((height, width), 'float32'), np.zeros((height, width), 'float32')
+    for dr in range(3):
+        for dc in range(3):
+            v = z[dr:dr+height, dc:dc+width] - center
+            high, low = np.fmax(high, v), np.fmin(low, v)
+            valid = ~np.isnan(v)
+            v[~valid] = 0
+            count += valid
+            total += v
+            squares += v*v
+
+    # 3 Relief and roughness (no-data where the center is)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relief = high - low
+        roughness = np.sqrt(np.maximum(squares/count - (total/count)**2, 0))
+    return {'Relief': relief, 'Roughness': roughness}
+
+
+
+## Walk an area window by window, giving the 'before' and 'after' tiles (no 'after' without 'afterName')
+# and the tiles of the terrain features, in the order of 'extras'
+# ('nHeld': float32 values per pixel the caller holds on top, 'blockHeight': align the windows to it instead of the 'before' blocks,
+#  'windows': walk these windows instead of strips)
+def featureWindows(beforeName, afterName=None, extras=(), terrainNames=None, memBudgetMB=256, nHeld=0, blockHeight=None, windows=None):
+    terrainNames = terrainNames or {}
+    missingMaps = [name for name in extras if name in rasterFeatures and name not in terrainNames]
+    if missingMaps:
+        raise ValueError("No maps given in 'terrainNames' for {}".format(missingMaps))
+    with ExitStack() as stack:
+
+        # 1 Open the rasters and check that they are on one grid
+        before = stack.enter_context(rio.open(beforeName))
+        after = stack.enter_context(rio.open(afterName)) if afterName else None
+        terrain = {name: stack.enter_context(rio.open(terrainNames[name])) for name in extras if name in rasterFeatures}
+        for src in ([after] if after is not None else []) + list(terrain.values()):
+            if src.shape != before.shape:
+                raise ValueError("{} has shape {}, expected {} as {}".format(src.name, src.shape, before.shape, beforeName))
+
+        # 2 Windows sized for all the rasters read, plus ~8 temporaries of the neighbourhood features
+        height, width = before.shape
+        useHalo = any(name in neighbourhoodFeatures for name in extras)
+        nRasters = 1 + (after is not None) + len(terrain) + (8 if useHalo else 0) + nHeld
+        if windows is None:
+            windows = stripWindows(height, width, nRasters, memBudgetMB, blockHeight or before.block_shapes[0][0])
+        for window in windows:
+            tiles = {}
+
+            # 2.1 'before' (read with a halo if the neighbourhood features are needed)
+            if useHalo:
+                readWin, missing = haloWindow(window, 1, height, width)
+                dem = readBand(before, readWin)
+                tiles.update(neighbourhood(dem, missing))
+                top, left = 1-missing[0], 1-missing[2]
+                beforeTile = dem[top:top+window.height, left:left+window.width]
+            else:
+                beforeTile = readBand(before, window)
+
+            # 2.2 'after' and the terrain maps (aspect is -1 on flat cells, so negative values are kept)
+            afterTile = readBand(after, window) if after is not None else None
+            for name, src in terrain.items():
+                tiles[name] = readBand(src, window, maskNegative=False)
+            yield window, beforeTile, afterTile, [tiles[name] for name in extras]
+
+
+
+## Mask of the pixels of a window that are valid in every tile
+def validMask(*tiles):
+    valid = ~np.isnan(tiles[0])
+    for tile in tiles[1:]:
+        valid &= ~np.isnan(tile)
+    return valid
+
+
+
+## Fill the feature rows of the valid pixels of a compact 'before' tile into 'out'
+def fillRows(before, extraTiles=(), out=None):
+    if out is None:
+        out = np.empty((before.nValid, len(featureColumns) + len(extraTiles)), dtype='float32')
+
+    # 1 Get row, col from the flat indices of the mask
+    out[:, 0] = before.rows
+    out[:, 1] = before.cols
+
+    # 2 Get the 'before' Land elevation values and the terrain features
+    out[:, 2] = before.elevation()
+    for j, tile in enumerate(extraTiles):
+        out[:, len(featureColumns)+j] = before.take(tile)
+    return out
+
+
+
+## Fill the rows of one window into 'out'
+def tileFeatures(before, after, extraTiles=(), rowOff=0, colOff=0, out=None):
+
+    # 1 Pack the 'before' values of the pixels that are valid before, after and in every terrain feature
+    compact = CompactRaster.fromArray(before, rowOff, colOff, valid=validMask(before, after, *extraTiles))
+    if out is None:
+        out = np.empty((compact.nValid, len(featureColumns) + len(extraTiles) + 1), dtype='float32')
+
+    # 2 Get the features and the 'after' Land elevation values
+    fillRows(compact, extraTiles, out=out[:, :-1])
+    out[:, -1] = compact.take(after)
+    return out
+
+
+
+## Get the features of every pixel of one window that is valid before (for prediction, no 'after' needed)
+def tilePredictors(before, extraTiles=(), rowOff=0, colOff=0):
+    compact = CompactRaster.fromArray(before, rowOff, colOff, valid=validMask(before, *extraTiles))
+    return compact.index, fillRows(compact, extraTiles)
+
+
+
+## Cache file of the matrix of an area: hash of the contents of its rasters and of its features
+def cachePath(cacheDir, beforeName, afterName, extras=(), terrainNames=None):
+    h = hashlib.blake2b(digest_size=16)
+    for name in [beforeName, afterName] + [(terrainNames or {})[name] for name in extras if name in rasterFeatures]:
+        h.update(fingerprint(name, cacheDir).encode())
+    h.update(repr(featureNames(extras)).encode())
+    return os.path.join(cacheDir, 'features_{}.npy'.format(h.hexdigest()))
+
+
+
+## Build the feature matrix of an area
+# float32 keeps row/col exact up to 16.7M pixels a side and is what the sklearn trees use internally,
+# so 'X' and 'y' are passed to fit as views of this one array
+# > 'extras': terrain features to add, 'terrainNames': the maps of 'Slope'/'Aspect' ({'Slope': name, 'Aspect': name})
+# > 'cacheDir': keep the matrix there, and memory-map it on later calls with unchanged rasters
+def buildAreaFeatures(beforeName, afterName, memBudgetMB=256, memmapPath=None, extras=(), terrainNames=None, cacheDir=None):
+    featureNames(extras)
+
+    # 1 Use the cached matrix
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        cacheName = cachePath(cacheDir, beforeName, afterName, extras, terrainNames)
+        if os.path.exists(cacheName):
+            return np.load(cacheName, mmap_mode='r')
+        memmapPath = cacheName + '.tmp.npy'
+
+    with stage('features') as record:
+
+        # 2 Count the valid pixels first, so the output is allocated once at its final size and memory stays within the window budget
+        # (with the raster cache on, the second pass maps the decoded rasters again instead of decoding them)
+        nValid = 0
+        for window, before, after, extraTiles in featureWindows(beforeName, afterName, extras, terrainNames, memBudgetMB):
+            nValid += np.count_nonzero(validMask(before, after, *extraTiles))
+
+        # 3 Allocate in memory, or as a memory-mapped .npy file
+        shape = (int(nValid), len(featureNames(extras)))
+        if memmapPath is None:
+            Xy = np.empty(shape, dtype='float32')
+        else:
+            Xy = np.lib.format.open_memmap(memmapPath, mode='w+', dtype='float32', shape=shape)
+
+        # 4 Fill the matrix window by window (rows are in row-major pixel order)
+        pos = 0
+        for window, before, after, extraTiles in featureWindows(beforeName, afterName, extras, terrainNames, memBudgetMB):
+            n = np.count_nonzero(validMask(before, after, *extraTiles))
+            tileFeatures(before, after, extraTiles, window.row_off, window.col_off, out=Xy[pos:pos+n])
+            pos += n
+        record['Pixels'] = int(pos)
+
+    # 5 Move the finished matrix into the cache
+    if cacheDir is not None:
+        Xy.flush()
+        del Xy
+        os.replace(memmapPath, cacheName)
+        return np.load(cacheName, mmap_mode='r')
+    return Xy
+
+
+
+## Split the matrix into 'X' and 'y' views
+def splitXy(Xy):
+    return Xy[:, :-1], Xy[:, -1]
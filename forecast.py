@@ -0,0 +1,84 @@
+## About
+# This module predicts the post GLOF elevation of every valid pixel of a 'before' DEM with a trained area model,
+# and writes it (plus the error against an 'after' DEM, if one is given) as tiled, compressed GeoTIFFs
+# (models trained with terrain features need the same 'extras' and 'terrainNames' as in training)
+# predictTiles updates the prediction of a new survey epoch, recomputing only the tiles whose inputs changed (see change_index.py)
+
+
+
+## Libraries
+import numpy as np, rasterio as rio
+from contextlib import ExitStack
+from raster_io import outputProfile
+from features import featureWindows, tilePredictors, rasterFeatures, neighbourhoodFeatures
+from change_index import indexRaster, updateTiles
+from profiling import stage
+
+
+
+## Predict the valid pixels of one window (returns the predicted tile and the number of pixels predicted)
+def predictTile(regressor, tile, extraTiles, window, batchSize=1000000):
+
+    # 1 Get the features of the valid pixels of the window
+    idx, X = tilePredictors(tile, extraTiles, window.row_off, window.col_off)
+
+    # 2 Predict in batches, so memory stays bounded however many pixels the window has
+    predTile = np.full(tile.shape, np.nan, dtype='float32')
+    flat = predTile.ravel()
+    for pos in range(0, len(idx), batchSize):
+        flat[idx[pos:pos+batchSize]] = regressor.predict(X[pos:pos+batchSize])
+    return predTile, len(idx)
+
+
+
+## Predict a whole 'before' DEM window by window
+def predictRaster(regressor, beforeName, predName, afterName=None, errorName=None, memBudgetMB=256, batchSize=1000000, blockSize=256, extras=(), terrainNames=None):
+    with ExitStack() as stack:
+
+        # 1 Open the outputs (the inputs are opened and checked by featureWindows)
+        with rio.open(beforeName) as before:
+            profile = outputProfile(before, blockSize)
+        pred = stack.enter_context(rio.open(predName, 'w', **profile))
+        error = stack.enter_context(rio.open(errorName, 'w', **profile)) if (afterName and errorName) else None
+
+        with stage('predict_raster', pixels=0) as record:
+
+            # 2 Predict window by window (windows are aligned to the output tiles; ~6 more float32 values held per pixel)
+            for window, tile, afterTile, extraTiles in featureWindows(beforeName, afterName if error is not None else None, extras, terrainNames,
+                                                                      memBudgetMB, nHeld=6, blockHeight=blockSize):
+
+                # 2.1 Predict the valid pixels of the window
+                predTile, n = predictTile(regressor, tile, extraTiles, window, batchSize)
+                pred.write(predTile, 1, window=window)
+                record['Pixels'] += n
+
+                # 2.2 Error against the actual 'after' DEM
+                if error is not None:
+                    error.write(predTile - afterTile, 1, window=window)
+
+
+
+## Update the prediction of one epoch's 'before' DEM ('raster': name of the DEM in the index, e.g. 'Area_01_Before';
+# 'modelKey': identifies the regressor, so a new model recomputes every tile; returns the recomputed tiles)
+# (the terrain maps must be indexed for the epoch, as terrainTiles does)
+def predictTiles(db, epoch, regressor, modelKey, beforeName, raster, predName, previousName=None, extras=(), terrainNames=None,
+                 tileSize=256, batchSize=1000000, nWorkers=4):
+    with rio.open(beforeName) as before:
+        profile = outputProfile(before, tileSize)
+
+    # 1 Inputs: the DEM and the terrain maps the model reads
+    indexRaster(db, beforeName, epoch, raster, tileSize)
+    inputs = {raster: beforeName}
+    for name in extras:
+        if name in rasterFeatures:
+            inputs['{}_{}'.format(raster, name.lower())] = terrainNames[name]
+            indexRaster(db, terrainNames[name], epoch, '{}_{}'.format(raster, name.lower()), tileSize, maskNegative=False)
+
+    # 2 Predict the tiles whose inputs changed (neighbourhood features read a one pixel halo)
+    def compute(window):
+        for window, tile, _, extraTiles in featureWindows(beforeName, None, extras, terrainNames, windows=[window]):
+            return {'predicted': predictTile(regressor, tile, extraTiles, window, batchSize)[0]}
+    halo = 1 if any(name in neighbourhoodFeatures for name in extras) else 0
+    return updateTiles(db, epoch, inputs, {'predicted': predName}, compute, profile, {'predicted': previousName} if previousName else None,
+                       settings={'model': modelKey, 'extras': list(extras)}, halo=halo, tileSize=tileSize, nWorkers=nWorkers,
+                       rasters={'predicted': raster + '_predicted'})
@@ -0,0 +1,67 @@
+## About
+# This module checks that the rasters of every area share one grid, from the raster headers only
+# (no pixels are read), so that the stages can run it as a cheap precondition before any long computation
+
+
+
+## Libraries
+import pandas as pd, rasterio as rio
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+## Grid of a raster, from its header
+def gridInfo(name):
+    with rio.open(name) as src:
+        return {'Name': name, 'Width': src.width, 'Height': src.height, 'Transform': src.transform, 'CRS': src.crs, 'Nodata': src.nodata}
+
+
+
+## Get the grids of all rasters and check them against the first raster of their area
+# > 'groups' maps a role to the list of raster names of that role (e.g. {'Before': [...], 'After': [...]}), in area order
+# > 'tolerance' is the allowed offset of the origin and pixel size, as a fraction of a pixel
+def checkGrids(groups, tolerance=0.01, nWorkers=8):
+
+    # 1 Read all headers in one batch
+    roles = list(groups)
+    with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+        infos = {role: list(pool.map(gridInfo, groups[role])) for role in roles}
+
+    # 2 Compare every raster with the raster of the first role of its area
+    rows = []
+    nAreas = max(len(names) for names in groups.values())
+    for i in range(nAreas):
+        ref = infos[roles[0]][i] if i < len(infos[roles[0]]) else None
+        for role in roles:
+            if i >= len(infos[role]):
+                rows.append({'Area': i+1, 'Role': role, 'Aligned': False, 'Problem': 'missing raster'})
+                continue
+            info = infos[role][i]
+            rows.append({'Area': i+1, 'Role': role, **info, 'Aligned': True, 'Problem': ''})
+            problems = _compare(info, ref, tolerance) if ref else ['no {} raster to compare with'.format(roles[0])]
+            if problems:
+                rows[-1].update(Aligned=False, Problem='; '.join(problems))
+    return pd.DataFrame(rows)
+
+
+
+def _compare(info, ref, tolerance):
+    problems = []
+    if (info['Width'], info['Height']) != (ref['Width'], ref['Height']):
+        problems.append('size {}x{} != {}x{}'.format(info['Width'], info['Height'], ref['Width'], ref['Height']))
+    if info['CRS'] != ref['CRS']:
+        problems.append('crs differs')
+    pixel = max(abs(ref['Transform'].a), abs(ref['Transform'].e))
+    if any(abs(a - b) > tolerance * pixel for a, b in zip(info['Transform'][:6], ref['Transform'][:6])):
+        problems.append('transform differs')
+    return problems
+
+
+
+## Stop with an error listing every misaligned raster
+def assertAligned(report):
+    bad = report[~report['Aligned']]
+    if len(bad):
+        lines = ['Area {} {}: {}'.format(r['Area'], r['Role'], r['Problem']) for _, r in bad.iterrows()]
+        raise ValueError("Rasters are not aligned:\n" + "\n".join(lines))
+    return report
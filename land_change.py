@@ -0,0 +1,115 @@
+## About
+# This module runs the per-area land change pipeline of 03_Prediction_Land_Change.py
+# (load -> features -> split -> fit -> predict -> error file), one area per worker process
+
+
+
+## Libraries
+import pandas as pd, numpy as np, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import train_test_split
+from features import buildAreaFeatures, splitXy, rasterFeatures
+from sampling import stratifiedSample
+from regressors import makeRegressor
+from model_store import modelKey, modelPath, loadModel, saveModel, evictModels
+from error_store import errorPath, writeErrors
+from profiling import stage
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows: no address-space cap
+
+
+
+## Run one area
+# (with a 'modelDir' the fitted model is kept in the model store, and reused while the inputs, seed and hyperparameters are unchanged)
+# (with a 'sampleSize' the model is fitted on a spatially stratified sample of that many training pixels)
+# ('backend' names the regressor in regressors.backends, 'backendParams' override its hyperparameters)
+# ('extras' adds terrain features, from the maps in 'terrainNames'; with a 'featureDir' the feature matrix is cached there)
+def runArea(i, beforeName, afterName, outDir="../06_Excel_Files/", memBudgetMB=256, seed=0, modelDir=None, errorFormat='parquet', exportCsv=False,
+            sampleSize=None, backend='tree', backendParams=None, extras=(), terrainNames=None, featureDir=None):
+    start = time.time()
+
+    with stage('run_area', i+1) as record:
+
+        # 1 Prepare 'X' and 'y' from the valid pixels
+        Xy = buildAreaFeatures(beforeName, afterName, memBudgetMB=memBudgetMB, extras=extras, terrainNames=terrainNames, cacheDir=featureDir)
+        X, y = splitXy(Xy)
+        record['Pixels'] = len(Xy)
+
+        # 2 Train and run the model
+        # 2.1 Train model (seeded split, so that runs can be reproduced), or load it from the model store
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.30, random_state=seed)
+        regressor = makeRegressor(backend, **(backendParams or {}))
+        params = regressor.get_params() if not sampleSize else {**regressor.get_params(), 'sampleSize': sampleSize}
+        rasterNames = [beforeName, afterName]
+        if extras:
+            params = {**params, 'features': list(extras)}
+            rasterNames += [terrainNames[name] for name in extras if name in rasterFeatures]
+        key = modelKey(rasterNames, seed, params, modelDir) if modelDir is not None else None
+        cached = loadModel(modelDir, key) if key else None
+        fitStart = time.time()
+        if cached is not None:
+            regressor = cached
+        elif sampleSize:
+            idx = stratifiedSample(X_train, sampleSize, seed=seed)
+            with stage('fit', pixels=len(idx)):
+                regressor.fit(X_train[idx], y_train[idx])
+        else:
+            with stage('fit', pixels=len(X_train)):
+                regressor.fit(X_train, y_train)
+        fitSecs = time.time() - fitStart
+
+        # 2.2 Run model
+        predictStart = time.time()
+        with stage('predict', pixels=len(X_test)):
+            yPred = regressor.predict(X_test)
+        predictSecs = time.time() - predictStart
+
+        # 3 Save results (with the row, col of every test pixel)
+        errorName = writeErrors(errorPath(outDir, i, errorFormat), X_test[:, 0], X_test[:, 1], yPred, y_test)
+        if exportCsv:
+            writeErrors(errorPath(outDir, i, 'csv'), X_test[:, 0], X_test[:, 1], yPred, y_test)
+
+        # 4 Save the model for later runs and the full-raster prediction
+        modelName = None
+        if key and cached is None:
+            modelName = saveModel(modelDir, key, regressor)
+        elif key:
+            modelName = modelPath(modelDir, key)
+
+    diff = yPred - y_test
+    return {'Area': i+1, 'Backend': backend, 'Pixels': len(Xy), 'Fit_Secs': fitSecs, 'Predict_Pixels_per_Sec': len(X_test) / max(predictSecs, 1e-9),
+            'Model_MB': os.path.getsize(modelName) / 2**20 if modelName else None, 'MAE': np.abs(diff).mean(), 'RMSE': np.sqrt((diff**2).mean()),
+            'Total_Secs': time.time()-start, 'Cached': cached is not None, 'Error_File': errorName, 'Model_File': modelName}
+
+
+
+## Cap the address space of a worker process, so one runaway area fails alone (MemoryError) instead of swapping the machine
+# (Linux only, ignored elsewhere; this is virtual memory, not resident memory: it also counts the memory-mapped raster cache,
+#  feature matrices and models, and the address space numpy/sklearn reserve, so the cap must be several times the memory
+#  an area really needs - a few GB at least, never a few hundred MB)
+def _limitWorker(memCapMB):
+    if memCapMB and resource is not None and sys.platform.startswith('linux'):
+        cap = int(memCapMB * 2**20)
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+
+
+## Run all areas in a process pool
+# (settings other than the pool's are passed on to runArea; 'terrainNames' is a list with the maps of every area;
+#  'maxStoreMB': evict the least recently used models beyond this size once every area is done, never those of this run)
+def runAreas(beforeNames, afterNames, nWorkers=None, memCapMB=None, terrainNames=None, maxStoreMB=None, **kwargs):
+
+    # 1 Submit the largest areas first, so the study takes about as long as its largest area
+    order = sorted(range(len(beforeNames)), key=lambda i: os.path.getsize(beforeNames[i]), reverse=True)
+
+    # 2 Run the areas (each worker reads, fits and writes one area on its own)
+    with ProcessPoolExecutor(max_workers=nWorkers, initializer=_limitWorker, initargs=(memCapMB,)) as pool:
+        futures = [pool.submit(runArea, i, beforeNames[i], afterNames[i], terrainNames=terrainNames[i] if terrainNames else None, **kwargs) for i in order]
+        results = [future.result() for future in futures]
+    if maxStoreMB is not None and kwargs.get('modelDir'):
+        evictModels(kwargs['modelDir'], maxStoreMB, keep=[result['Model_File'] for result in results])
+
+    # 3 Merge the results in area order, whatever order they finished in
+    return pd.DataFrame(results).sort_values('Area').reset_index(drop=True)
@@ -0,0 +1,106 @@
+## About
+# This module keeps fitted models in an on-disk store, keyed by a hash of the input raster contents,
+# the split seed and the model hyperparameters, so that unchanged areas are never refitted
+
+
+
+## Libraries
+import os, json, hashlib, joblib, tempfile
+
+
+
+## Hash of a file's contents
+# (remembered in 'fingerprints.json' by path, size and mtime, so unchanged rasters are hashed only once)
+def fingerprint(name, storeDir=None, chunkMB=16):
+
+    # 1 Look the file up in the fingerprint index
+    stat = os.stat(name)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    indexName = os.path.join(storeDir, 'fingerprints.json') if storeDir else None
+    index = {}
+    if indexName and os.path.exists(indexName):
+        with open(indexName) as f:
+            index = json.load(f)
+    entry = index.get(os.path.abspath(name))
+    if entry and entry['stamp'] == stamp:
+        return entry['hash']
+
+    # 2 Hash the contents chunk by chunk
+    h = hashlib.blake2b(digest_size=16)
+    with open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkMB * 2**20), b''):
+            h.update(chunk)
+
+    # 3 Remember it (written to a temp file first, so parallel workers never see a half-written index)
+    if indexName:
+        index[os.path.abspath(name)] = {'stamp': stamp, 'hash': h.hexdigest()}
+        _writeAtomic(indexName, lambda f: f.write(json.dumps(index, indent=1).encode()))
+    return h.hexdigest()
+
+
+
+## Key of a model: input raster contents + split seed + hyperparameters
+def modelKey(rasterNames, seed, params, storeDir=None):
+    h = hashlib.blake2b(digest_size=16)
+    for name in rasterNames:
+        h.update(fingerprint(name, storeDir).encode())
+    h.update(json.dumps({'seed': seed, 'params': params}, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+
+## Path of a model in the store
+def modelPath(storeDir, key):
+    return os.path.join(storeDir, key + '.joblib')
+
+
+
+## Load a model from the store (None if it is not there)
+def loadModel(storeDir, key):
+    name = modelPath(storeDir, key)
+    try:
+        model = joblib.load(name, mmap_mode='r')  # node arrays are memory-mapped, not read
+    except FileNotFoundError:
+        return None
+    os.utime(name)  # mark as recently used for the eviction
+    return model
+
+
+
+## Save a model into the store and evict the least recently used models over 'maxSizeMB'
+def saveModel(storeDir, key, model, maxSizeMB=None):
+    name = modelPath(storeDir, key)
+    _writeAtomic(name, lambda f: joblib.dump(model, f))
+    if maxSizeMB is not None:
+        evictModels(storeDir, maxSizeMB, keep=[name])
+    return name
+
+
+
+## Remove the least recently used models until the store fits into 'maxSizeMB' ('keep': models never removed, e.g. those of the current run)
+def evictModels(storeDir, maxSizeMB, keep=()):
+    keep = {os.path.abspath(name) for name in keep if name}
+
+    # 1 Get the models, least recently used first
+    names = [os.path.join(storeDir, f) for f in os.listdir(storeDir) if f.endswith('.joblib')]
+    names.sort(key=os.path.getmtime)
+
+    # 2 Remove them until the store is small enough (never the models to keep)
+    total = sum(os.path.getsize(name) for name in names)
+    for name in names:
+        if total <= maxSizeMB * 2**20:
+            break
+        if os.path.abspath(name) not in keep:
+            total -= os.path.getsize(name)
+            os.remove(name)
+
+
+
+## Write a file through a temp file in the same directory, then move it in place
+def _writeAtomic(name, write):
+    dirName = os.path.dirname(os.path.abspath(name))
+    os.makedirs(dirName, exist_ok=True)
+    fd, tmpName = tempfile.mkstemp(dir=dirName, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.replace(tmpName, name)
@@ -0,0 +1,153 @@
+## About
+# This module updates the maps of a new survey epoch (a new set of pre-flood DEMs of the same areas) from the command line,
+# recomputing only the tiles whose inputs changed since the previous epoch:
+# > resample -> slope/aspect -> prediction with the area models trained by pipeline.py -> statistics, per area
+# > the DEMs of an epoch are read from <root>/02_Data/04_Epochs/<epoch>/, named like the clipped areas ('01_Area_Before.tif', ...)
+# > the maps of an epoch go to .../02_Rasters/05_Epochs/<epoch>/, starting as copies of the previous epoch's
+# > the tile index (checksums and statistics of every tile of every raster of every epoch) is <root>/10_Pipeline/change_index.sqlite,
+#   queryable with change_index.tileStats / changedTiles / epochSummary
+#
+# > the terrain features of every model ('extras') are read from the train manifest pipeline.py wrote for it
+#
+# Usage: python monitor.py --root .. --epoch 2025_07 [--previous 2024_07]
+
+
+
+## Libraries
+import pandas as pd, os, sys, glob, json, time, argparse
+from concurrent.futures import ProcessPoolExecutor
+from pipeline import studyDirs
+from model_store import fingerprint
+import profiling, raster_cache
+
+
+
+## Folders of an epoch
+def epochDirs(root, epoch):
+    dirs = studyDirs(root)
+    return {'dems': os.path.join(root, '02_Data', '04_Epochs', epoch),
+            'maps': os.path.join(os.path.dirname(dirs['clusters']), '05_Epochs', epoch),
+            'index': os.path.join(dirs['state'], 'change_index.sqlite')}
+
+
+
+## Maps of one area in an epoch
+def areaMaps(mapDir, area):
+    return {name: os.path.join(mapDir, 'Area_{}_{}.tif'.format(area, name)) for name in ['Before_Resampled', 'slope', 'aspect', 'Predicted_After']}
+
+
+
+## Update the maps of one area (returns how many tiles every stage recomputed)
+def updateArea(area, demName, refName, modelName, epoch, mapDir, previousDir, dbName, extras=(), skipResample=False, tileSize=256, nWorkers=4):
+    import joblib
+    from change_index import openIndex
+    from terrain import terrainTiles
+    from forecast import predictTiles
+    db = openIndex(dbName)
+    maps = areaMaps(mapDir, area)
+    previous = areaMaps(previousDir, area) if previousDir else {}
+    raster = 'Area_{}_Before'.format(area)
+    tiles = {'Area': int(area)}
+
+    # 1 Resampled DEM (taken as it is when it is already on the grid of the 'after' DEM)
+    with profiling.stage('epoch_area', int(area)):
+        if skipResample:
+            dem, demRaster = demName, raster
+        else:
+            from resample import resampleTiles  # gdal is only needed when resampling
+            tiles['Resampled'] = len(resampleTiles(db, epoch, demName, refName, maps['Before_Resampled'], raster, previous.get('Before_Resampled'),
+                                                   tileSize, nWorkers=nWorkers))
+            dem, demRaster = maps['Before_Resampled'], raster + '_Resampled'
+
+        # 2 Slope and aspect
+        outNames = {'slope': maps['slope'], 'aspect': maps['aspect']}
+        previousNames = {'slope': previous['slope'], 'aspect': previous['aspect']} if previous else None
+        tiles['Terrain'] = len(terrainTiles(db, epoch, dem, demRaster, outNames, previousNames, tileSize, nWorkers))
+
+        # 3 Prediction with the area model
+        terrainNames = {'Slope': maps['slope'], 'Aspect': maps['aspect']}
+        tiles['Predicted'] = len(predictTiles(db, epoch, joblib.load(modelName, mmap_mode='r'), fingerprint(modelName, os.path.dirname(modelName)), dem,
+                                              demRaster, maps['Predicted_After'], previous.get('Predicted_After'), extras, terrainNames, tileSize, nWorkers=nWorkers))
+    db.close()
+    return tiles
+
+
+
+## Areas of an epoch: its DEMs, the 'after' DEMs whose grid they are resampled to, and the models pipeline.py trained
+# (with the terrain features they were trained with)
+def findEpochAreas(root, epoch):
+    dirs = studyDirs(root)
+    areas = []
+    for demName in sorted(glob.glob(os.path.join(epochDirs(root, epoch)['dems'], '*Before.tif'))):
+        area = os.path.basename(demName).split('_')[0]
+        refNames = glob.glob(os.path.join(dirs['clipped'], '{}_*After.tif'.format(area)))
+        manifestName = os.path.join(dirs['state'], 'train_{}.json'.format(area))
+        if not refNames or not os.path.exists(manifestName):
+            raise ValueError("Area {} of epoch {} has no 'after' DEM in {} or no model trained by pipeline.py".format(area, epoch, dirs['clipped']))
+        with open(manifestName) as f:
+            manifest = json.load(f)
+        areas.append({'area': area, 'dem': demName, 'ref': refNames[0], 'model': manifest['outputs']['model'], 'extras': manifest['settings']['extras']})
+    return areas
+
+
+
+## Epoch before 'epoch' with maps (None for the first)
+def previousEpoch(root, epoch):
+    epochsDir = os.path.dirname(epochDirs(root, epoch)['maps'])
+    epochs = sorted(name for name in os.listdir(epochsDir) if name < epoch) if os.path.isdir(epochsDir) else []
+    return epochs[-1] if epochs else None
+
+
+
+## Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update the maps of a new survey epoch, recomputing only the tiles whose inputs changed")
+    parser.add_argument('--root', default='..', help="study root (the folder holding 02_Data)")
+    parser.add_argument('--epoch', required=True, help="epoch folder in <root>/02_Data/04_Epochs")
+    parser.add_argument('--previous', default=None, help="epoch to start from (default: the latest earlier one with maps)")
+    parser.add_argument('--skip-resample', action='store_true', help="the DEMs of the epoch are already on the grid of the 'after' DEMs")
+    parser.add_argument('--tile-size', type=int, default=256, help="pixels a side of the tiles that are compared and recomputed")
+    parser.add_argument('--workers', type=int, default=None, help="areas updated at a time (default: one per core)")
+    parser.add_argument('--threads', type=int, default=4, help="tiles computed at a time in every area")
+    parser.add_argument('--raster-cache', type=float, default=None, metavar='MB', help="as in pipeline.py")
+    parser.add_argument('--profile', default=None, help="folder of the run report")
+    args = parser.parse_args(argv)
+
+    # 1 Areas of the epoch, and the epoch they start from
+    dirs = epochDirs(args.root, args.epoch)
+    areas = findEpochAreas(args.root, args.epoch)
+    if not areas:
+        sys.exit("No '*Before.tif' rasters in {}".format(dirs['dems']))
+    previous = args.previous or previousEpoch(args.root, args.epoch)
+    previousDir = epochDirs(args.root, previous)['maps'] if previous else None
+    os.makedirs(dirs['maps'], exist_ok=True)
+
+    # 2 Update them
+    start = time.time()
+    if args.profile:
+        profiling.enable(args.profile)
+    if args.raster_cache:
+        raster_cache.enable(studyDirs(args.root)['rasterCache'], args.raster_cache)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(updateArea, a['area'], a['dem'], a['ref'], a['model'], args.epoch, dirs['maps'], previousDir, dirs['index'], a['extras'],
+                               args.skip_resample, args.tile_size, args.threads) for a in areas]
+        report = pd.DataFrame([future.result() for future in futures])
+    print("Epoch {} (from {}), tiles recomputed:".format(args.epoch, previous or 'scratch'))
+    print(report.to_string(index=False))
+    print("Time elapsed: {:.1f} s".format(time.time() - start))
+
+    # 3 Statistics of every raster in every epoch, from the tile index
+    from change_index import openIndex, epochSummary
+    db = openIndex(dirs['index'])
+    summary = epochSummary(db)
+    db.close()
+    summary.to_csv(os.path.join(studyDirs(args.root)['errors'], 'Epoch_Table.csv'), index=False)
+    print(summary.to_string(index=False))
+    if args.profile:
+        print(profiling.runReport(args.profile).to_string(index=False))
+    return report
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+## About
+# This module filters outliers out of the error data of an area, for every script that needs it:
+# > 'zscore': |x - mean| / std < threshold (as scipy's zscore, ddof=0)
+# > 'quantile': qLow < x < qHigh
+# > 'mad': |x - median| / (1.4826 * MAD) < threshold
+# The bounds are computed once per area and the kept pixels are saved as a bit-packed mask next to the error file,
+# so later readers load the mask instead of recomputing the statistics, and get filtered views instead of copies
+
+
+
+## Libraries
+import numpy as np, os, json
+from error_store import readErrorColumns, errorFormat
+from model_store import fingerprint
+
+
+
+methods = ['zscore', 'quantile', 'mad']
+
+
+
+## Open (low, high) bounds of every column
+def computeBounds(values, method='zscore', threshold=3.0, quantiles=(0.01, 0.99)):
+    bounds = {}
+    for name, column in values.items():
+        column = np.asarray(column, dtype='float64')
+        if method == 'zscore':
+            center, spread = column.mean(), column.std()
+        elif method == 'mad':
+            center = np.median(column)
+            spread = 1.4826 * np.median(np.abs(column - center))
+        elif method == 'quantile':
+            bounds[name] = tuple(float(q) for q in np.quantile(column, quantiles))
+            continue
+        else:
+            raise ValueError("Unknown outlier method '{}', expected one of {}".format(method, methods))
+        bounds[name] = (float(center - threshold*spread), float(center + threshold*spread))
+    return bounds
+
+
+
+## Pixels that are within the bounds in every column
+def buildMask(values, bounds):
+    mask = np.ones(len(next(iter(values.values()))), dtype=bool)
+    for name, (low, high) in bounds.items():
+        column = values[name]
+        mask &= (column > low) & (column < high)
+    return mask
+
+
+
+## Mask file of an error file
+def maskPath(errorName, method):
+    return errorName.rstrip('/\\') + '.{}_mask.npz'.format(method)
+
+
+
+## Contents hash of the error data a mask is computed from ('npy' errors: the files of the columns read, as their folder's
+# size and mtime do not change when the columns are written again; hashes are remembered in the errors folder)
+def errorFingerprint(errorName, columns=('diff',)):
+    storeDir = os.path.dirname(os.path.abspath(errorName.rstrip('/\\')))
+    if errorFormat(errorName) == 'npy':
+        return ''.join(fingerprint(os.path.join(errorName, c + '.npy'), storeDir) for c in columns)
+    return fingerprint(errorName, storeDir)
+
+
+
+## Mask of the kept pixels of an area, computed once and then read from the mask file
+# (recomputed when the contents of the error columns or the settings change)
+def loadMask(errorName, method='zscore', columns=('diff',), threshold=3.0, quantiles=(0.01, 0.99)):
+
+    # 1 Settings and error data the mask must match
+    key = json.dumps({'error': errorFingerprint(errorName, columns), 'method': method, 'columns': list(columns),
+                      'threshold': threshold, 'quantiles': list(quantiles)}, sort_keys=True)
+
+    # 2 Read the saved mask
+    name = maskPath(errorName, method)
+    if os.path.exists(name):
+        with np.load(name) as saved:
+            if str(saved['key']) == key:
+                return np.unpackbits(saved['bits'], count=int(saved['count'])).astype(bool)
+
+    # 3 Compute and save it (8 pixels per byte)
+    values = readErrorColumns(errorName, list(columns))
+    bounds = computeBounds(values, method, threshold, quantiles)
+    mask = buildMask(values, bounds)
+    np.savez(name, bits=np.packbits(mask), count=len(mask), key=key, bounds=json.dumps(bounds))
+    return mask
+
+
+
+## Filtered view of a column: a masked array over the same data, outliers hidden (no copy)
+def maskedView(column, mask):
+    return np.ma.MaskedArray(column, mask=~mask, copy=False)
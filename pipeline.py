@@ -0,0 +1,388 @@
+## About
+# This module runs the whole study from the command line, instead of the five scripts by hand:
+# > resample -> terrain -> features -> train -> predict -> stats -> plots, as a graph of (stage, area) tasks,
+#   each task run as soon as the tasks it needs are done, independent areas at the same time
+# > every task is keyed by the contents of its input files, its parameters and the code of the modules it runs;
+#   a task whose key is unchanged since its last run and whose outputs still exist is skipped
+# > all paths are built from one study root with os.path, so the runner works the same on posix and Windows
+#
+# Usage: python pipeline.py --root .. [--workers 4] [--backend tree] [--extras Slope Aspect] [--force plots]
+
+
+
+## Libraries
+import pandas as pd, numpy as np, os, sys, json, glob, time, hashlib, argparse, importlib.util
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from model_store import fingerprint, evictModels, _writeAtomic
+import profiling, raster_cache
+
+
+
+## Stages in run order, and the repo modules whose code every stage depends on
+stages = {
+    'resample': ['resample'],
+    'terrain': ['terrain', 'raster_io', 'raster_cache'],
+    'features': ['features', 'grid_check', 'compact_raster', 'raster_io', 'raster_cache'],
+    'train': ['land_change', 'features', 'compact_raster', 'regressors', 'sampling', 'model_store', 'error_store', 'raster_io', 'raster_cache'],
+    'predict': ['forecast', 'features', 'compact_raster', 'raster_io', 'raster_cache'],
+    'stats': ['stream_stats', 'slope_clusters', 'compact_raster', 'error_store', 'raster_io', 'raster_cache'],
+    'plots': ['plotting', 'outliers', 'error_store'],
+    'table': [],
+}
+
+
+
+## Output of another task, used as a parameter ('task' is its id, 'name' one of the outputs it returned)
+Output = namedtuple('Output', 'task name')
+
+
+
+## Folders of the study, from its root
+def studyDirs(root):
+    rasters = os.path.join(root, '02_Data', '03_Processed_Data', '02_Rasters')
+    return {
+        'clipped': os.path.join(rasters, '01_Clipped_Areas'),
+        'slope': os.path.join(rasters, '02_Slope_And_Aspect_Maps', '01_Slope_Maps'),
+        'aspect': os.path.join(rasters, '02_Slope_And_Aspect_Maps', '02_Aspect_Maps'),
+        'predicted': os.path.join(rasters, '03_Predicted_Maps'),
+        'clusters': os.path.join(rasters, '04_Slope_Change_Clusters'),
+        'images': os.path.join(root, '05_Images', '01_Land_Elevation_Changes'),
+        'errors': os.path.join(root, '06_Excel_Files'),
+        'models': os.path.join(root, '07_Models'),
+        'features': os.path.join(root, '09_Features'),
+        'state': os.path.join(root, '10_Pipeline'),
+        'rasterCache': os.path.join(root, '12_Raster_Cache'),
+    }
+
+
+
+## Stage functions (module level, so the worker processes can run them); each returns its outputs by name
+def _resample(src, ref, out, warpMemoryMB):
+    from resample import resampleRaster  # gdal is only needed when this stage runs
+    resampleRaster(src, ref, out, warpMemoryMB=warpMemoryMB, force=True)
+    return {'resampled': out}
+
+
+def _terrain(dems, outDirs, memBudgetMB):
+    from terrain import terrainAttributes
+    outputs = {}
+    for role, demName in dems.items():
+        baseName = os.path.splitext(os.path.basename(demName))[0]
+        outNames = {name: os.path.join(outDirs[name], '{}_{}.tif'.format(baseName, name)) for name in outDirs}
+        for outDir in outDirs.values():
+            os.makedirs(outDir, exist_ok=True)
+        terrainAttributes(demName, outNames, memBudgetMB=memBudgetMB)
+        outputs.update({'{}_{}'.format(name, role): outNames[name] for name in outNames})
+    return outputs
+
+
+def _features(before, after, terrainNames, extras, cacheDir, memBudgetMB):
+    from features import buildAreaFeatures, cachePath
+    from grid_check import checkGrids, assertAligned
+    assertAligned(checkGrids({'After': [after], 'Before': [before], **{name: [fileName] for name, fileName in (terrainNames or {}).items()}}))
+    buildAreaFeatures(before, after, memBudgetMB=memBudgetMB, extras=extras, terrainNames=terrainNames, cacheDir=cacheDir)
+    return {'features': cachePath(cacheDir, before, after, extras, terrainNames)}
+
+
+def _train(i, before, after, terrainNames, features, stateDir, **settings):
+    from land_change import runArea
+    os.makedirs(settings['outDir'], exist_ok=True)
+    result = runArea(i, before, after, terrainNames=terrainNames, **settings)
+    summaryName = os.path.join(stateDir, 'Area_{}_train.json'.format(str(i+1).zfill(2)))
+    with open(summaryName, 'w') as f:
+        json.dump(result, f, default=float)
+    return {'errors': result['Error_File'], 'model': result['Model_File'], 'summary': summaryName}
+
+
+def _predict(model, before, after, terrainNames, extras, outDir, area, memBudgetMB):
+    import joblib
+    from forecast import predictRaster
+    os.makedirs(outDir, exist_ok=True)
+    predName = os.path.join(outDir, 'Area_{}_Predicted_After.tif'.format(area))
+    errorName = os.path.join(outDir, 'Area_{}_Predicted_Error.tif'.format(area))
+    predictRaster(joblib.load(model, mmap_mode='r'), before, predName, after, errorName, memBudgetMB=memBudgetMB, extras=extras, terrainNames=terrainNames)
+    return {'predicted': predName, 'error': errorName}
+
+
+def _stats(i, before, after, errors, slopeBefore, slopeAfter, clusterDir, tableDir, nClusters, memBudgetMB):
+    from compact_raster import landPixels
+    from error_store import iterErrorChunks
+    from stream_stats import streamStats
+    from slope_clusters import clusterArea
+    area = str(i+1).zfill(2)
+
+    # 1 Land percentages and error statistics of the area (the row of 05's error table)
+    landBefore, size = landPixels(before, memBudgetMB)
+    landAfter, _ = landPixels(after, memBudgetMB)
+    errorStats = streamStats(iterErrorChunks(errors, 'diff'), relativeAccuracy=0.001, transform=np.abs).describe()
+    table = pd.DataFrame([{'Area': i+1, 'Land_Per_Before': landBefore/size*100, 'Land_Per_After': landAfter/size*100, **errorStats}])
+    tableName = os.path.join(tableDir, 'Area_{}_Error_Table.csv'.format(area))
+    table.to_csv(tableName, index=False)
+
+    # 2 Slope change clusters and their errors
+    clusterName = os.path.join(tableDir, 'Area_{}_Slope_Clusters.csv'.format(area))
+    clusterArea(i, slopeBefore, slopeAfter, errors, clusterDir, nClusters=nClusters, memBudgetMB=memBudgetMB).to_csv(clusterName, index=False)
+    return {'table': tableName, 'clusters': clusterName}
+
+
+def _plots(i, errors, outDir):
+    from plotting import renderArea, panels
+    os.makedirs(outDir, exist_ok=True)
+    renderArea(i, errors, outDir, force=True)
+    return {name: os.path.join(outDir, 'Area_{}_{}.png'.format(str(i+1).zfill(2), name)) for name in panels}
+
+
+def _table(tables, clusters, outDir):
+    tableName, clusterName = os.path.join(outDir, 'Error_Table.csv'), os.path.join(outDir, 'Slope_Clusters.csv')
+    pd.concat([pd.read_csv(name) for name in tables], ignore_index=True).to_csv(tableName, index=False)
+    pd.concat([pd.read_csv(name) for name in clusters], ignore_index=True).to_csv(clusterName, index=False)
+    return {'table': tableName, 'clusters': clusterName}
+
+
+
+## Run one task, recorded as 'task_<stage>' (the stages inside it get its area; 0 = the whole study)
+def _runTask(run, stageName, area, params):
+    with profiling.stage('task_' + stageName, int(area) if area.isdigit() else 0):
+        return run(**params)
+
+
+
+## Run one task in a new process of its own (fresh workers before Python 3.11, whose pools cannot retire a worker after each task)
+def _runFresh(run, stageName, area, params):
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(_runTask, run, stageName, area, params).result()
+
+
+
+## Input rasters of the areas: 'before', 'after' and the resampled 'before' the other stages read
+# ('skipResample': the 'before' rasters are the existing '*Before_Resampled.tif' ones)
+def findAreas(dirs, skipResample=False):
+    beforeNames = sorted(glob.glob(os.path.join(dirs['clipped'], '*Before_Resampled.tif' if skipResample else '*Before.tif')))
+    afterNames = sorted(glob.glob(os.path.join(dirs['clipped'], '*After.tif')))
+    if len(beforeNames) != len(afterNames):
+        raise ValueError("{} 'before' and {} 'after' rasters in {}".format(len(beforeNames), len(afterNames), dirs['clipped']))
+    if skipResample:
+        return [{'before': b, 'after': a, 'resampled': b} for b, a in zip(beforeNames, afterNames)]
+    return [{'before': b, 'after': a, 'resampled': os.path.splitext(b)[0] + '_Resampled.tif'} for b, a in zip(beforeNames, afterNames)]
+
+
+
+## Tasks of the study: id -> stage, run function, parameters (files among them named in 'files') and the tasks it needs
+def buildTasks(areas, dirs, settings):
+    tasks = {}
+
+    def add(stage, area, run, params, files):
+        deps = sorted({value.task for value in _refs(params)})
+        tasks['{}:{}'.format(stage, area)] = {'stage': stage, 'run': run, 'params': params, 'files': files, 'deps': deps}
+
+    extras, memBudgetMB = list(settings['extras']), settings['memBudgetMB']
+    for i, names in enumerate(areas):
+        area = str(i+1).zfill(2)
+
+        # 1 Resampled 'before' (taken as it is when resampling is skipped)
+        if settings['skipResample']:
+            resampled = names['resampled']
+        else:
+            add('resample', area, _resample, {'src': names['before'], 'ref': names['after'], 'out': names['resampled'], 'warpMemoryMB': settings['warpMemoryMB']},
+                ['src', 'ref'])
+            resampled = Output('resample:' + area, 'resampled')
+
+        # 2 Slope and aspect of the 'before' and 'after' DEMs
+        add('terrain', area, _terrain, {'dems': {'Before': resampled, 'After': names['after']}, 'outDirs': {'slope': dirs['slope'], 'aspect': dirs['aspect']},
+                                        'memBudgetMB': memBudgetMB}, ['dems'])
+        terrainNames = {'Slope': Output('terrain:' + area, 'slope_Before'), 'Aspect': Output('terrain:' + area, 'aspect_Before')}
+
+        # 3 Features, model and errors
+        add('features', area, _features, {'before': resampled, 'after': names['after'], 'terrainNames': terrainNames if extras else None, 'extras': extras,
+                                          'cacheDir': dirs['features'], 'memBudgetMB': memBudgetMB}, ['before', 'after', 'terrainNames'])
+        add('train', area, _train, {'i': i, 'before': resampled, 'after': names['after'], 'terrainNames': terrainNames if extras else None,
+                                    'features': Output('features:' + area, 'features'), 'stateDir': dirs['state'], 'outDir': dirs['errors'],
+                                    'memBudgetMB': memBudgetMB, 'modelDir': dirs['models'], 'errorFormat': settings['errorFormat'],
+                                    'sampleSize': settings['sampleSize'], 'backend': settings['backend'], 'extras': extras, 'featureDir': dirs['features']},
+            ['before', 'after', 'terrainNames', 'features'])
+
+        # 4 Full-raster prediction, statistics and figures
+        add('predict', area, _predict, {'model': Output('train:' + area, 'model'), 'before': resampled, 'after': names['after'],
+                                        'terrainNames': terrainNames if extras else None, 'extras': extras, 'outDir': dirs['predicted'], 'area': area,
+                                        'memBudgetMB': memBudgetMB}, ['model', 'before', 'after', 'terrainNames'])
+        add('stats', area, _stats, {'i': i, 'before': resampled, 'after': names['after'], 'errors': Output('train:' + area, 'errors'),
+                                    'slopeBefore': terrainNames['Slope'], 'slopeAfter': Output('terrain:' + area, 'slope_After'), 'clusterDir': dirs['clusters'],
+                                    'tableDir': dirs['errors'], 'nClusters': settings['nClusters'], 'memBudgetMB': memBudgetMB},
+            ['before', 'after', 'errors', 'slopeBefore', 'slopeAfter'])
+        add('plots', area, _plots, {'i': i, 'errors': Output('train:' + area, 'errors'), 'outDir': dirs['images']}, ['errors'])
+
+    # 5 Tables of the whole study
+    add('table', 'all', _table, {'tables': [Output('stats:' + str(i+1).zfill(2), 'table') for i in range(len(areas))],
+                                 'clusters': [Output('stats:' + str(i+1).zfill(2), 'clusters') for i in range(len(areas))], 'outDir': dirs['errors']},
+        ['tables', 'clusters'])
+    return tasks
+
+
+
+## Outputs of other tasks among the parameters (also inside lists and dicts)
+def _refs(value):
+    if isinstance(value, Output):
+        return [value]
+    if isinstance(value, dict):
+        return [ref for v in value.values() for ref in _refs(v)]
+    if isinstance(value, (list, tuple)):
+        return [ref for v in value for ref in _refs(v)]
+    return []
+
+
+
+## Replace the outputs of other tasks among the parameters with their files
+def _resolve(value, outputs):
+    if isinstance(value, Output):
+        return outputs[value.task][value.name]
+    if isinstance(value, dict):
+        return {k: _resolve(v, outputs) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_resolve(v, outputs) for v in value]
+    return value
+
+
+
+## Files of a parameter value (a file name, or lists/dicts of them; None for none)
+def _files(value):
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [name for v in value.values() for name in _files(v)]
+    if isinstance(value, (list, tuple)):
+        return [name for v in value for name in _files(v)]
+    return [value]
+
+
+
+## Fingerprint of a file, or of the files of a folder ('npy' error files are folders)
+def _fingerprint(name, stateDir):
+    if os.path.isdir(name):
+        return ''.join(fingerprint(os.path.join(name, f), stateDir) for f in sorted(os.listdir(name)))
+    return fingerprint(name, stateDir)
+
+
+
+## Key of a task: contents of its input files + its other parameters + the code of its stage
+def taskKey(task, params, stateDir):
+    h = hashlib.blake2b(digest_size=16)
+    for name in task['files']:
+        for fileName in _files(params[name]):
+            h.update(_fingerprint(fileName, stateDir).encode())
+    for module in stages[task['stage']]:
+        h.update(fingerprint(importlib.util.find_spec(module).origin, stateDir).encode())
+    others = {name: value for name, value in params.items() if name not in task['files']}
+    h.update(json.dumps(others, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+
+## Run the tasks, skipping the up-to-date ones ('force': stages to re-run whatever their key,
+# 'freshWorkers': run every task in a new worker process, so its memory figures are its own)
+# > the manifest of every task holds its key, its outputs and its settings (the parameters that are not files, e.g. the
+#   'extras' a model was trained with, which monitor.py and service.py read back)
+def runPipeline(tasks, stateDir, nWorkers=None, force=(), log=print, freshWorkers=False):
+    os.makedirs(stateDir, exist_ok=True)
+    outputs, report, running = {}, [], {}
+    waiting = dict(tasks)
+    retire = {'max_tasks_per_child': 1} if freshWorkers and sys.version_info >= (3, 11) else {}
+    runTask = _runFresh if freshWorkers and not retire else _runTask
+    with ProcessPoolExecutor(max_workers=nWorkers, **retire) as pool:
+        while waiting or running:
+
+            # 1 Start (or skip) every task whose dependencies are done (skipped tasks may make more tasks ready at once)
+            ready = True
+            while ready:
+                ready = [t for t, task in waiting.items() if all(dep in outputs for dep in task['deps'])]
+                for taskId in ready:
+                    task = waiting.pop(taskId)
+                    params = _resolve(task['params'], outputs)
+                    key = taskKey(task, params, stateDir)
+                    settings = json.loads(json.dumps({name: value for name, value in params.items() if name not in task['files']}, default=str))
+                    manifestName = os.path.join(stateDir, taskId.replace(':', '_') + '.json')
+                    if task['stage'] not in force and os.path.exists(manifestName):
+                        with open(manifestName) as f:
+                            manifest = json.load(f)
+                        if manifest['key'] == key and all(os.path.exists(name) for name in _files(manifest['outputs'])):
+                            outputs[taskId] = manifest['outputs']
+                            report.append({'Task': taskId, 'Stage': task['stage'], 'Skipped': True, 'Secs': 0.0})
+                            continue
+                    running[pool.submit(runTask, task['run'], task['stage'], taskId.split(':')[1], params)] = (taskId, task, key, settings, manifestName,
+                                                                                                                 time.time())
+            if not running:
+                if waiting:
+                    raise ValueError("Tasks {} need tasks that do not exist".format(sorted(waiting)))
+                break
+
+            # 2 Record the tasks that finish, so their dependents can start
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                taskId, task, key, settings, manifestName, started = running.pop(future)
+                outputs[taskId] = future.result()
+                manifest = {'key': key, 'outputs': outputs[taskId], 'settings': settings, 'secs': time.time()-started}
+                _writeAtomic(manifestName, lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+                report.append({'Task': taskId, 'Stage': task['stage'], 'Skipped': False, 'Secs': manifest['secs']})
+                log("{:<12} {:8.1f} s".format(taskId, manifest['secs']))
+    return pd.DataFrame(report)
+
+
+
+## Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the GLOF prediction study, re-running only the stages whose inputs, settings or code changed")
+    parser.add_argument('--root', default='..', help="study root (the folder holding 02_Data)")
+    parser.add_argument('--workers', type=int, default=None, help="tasks run at a time (default: one per core)")
+    parser.add_argument('--mem-budget', type=float, default=256, help="MB of raster windows read at a time by each task")
+    parser.add_argument('--warp-memory', type=float, default=512, help="gdal warp memory (MB) of each resampling")
+    parser.add_argument('--skip-resample', action='store_true', help="use the existing *_Resampled.tif rasters")
+    parser.add_argument('--backend', default='tree', help="regressor backend (see regressors.py)")
+    parser.add_argument('--sample-size', type=int, default=None, help="train on a stratified sample of this many pixels")
+    parser.add_argument('--extras', nargs='*', default=[], help="terrain features: Slope Aspect Relief Roughness")
+    parser.add_argument('--error-format', default='parquet', choices=['parquet', 'npy', 'csv'])
+    parser.add_argument('--max-store', type=float, default=20000, help="MB of models kept in the model store")
+    parser.add_argument('--clusters', type=int, default=4, help="slope change clusters per area")
+    parser.add_argument('--force', nargs='*', default=[], choices=list(stages), help="stages to re-run even if up to date")
+    parser.add_argument('--raster-cache', type=float, default=None, metavar='MB',
+                        help="decode every raster once into <root>/12_Raster_Cache, shared by all tasks, keeping at most this many MB")
+    parser.add_argument('--profile', default=None, help="folder of the run report (time, CPU, memory, I/O and pixels/s of every stage)")
+    args = parser.parse_args(argv)
+
+    # 1 Tasks of the areas found under the root
+    dirs = studyDirs(args.root)
+    areas = findAreas(dirs, args.skip_resample)
+    if not areas:
+        sys.exit("No '{}' rasters in {}".format('*Before_Resampled.tif' if args.skip_resample else '*Before.tif', dirs['clipped']))
+    settings = {'extras': args.extras, 'memBudgetMB': args.mem_budget, 'warpMemoryMB': args.warp_memory, 'skipResample': args.skip_resample,
+                'backend': args.backend, 'sampleSize': args.sample_size, 'errorFormat': args.error_format,
+                'nClusters': args.clusters}
+    tasks = buildTasks(areas, dirs, settings)
+
+    # 2 Run them
+    start = time.time()
+    if args.profile:
+        profiling.enable(args.profile)
+    if args.raster_cache:
+        raster_cache.enable(dirs['rasterCache'], args.raster_cache)
+    report = runPipeline(tasks, dirs['state'], nWorkers=args.workers, force=args.force)
+
+    # 2.1 Evict the least recently used models over the store size once every area is done (never the models of this study)
+    if args.max_store is not None:
+        models = []
+        for manifestName in glob.glob(os.path.join(dirs['state'], 'train_*.json')):
+            with open(manifestName) as f:
+                models.append(json.load(f)['outputs']['model'])
+        evictModels(dirs['models'], args.max_store, keep=models)
+    print(report.groupby('Stage', sort=False).agg(Tasks=('Task', 'size'), Skipped=('Skipped', 'sum'), Secs=('Secs', 'sum')))
+    print("Time elapsed: {:.1f} s".format(time.time() - start))
+
+    # 3 Run report
+    if args.profile:
+        runReport = profiling.runReport(args.profile)
+        print(runReport.to_string(index=False))
+    return report
+
+
+
+if __name__ == '__main__':
+    main()
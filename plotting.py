@@ -0,0 +1,128 @@
+## About
+# This module renders the four error figures of an area (all errors, filtered errors, 100 random errors before/after filtering)
+# > the errors are loaded once per area and shared by the four figures
+# > long series are cut down to a min/max envelope, which draws the same picture with a few thousand vertices
+# > figures are drawn on Agg canvases (no pyplot state), one area per worker process
+# > figures whose error file and settings are unchanged since they were last drawn are skipped
+
+
+
+## Libraries
+import pandas as pd, numpy as np, os, json, string, time
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from error_store import readErrorColumns
+from outliers import loadMask, maskedView
+from profiling import stage
+
+
+
+## Figures of an area: suffix, title, y limits, colour
+panels = {
+    'A_All': ("Predicted vs actual elevation DEM values", [-0.8, 0.8], 'firebrick'),
+    'B_All_Filtered': ("Predicted vs actual DEM values", [-0.2, 0.2], 'firebrick'),
+    'C_100': ("Errors for 100 random samples", [-0.04, 0.04], 'k'),
+    'D_100_filtered': ("Errors for 100 random samples after filtering", [-0.03, 0.03], 'k'),
+}
+
+
+
+## Min/max envelope of a long series: the min and the max of each bucket, in pixel order
+# (masked pixels, e.g. filtered outliers, are left out but keep their pixel numbers, as in a filtered pandas plot)
+def envelope(y, maxPoints=4000):
+    n = len(y)
+
+    # 1 Equal buckets (the last one padded with NaN)
+    size = max(1, -(-n // (maxPoints // 2)))
+    nBuckets = -(-n // size)
+    padded = np.full(nBuckets * size, np.nan)
+    padded[:n] = np.ma.filled(np.ma.asarray(y, dtype='float64'), np.nan)
+    padded = padded.reshape(nBuckets, size)
+
+    # 2 Position of the min and the max of each bucket, in the order they occur (empty buckets dropped)
+    starts = np.arange(nBuckets) * size
+    keep = ~np.isnan(padded).all(axis=1)
+    padded, starts = padded[keep], starts[keep]
+    iMin, iMax = np.nanargmin(padded, axis=1), np.nanargmax(padded, axis=1)
+    first, second = np.minimum(iMin, iMax), np.maximum(iMin, iMax)
+    x = np.unique(np.column_stack([starts + first, starts + second]).ravel())
+    return x, np.asarray(np.ma.getdata(y))[x]
+
+
+
+## One figure
+def _drawPanel(x, y, name, letter, outName, dpi, fontFamily):
+    title, ylim, color = panels[name]
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # 1 Plot
+    ax.plot(x, y, color=color)
+    ax.set_ylim(ylim)
+    ax.set_title(title, fontfamily=fontFamily)
+    ax.set_xlabel("Pixel number", fontweight='bold', fontfamily=fontFamily)
+    ax.set_ylabel("Error (m)", fontweight='bold', fontfamily=fontFamily)
+    ax.grid(True, which='major', color='k', linestyle='--', alpha=0.50)
+    ax.grid(True, which='minor', color='k', linestyle='--', alpha=0.50)
+
+    # 2 Add annotation
+    x0, xmax = ax.get_xlim()
+    y0, ymax = ax.get_ylim()
+    ax.text(xmax, ymax, '({})'.format(letter), size=14, fontfamily=fontFamily, bbox=dict(boxstyle="square", ec='k', fc='darkgray'))
+
+    # 3 Save fig
+    with stage('figure_write'):
+        fig.savefig(outName, dpi=dpi, bbox_inches='tight', facecolor='gainsboro')
+
+
+
+## Render the four figures of area 'i'
+def renderArea(i, errorName, outDir, dpi=300, fontFamily='Century Gothic', maxPoints=4000, seed=0, force=False):
+    start = time.time()
+    area = str(i+1).zfill(2)
+    outNames = {name: os.path.join(outDir, "Area_{}_{}.png".format(area, name)) for name in panels}
+
+    # 1 Skip the area if its error file and the settings are unchanged since the figures were drawn
+    stat = os.stat(errorName)
+    stamp = {'error': [os.path.abspath(errorName), stat.st_size, stat.st_mtime_ns], 'dpi': dpi, 'font': fontFamily, 'maxPoints': maxPoints, 'seed': seed}
+    stampName = os.path.join(outDir, "Area_{}_plots.json".format(area))
+    if not force and os.path.exists(stampName) and all(os.path.exists(name) for name in outNames.values()):
+        with open(stampName) as f:
+            if json.load(f) == stamp:
+                return {'Area': i+1, 'Skipped': True, 'Secs': time.time()-start}
+
+    with stage('plots', i+1) as record:
+
+        # 2 Load the errors once
+        diff = readErrorColumns(errorName, ['diff'])['diff']
+        record['Pixels'] = len(diff)
+        rng = np.random.default_rng(seed)
+
+        # 3 Filters (masks saved next to the error file by the first script that needs them)
+        # 3.1 quantile method on 'diff' (for the filtered plot)
+        quantileMask = loadMask(errorName, 'quantile', columns=['diff'], quantiles=(0.01, 0.99))
+
+        # 3.2 z-score method over all columns (for the filtered random samples)
+        zMask = loadMask(errorName, 'zscore', columns=['yPred', 'yTest', 'diff'], threshold=3.0)
+
+        # 4 Draw the figures
+        letter = string.ascii_lowercase[i:i+1]
+        _drawPanel(*envelope(diff, maxPoints), 'A_All', letter, outNames['A_All'], dpi, fontFamily)
+        _drawPanel(*envelope(maskedView(diff, quantileMask), maxPoints), 'B_All_Filtered', letter, outNames['B_All_Filtered'], dpi, fontFamily)
+        _drawPanel(np.arange(100), diff[rng.choice(len(diff), 100, replace=False)], 'C_100', letter, outNames['C_100'], dpi, fontFamily)
+        _drawPanel(np.arange(100), diff[rng.choice(np.flatnonzero(zMask), 100, replace=False)], 'D_100_filtered', letter, outNames['D_100_filtered'], dpi, fontFamily)
+
+    # 5 Remember what the figures were drawn from
+    with open(stampName, 'w') as f:
+        json.dump(stamp, f)
+    return {'Area': i+1, 'Skipped': False, 'Secs': time.time()-start}
+
+
+
+## Render the figures of all areas, one area per worker process
+def renderAreas(errorNames, outDir, nWorkers=None, **kwargs):
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        futures = [pool.submit(renderArea, i, errorNames[i], outDir, **kwargs) for i in range(len(errorNames))]
+        return pd.DataFrame([future.result() for future in futures])
@@ -0,0 +1,165 @@
+## About
+# This module records what the stages of the study cost, to find regressions and plan capacity:
+# > wall time, CPU time, peak RSS, bytes read/written and pixels/s of every stage, per area
+# > stages are marked with 'with stage(name, area, pixels):' in the modules; nested stages inherit the area of the outer one
+# > recording is off until enable(profileDir) is called; the setting is passed to worker processes through the environment,
+#   and every process appends its records to its own JSON-lines file in 'profileDir'
+# > runReport merges the records of a run into one table per (stage, area), written as JSON and CSV
+# (CPU time and bytes are counted for the whole process, so stages running in threads at the same time share them)
+# Peak_RSS_MB is the peak resident memory of the process during the stage: on Linux the high-water mark is reset at the start
+# of every stage (/proc/self/clear_refs) and read at its end (VmHWM), with outer stages keeping the peaks of the ones inside them;
+# elsewhere it is the high-water mark of the process so far (ru_maxrss), and empty where there is no 'resource' module (Windows)
+
+
+
+## Libraries
+import pandas as pd, os, sys, json, glob, time, threading, contextvars
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows: no memory figures
+
+
+
+envName = 'GLOF_PROFILE_DIR'  # environment variable holding the profile folder (unset = not recording)
+_area = contextvars.ContextVar('area', default=None)
+_open, _openLock = [], threading.Lock()  # records of the stages running in this process, and the lock of their peaks
+
+
+
+## Start recording into 'profileDir' (in this process and in the worker processes it starts afterwards)
+def enable(profileDir, clear=True):
+    os.makedirs(profileDir, exist_ok=True)
+    if clear:
+        for name in glob.glob(os.path.join(profileDir, 'profile_*.jsonl')):
+            os.remove(name)
+    os.environ[envName] = os.path.abspath(profileDir)
+
+
+
+## Stop recording
+def disable():
+    os.environ.pop(envName, None)
+
+
+
+## Bytes read and written by this process so far (from /proc, where there is one; None elsewhere)
+def _ioBytes():
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+
+## Peak RSS of this process since the last reset, in MB (None without any memory figures)
+# (VmHWM where /proc has it, else ru_maxrss, which is in KB on Linux and in bytes on macOS)
+def _peakRssMB():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+
+## Reset the peak RSS of this process to its current RSS (Linux only; elsewhere the peak keeps growing)
+def _resetPeakRss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+
+## Fold the peak since the last reset into the peaks of the running stages, then reset it
+def _foldPeak(record=None, reset=True):
+    with _openLock:
+        peak = _peakRssMB()
+        if peak is not None:
+            for r in _open + ([record] if record is not None else []):
+                r['_peak'] = max(r.get('_peak') or 0, peak)
+        if reset:
+            _resetPeakRss()
+
+
+
+## Record one stage ('pixels' can also be set on the yielded dict once it is known: record['Pixels'] = n)
+@contextmanager
+def stage(name, area=None, pixels=None):
+    record = {'Pixels': pixels}
+    profileDir = os.environ.get(envName)
+    if not profileDir:
+        yield record
+        return
+
+    # 1 Counters at the start
+    token = _area.set(area if area is not None else _area.get())
+    _foldPeak()
+    with _openLock:
+        _open.append(record)
+    read0, written0 = _ioBytes()
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield record
+
+    # 2 Differences at the end, appended to this process's file
+    finally:
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        read1, written1 = _ioBytes()
+        _foldPeak(reset=False)
+        with _openLock:
+            _open[:] = [r for r in _open if r is not record]
+        peak = record.pop('_peak', None)
+        record.update({'Stage': name, 'Area': _area.get(), 'Pid': os.getpid(), 'Start': time.time() - wall, 'Wall_Secs': wall, 'CPU_Secs': cpu,
+                       'Peak_RSS_MB': peak, 'Read_MB': (read1 - read0) / 2**20 if read0 is not None else None,
+                       'Written_MB': (written1 - written0) / 2**20 if written0 is not None else None})
+        _area.reset(token)
+        with open(os.path.join(profileDir, 'profile_{}.jsonl'.format(os.getpid())), 'a') as f:
+            f.write(json.dumps(record, default=float) + '\n')
+
+
+
+## Records of a run, one row per recorded stage
+def readRecords(profileDir):
+    rows = []
+    for name in glob.glob(os.path.join(profileDir, 'profile_*.jsonl')):
+        with open(name) as f:
+            rows += [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(rows, columns=['Stage', 'Area', 'Pid', 'Start', 'Wall_Secs', 'CPU_Secs', 'Peak_RSS_MB', 'Read_MB', 'Written_MB', 'Pixels'])
+
+
+
+## Which figure Peak_RSS_MB is on this machine
+def _peakRssFigure():
+    if os.path.exists('/proc/self/clear_refs'):
+        return 'peak RSS during the stage (VmHWM reset at its start)'
+    return 'peak RSS of the process so far (ru_maxrss)' if resource is not None else 'not recorded'
+
+
+
+## Run report: the records summed per (stage, area), written to 'run_report.json' and 'run_report.csv' in 'profileDir'
+def runReport(profileDir):
+    records = readRecords(profileDir)
+    records['Area'] = records['Area'].fillna(0).astype('int64')  # 0 = not tied to an area
+    report = records.groupby(['Stage', 'Area'], sort=False).agg(
+        Calls=('Stage', 'size'), Wall_Secs=('Wall_Secs', 'sum'), CPU_Secs=('CPU_Secs', 'sum'), Peak_RSS_MB=('Peak_RSS_MB', 'max'),
+        Read_MB=('Read_MB', 'sum'), Written_MB=('Written_MB', 'sum'), Pixels=('Pixels', lambda v: v.sum(min_count=1))).reset_index()
+    report['Pixels_per_Sec'] = report['Pixels'] / report['Wall_Secs'].where(report['Wall_Secs'] > 0)
+    report = report.sort_values(['Area', 'Stage']).reset_index(drop=True)
+
+    # 1 Save it
+    report.to_csv(os.path.join(profileDir, 'run_report.csv'), index=False)
+    with open(os.path.join(profileDir, 'run_report.json'), 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'peak_rss': _peakRssFigure(), 'stages': report.to_dict(orient='records')}, f, indent=1, default=float)
+    return report
@@ -0,0 +1,160 @@
+## About
+# This module keeps decoded rasters on disk, so each GeoTIFF is decoded once for all stages and worker processes:
+# > a raster is decoded window by window into float32 (NaN for no-data, as readBand does) and saved as a .npy file
+#   named after the fingerprint of its contents, so a changed raster gets a new entry
+# > readers memory-map the entry read-only: windows are views into the OS page cache, shared by every process, with no decoding or copies
+# > the least recently used entries are evicted beyond a size cap (entries still mapped by a reader stay readable until it closes them)
+# > a raster is fingerprinted and decoded by one thread of one process at a time (a per-raster lock in the process, plus a lock file
+#   next to the entry across processes); the others wait and map the finished entry
+# > windows narrower than the raster (the tiles change_index recomputes) are read straight from the GeoTIFF unless the raster is
+#   already cached, so updating a few tiles never decodes a whole raster
+# > off until enable(cacheDir, maxSizeMB); the setting reaches worker processes through the environment, as profiling does
+
+
+
+## Libraries
+import numpy as np, os, glob, tempfile, threading
+from rasterio.windows import Window
+from model_store import fingerprint
+try:
+    import fcntl
+except ImportError:  # Windows: no lock across processes (an entry may then be decoded twice, never read half-written)
+    fcntl = None
+
+
+
+envDir, envSize = 'GLOF_RASTER_CACHE', 'GLOF_RASTER_CACHE_MB'  # environment variables holding the cache folder and its cap
+_opened = {}  # entries mapped by this process: (file, size, mtime, maskNegative) -> memory-mapped band
+_locks = {}  # one lock per key of '_opened', held while the raster is fingerprinted, decoded and mapped
+_entries = {}  # entry name of every key of '_opened' fingerprinted by this process
+_openedLock = threading.Lock()  # guards '_opened' and '_locks'
+
+
+
+## Start caching into 'cacheDir' (in this process and in the worker processes it starts afterwards)
+def enable(cacheDir, maxSizeMB=20000):
+    os.makedirs(cacheDir, exist_ok=True)
+    os.environ[envDir] = os.path.abspath(cacheDir)
+    os.environ[envSize] = str(maxSizeMB)
+
+
+
+## Stop caching
+def disable():
+    os.environ.pop(envDir, None)
+    os.environ.pop(envSize, None)
+    with _openedLock:
+        _opened.clear()
+        _entries.clear()
+
+
+
+## Entry of a raster in the cache
+def entryPath(cacheDir, key, maskNegative=True):
+    return os.path.join(cacheDir, '{}_{}.npy'.format(key, 'masked' if maskNegative else 'raw'))
+
+
+
+## Decode band 1 of a raster into an entry, strip by strip (written to a temp file first, so readers never see half an entry)
+def decode(src, name, maskNegative=True, memBudgetMB=256):
+    height, width = src.shape
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(name), suffix='.tmp.npy')
+    os.close(fd)
+    try:
+        band = np.lib.format.open_memmap(tmpName, mode='w+', dtype='float32', shape=(height, width))
+        nRows = max(1, int(memBudgetMB * 2**20) // (width * 4))
+        for rowOff in range(0, height, nRows):
+            n = min(nRows, height - rowOff)
+            arr = src.read(1, window=Window(0, rowOff, width, n), out_dtype='float32')
+            if maskNegative:
+                arr[arr<0] = np.nan
+            band[rowOff:rowOff+n] = arr
+        band.flush()
+        del band
+        os.replace(tmpName, name)
+    except BaseException:
+        os.remove(tmpName)
+        raise
+
+
+
+## Hold the lock file of an entry (no-op where file locks are not available)
+class _FileLock:
+
+    def __init__(self, name):
+        self.name = name + '.lock'
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.f = open(self.name, 'a')
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+
+
+## Remove the least recently used entries until the cache fits into 'maxSizeMB'
+def evictEntries(cacheDir, maxSizeMB, keep=None):
+    entries = sorted(glob.glob(os.path.join(cacheDir, '*_masked.npy')) + glob.glob(os.path.join(cacheDir, '*_raw.npy')), key=os.path.getmtime)
+    total = sum(os.path.getsize(name) for name in entries)
+    for name in entries:
+        if total <= maxSizeMB * 2**20:
+            break
+        if name != keep:
+            try:
+                total -= os.path.getsize(name)
+                os.remove(name)
+            except FileNotFoundError:
+                pass  # evicted by another process
+
+
+
+## Band 1 of an open raster, memory-mapped from the cache (decoded first if it is not cached yet; None while caching is off,
+# and for a window narrower than the raster while the raster is not cached)
+def cachedBand(src, maskNegative=True, window=None):
+    cacheDir = os.environ.get(envDir)
+    if not cacheDir:
+        return None
+
+    # 1 Entries already mapped by this process
+    try:
+        stat = os.stat(src.name)
+    except OSError:
+        return None  # not a file (e.g. an in-memory dataset)
+    memo = (os.path.abspath(src.name), stat.st_size, stat.st_mtime_ns, maskNegative)
+    with _openedLock:
+        if memo in _opened:
+            return _opened[memo]
+        lock = _locks.setdefault(memo, threading.Lock())
+
+    # 2 One thread per raster goes on; the others wait for it and take its entry
+    with lock:
+        with _openedLock:
+            if memo in _opened:
+                return _opened[memo]
+        name = _entries.get(memo) or _entries.setdefault(memo, entryPath(cacheDir, fingerprint(src.name, cacheDir), maskNegative))
+        if window is not None and window.width < src.width and not os.path.exists(name):
+            return None
+
+        # 3 Map the entry, decoding the raster first if no process has yet (or it was evicted meanwhile)
+        for attempt in range(2):
+            if not os.path.exists(name):
+                with _FileLock(name):
+                    if not os.path.exists(name):
+                        decode(src, name, maskNegative)
+                        evictEntries(cacheDir, float(os.environ.get(envSize, 20000)), keep=name)
+            try:
+                band = np.load(name, mmap_mode='r')
+                os.utime(name)  # mark as recently used
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            raise FileNotFoundError("{} was evicted from the raster cache while being read".format(name))
+        with _openedLock:
+            _opened[memo] = band
+        return band
@@ -0,0 +1,95 @@
+## About
+# This module reads aligned rasters (e.g. 'before'/'after' DEMs and their slope/aspect maps)
+# window by window, so that no stage has to hold a whole area in memory at once
+
+
+
+## Libraries
+import numpy as np, rasterio as rio
+from contextlib import ExitStack
+from rasterio.windows import Window
+from profiling import stage
+from raster_cache import cachedBand
+
+
+
+## Read a single window
+def readBand(src, window=None, maskNegative=True):
+
+    # 1 Read as float32 (half the memory of the float64 the scripts used to end up with)
+    # (with the raster cache on, the window is a read-only view of the raster decoded once for all stages, already masked;
+    # tiles narrower than the raster are read from the file until it is cached)
+    with stage('read') as record:
+        band = cachedBand(src, maskNegative, window)
+        if band is not None:
+            arr = band[window.toslices()] if window is not None else band
+            record['Pixels'] = arr.size
+            return arr
+        arr = src.read(1, window=window, out_dtype='float32')
+        record['Pixels'] = arr.size
+
+    # 2 Assign 'np.nan' to no-data pixels
+    if maskNegative:
+        arr[arr<0] = np.nan
+    return arr
+
+
+
+## Split a raster into full-width row strips that fit into the memory budget
+def stripWindows(height, width, nRasters=2, memBudgetMB=256, blockHeight=1):
+
+    # 1 Rows that fit into the budget, counting every raster read together as float32
+    bytesPerRow = width * 4 * nRasters
+    nRows = max(1, int(memBudgetMB * 2**20) // bytesPerRow)
+
+    # 2 Align the strips to the internal block height so each block is decoded only once
+    if nRows > blockHeight:
+        nRows -= nRows % blockHeight
+
+    # 3 Get the windows
+    for rowOff in range(0, height, nRows):
+        yield Window(0, rowOff, width, min(nRows, height-rowOff))
+
+
+
+## Profile of the output rasters (georeferencing of the 'before' DEM, tiled and compressed float32)
+def outputProfile(src, blockSize=256):
+    profile = src.profile.copy()
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=np.nan, tiled=True, blockxsize=blockSize, blockysize=blockSize,
+                   compress='deflate', predictor=3, BIGTIFF='IF_SAFER')
+    return profile
+
+
+
+## Grow a window by 'halo' pixels on every side, clipped to the raster
+# (also returns how many of the halo pixels fell outside the raster, per side: top, bottom, left, right)
+def haloWindow(window, halo, height, width):
+    top, left = max(0, window.row_off-halo), max(0, window.col_off-halo)
+    bottom, right = min(height, window.row_off+window.height+halo), min(width, window.col_off+window.width+halo)
+    missing = (halo-(window.row_off-top), halo-(bottom-window.row_off-window.height), halo-(window.col_off-left), halo-(right-window.col_off-window.width))
+    return Window(left, top, right-left, bottom-top), missing
+
+
+
+## Walk any number of aligned rasters window by window
+def readWindows(names, memBudgetMB=256, maskNegative=True):
+    with ExitStack() as stack:
+
+        # 1 Open all rasters and check that they share one grid
+        srcs = [stack.enter_context(rio.open(name)) for name in names]
+        for src, name in zip(srcs[1:], names[1:]):
+            if src.shape != srcs[0].shape:
+                raise ValueError("{} has shape {}, expected {} as in {}".format(name, src.shape, srcs[0].shape, names[0]))
+
+        # 2 Yield the window and the tile of every raster
+        height, width = srcs[0].shape
+        blockHeight = srcs[0].block_shapes[0][0]
+        for window in stripWindows(height, width, len(srcs), memBudgetMB, blockHeight):
+            yield window, [readBand(src, window, maskNegative) for src in srcs]
+
+
+
+## Walk a 'before'/'after' pair (plus optional slope/aspect rasters) window by window
+def readPairWindows(beforeName, afterName, extraNames=(), memBudgetMB=256, maskNegative=True):
+    for window, tiles in readWindows([beforeName, afterName, *extraNames], memBudgetMB, maskNegative):
+        yield window, tiles[0], tiles[1], tiles[2:]
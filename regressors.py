@@ -0,0 +1,54 @@
+## About
+# This module keeps the regressors the areas can be trained with, by name, and compares them by cost as well as accuracy
+# > 'tree': the original unpruned DecisionTreeRegressor
+# > 'tree_limited': a tree with limited depth and leaf size, much smaller than the training set
+# > 'hist_gbm': HistGradientBoostingRegressor (binned features, multithreaded)
+# > 'forest': RandomForestRegressor of limited trees, fitted on all cores
+
+
+
+## Libraries
+import pandas as pd, numpy as np, time, pickle
+from sklearn.tree import DecisionTreeRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
+
+
+
+## Registry of backends
+backends = {
+    'tree': lambda: DecisionTreeRegressor(random_state=0),
+    'tree_limited': lambda: DecisionTreeRegressor(max_depth=24, min_samples_leaf=20, random_state=0),
+    'hist_gbm': lambda: HistGradientBoostingRegressor(max_iter=300, max_leaf_nodes=63, learning_rate=0.1, random_state=0),
+    'forest': lambda: RandomForestRegressor(n_estimators=32, max_depth=24, min_samples_leaf=20, max_samples=0.5, n_jobs=-1, random_state=0),
+}
+
+
+
+## New, unfitted regressor of a backend ('params' override its hyperparameters)
+def makeRegressor(backend='tree', **params):
+    if backend not in backends:
+        raise ValueError("Unknown backend '{}', expected one of {}".format(backend, list(backends)))
+    return backends[backend]().set_params(**params)
+
+
+
+## Fit every backend on the same split and record its cost and error
+def benchmarkBackends(X_train, y_train, X_test, y_test, names=None, params=None):
+    rows = []
+    for name in names or list(backends):
+        regressor = makeRegressor(name, **(params or {}).get(name, {}))
+
+        # 1 Fit
+        start = time.time()
+        regressor.fit(X_train, y_train)
+        fitSecs = time.time() - start
+
+        # 2 Predict
+        start = time.time()
+        diff = regressor.predict(X_test) - y_test
+        predictSecs = time.time() - start
+
+        rows.append({'Backend': name, 'Fit_Secs': fitSecs, 'Predict_Pixels_per_Sec': len(X_test) / max(predictSecs, 1e-9),
+                     'Model_MB': len(pickle.dumps(regressor, protocol=pickle.HIGHEST_PROTOCOL)) / 2**20,
+                     'MAE': np.abs(diff).mean(), 'RMSE': np.sqrt((diff**2).mean())})
+    return pd.DataFrame(rows)
@@ -0,0 +1,112 @@
+## About
+# This module resamples the 'before' rasters to the grid of the 'after' rasters:
+# > warps run in a pool of threads (gdal releases the GIL), each using gdal's own multithreading and warp memory limit
+# > outputs are warped onto the exact grid of the 'after' raster (its extent, size and CRS), so every stage can compare them pixel by pixel
+# > outputs newer than their inputs and already on that grid (same size, transform and CRS) are skipped
+# > outputs are tiled, compressed GeoTIFFs, so later stages can read them window by window
+# > resampleTiles updates the resampled raster of a new survey epoch, warping only the tiles whose source tiles changed (see change_index.py)
+
+
+
+## Libraries
+import pandas as pd, numpy as np, rasterio as rio, os, time
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal
+from rasterio.windows import bounds
+from profiling import stage
+from raster_io import outputProfile
+from change_index import indexRaster, updateTiles
+from grid_check import checkGrids
+gdal.UseExceptions()
+
+
+
+## Creation options of the resampled rasters
+def creationOptions(srcName, blockSize=256):
+    ds = gdal.Open(srcName)
+    isFloat = gdal.GetDataTypeName(ds.GetRasterBand(1).DataType).startswith('Float')
+    return ['TILED=YES', 'BLOCKXSIZE={}'.format(blockSize), 'BLOCKYSIZE={}'.format(blockSize), 'COMPRESS=DEFLATE',
+            'PREDICTOR={}'.format(3 if isFloat else 2), 'BIGTIFF=IF_SAFER']
+
+
+
+## Is 'outName' newer than its inputs and already on the grid of 'refName' (size, transform and CRS)?
+def isUpToDate(outName, srcName, refName):
+    if not os.path.exists(outName):
+        return False
+    if os.path.getmtime(outName) < max(os.path.getmtime(srcName), os.path.getmtime(refName)):
+        return False
+    return bool(checkGrids({'Reference': [refName], 'Output': [outName]}, nWorkers=1)['Aligned'].all())
+
+
+
+## Grid of 'refName' as gdal.Warp options (extent, size and CRS)
+def gridOptions(refName):
+    ref = gdal.Open(refName)
+    x0, dx, _, y0, _, dy = ref.GetGeoTransform()
+    x1, y1 = x0 + dx * ref.RasterXSize, y0 + dy * ref.RasterYSize
+    return {'outputBounds': (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)), 'width': ref.RasterXSize, 'height': ref.RasterYSize,
+            'dstSRS': ref.GetProjection() or None}
+
+
+
+## Resample 'srcName' onto the grid of 'refName'
+def resampleRaster(srcName, refName, outName, nThreads=1, warpMemoryMB=512, force=False):
+    start = time.time()
+    if not force and isUpToDate(outName, srcName, refName):
+        return {'Output': outName, 'Skipped': True, 'Secs': time.time()-start}
+
+    # 1 Warp into a temp file, so an interrupted run never leaves an output that looks up to date
+    grid = gridOptions(refName)
+    tmpName = outName + '.tmp.tif'
+    with stage('resample', pixels=grid['width']*grid['height']):
+        result = gdal.Warp(
+            destNameOrDestDS=tmpName,
+            srcDSOrSrcDSTab=srcName,
+            **grid,
+            multithread=True,
+            warpMemoryLimit=warpMemoryMB,
+            warpOptions=['NUM_THREADS={}'.format(nThreads)],
+            creationOptions=creationOptions(srcName),
+        )
+        result = None
+    os.replace(tmpName, outName)
+    return {'Output': outName, 'Skipped': False, 'Secs': time.time()-start}
+
+
+
+## Resample all areas ('nWorkers' warps at a time, each with its share of the cores)
+def resampleRasters(srcNames, refNames, outNames, nWorkers=2, warpMemoryMB=512, force=False):
+    nThreads = max(1, (os.cpu_count() or 1) // nWorkers)
+    with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+        futures = [pool.submit(resampleRaster, srcNames[i], refNames[i], outNames[i], nThreads, warpMemoryMB, force) for i in range(len(srcNames))]
+        return pd.DataFrame([future.result() for future in futures])
+
+
+
+## Profile of 'srcName' resampled onto the grid of 'refName', as resampleRaster writes it
+def resampledProfile(srcName, refName, blockSize=256):
+    with rio.open(srcName) as src, rio.open(refName) as ref:
+        profile = outputProfile(src, blockSize)
+        profile.update(width=ref.width, height=ref.height, transform=ref.transform, crs=ref.crs, nodata=src.nodata if src.nodata is not None else np.nan)
+    return profile
+
+
+
+## Warp one window of the resampled grid (nearest neighbour, as resampleRaster)
+def warpWindow(srcName, profile, window):
+    left, bottom, right, top = bounds(window, profile['transform'])
+    ds = gdal.Warp('', srcName, format='MEM', outputBounds=(left, bottom, right, top), width=window.width, height=window.height,
+                   dstSRS=profile['crs'].to_wkt() if profile['crs'] else None)
+    return ds.GetRasterBand(1).ReadAsArray().astype('float32')
+
+
+
+## Update the resampled raster of one epoch ('raster': name of the source in the index, e.g. 'Area_01_Before';
+# 'previousName': the resampled raster of the previous epoch; returns the recomputed tiles)
+def resampleTiles(db, epoch, srcName, refName, outName, raster, previousName=None, tileSize=256, nWorkers=2):
+    profile = resampledProfile(srcName, refName, tileSize)
+    indexRaster(db, srcName, epoch, raster, tileSize)
+    return updateTiles(db, epoch, {raster: srcName}, {'resampled': outName}, lambda window: {'resampled': warpWindow(srcName, profile, window)},
+                       profile, {'resampled': previousName} if previousName else None, settings={'shape': (profile['height'], profile['width'])},
+                       halo=1, tileSize=tileSize, nWorkers=nWorkers, rasters={'resampled': raster + '_Resampled'})
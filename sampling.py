@@ -0,0 +1,61 @@
+## About
+# This module trains on a spatially stratified sample of the training pixels instead of all of them:
+# > strata are the tiles of the row/col grid crossed with quantile bins of a feature (elevation by default)
+# > every stratum gets its proportional share of the sample budget
+# sampleCurve fits on growing samples and reports how the hold-out error and the fit cost change
+
+
+
+## Libraries
+import pandas as pd, numpy as np, time, pickle
+from sklearn.model_selection import train_test_split
+from sklearn.tree import DecisionTreeRegressor
+
+
+
+## Indices of a stratified sample of 'budget' rows of 'X' (columns Row, Col, then features)
+def stratifiedSample(X, budget, tileSize=256, nBins=8, binColumn=2, seed=0):
+    n = len(X)
+    if budget >= n:
+        return np.arange(n)
+
+    # 1 Stratum of every row: tile of the row/col grid x quantile bin of 'binColumn'
+    row, col = X[:, 0].astype('int64') // tileSize, X[:, 1].astype('int64') // tileSize
+    edges = np.unique(np.quantile(X[:, binColumn], np.linspace(0, 1, nBins+1)[1:-1]))
+    bins = np.searchsorted(edges, X[:, binColumn])
+    strata = np.unique((row * (col.max()+1) + col) * (len(edges)+1) + bins, return_inverse=True)[1]
+
+    # 2 Proportional quota of every stratum (largest remainders get the rows left over)
+    counts = np.bincount(strata)
+    share = budget * counts / n
+    quota = np.floor(share).astype('int64')
+    left = budget - quota.sum()
+    quota[np.argsort(quota - share)[:left]] += 1
+
+    # 3 Random rows of every stratum up to its quota
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(n), strata))
+    firsts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(n) - firsts[strata[order]]
+    return np.sort(order[rank < quota[strata[order]]])
+
+
+
+## Hold-out error and cost of fits on growing stratified samples of one area
+def sampleCurve(X, y, budgets, makeRegressor=lambda: DecisionTreeRegressor(random_state=0), seed=0, tileSize=256, nBins=8):
+
+    # 1 One split for every budget, so the hold-out set is the same
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.30, random_state=seed)
+
+    # 2 Fit on every budget (and on all training pixels) and score on the hold-out set
+    rows = []
+    for budget in sorted(set(list(budgets) + [len(X_train)])):
+        idx = stratifiedSample(X_train, budget, tileSize, nBins, seed=seed)
+        regressor = makeRegressor()
+        start = time.time()
+        regressor.fit(X_train[idx], y_train[idx])
+        fitSecs = time.time() - start
+        diff = regressor.predict(X_test) - y_test
+        rows.append({'Sample': len(idx), 'Fraction': len(idx)/len(X_train), 'Fit_Secs': fitSecs, 'Model_MB': len(pickle.dumps(regressor))/2**20,
+                     'MAE': np.abs(diff).mean(), 'RMSE': np.sqrt((diff**2).mean())})
+    return pd.DataFrame(rows)
@@ -0,0 +1,324 @@
+## About
+# This module serves predicted post-flood elevations of windows of pre-flood DEMs on localhost, for interactive forecasts:
+# > the area models trained by pipeline.py are loaded once, when the service starts, with the terrain features ('extras') their train
+#   manifests record
+# > requests are newline-delimited JSON over TCP (asyncio streams, no web framework), answered with the predicted window
+# > requests of one area arriving within 'maxDelayMs' of each other are grouped into one vectorized 'predict' call on a thread pool
+# > predicted windows are kept in an LRU cache, keyed by the window and the size/mtime of the rasters read
+#   (a new DEM, or a DEM written again, is predicted anew); identical requests in flight share one prediction
+# > {"op": "metrics"} gives request, cache and batch counts, latency percentiles and throughput
+#
+# Usage: python service.py --root .. [--port 8765]
+# Request: {"area": "01", "window": [colOff, rowOff, width, height]}, or {"area": "01", "tile": [row, col]} (tiles of 'tileSize' pixels),
+#          optionally with "dem" (a new pre-flood DEM on the grid of the area) and "terrain" ({"Slope": name, ...} of that DEM),
+#          which must be files under --root
+# Reply: {"shape": [height, width], "values": base64 of float32 values (NaN = no-data), "cached": bool}, or {"error": message}
+
+
+
+## Libraries
+import numpy as np, rasterio as rio, asyncio, base64, json, os, sys, glob, time, argparse
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
+from features import featureWindows, tilePredictors, featureNames, rasterFeatures
+from stream_stats import StreamingStats
+from pipeline import studyDirs
+
+
+
+## Window of one request, waiting for its batch
+Job = namedtuple('Job', 'key dem terrain window future')
+
+
+
+## Prediction service of the area models
+# > 'models': area -> regressor, 'sources': area -> {'dem': name, 'terrain': {'Slope': name, ...}} read when a request gives no DEM
+# > 'maxBatchPixels': pixels predicted in one call at most, 'cacheWindows': predicted windows kept
+# > 'dataDir': the folder the rasters named in requests must be under (None: any file the service can read)
+class PredictionService:
+
+    def __init__(self, models, sources, extras=(), tileSize=256, maxBatchPixels=2**20, maxDelayMs=5, cacheWindows=256, nThreads=4, dataDir=None):
+        featureNames(extras)
+        self.models, self.sources, self.extras = models, sources, list(extras)
+        self.dataDir = os.path.realpath(dataDir) if dataDir else None
+        self.tileSize, self.maxBatchPixels, self.maxDelay = tileSize, maxBatchPixels, maxDelayMs / 1000
+        self.cacheWindows, self.cache, self.inFlight = cacheWindows, OrderedDict(), {}
+        self.demShapes = {}  # DEM -> (stamp, height, width), so requests for a known DEM do not open it
+        self.pool = ThreadPoolExecutor(max_workers=nThreads)
+        self.slots = asyncio.Semaphore(nThreads)
+        self.queues, self.batchers, self.running = {}, [], set()  # 'running': batches on the pool (held until they finish)
+        self.started = time.time()
+        self.counts = {'requests': 0, 'errors': 0, 'cache_hits': 0, 'shared': 0, 'batches': 0, 'batched_windows': 0, 'pixels': 0}
+        self.latency = StreamingStats(relativeAccuracy=0.01)
+
+
+    ## Predict the window of one request (returns the predicted window and whether it came from the cache)
+    async def predict(self, request):
+        area = str(request['area']).zfill(2)
+        if area not in self.models:
+            raise ValueError("No model for area {} (areas: {})".format(area, sorted(self.models)))
+
+        # 1 Rasters to read, and the window
+        dem = request.get('dem') or self.sources[area]['dem']
+        terrain = request.get('terrain') or (self.sources[area]['terrain'] if not request.get('dem') else {})
+        missing = [name for name in self.extras if name in rasterFeatures and name not in terrain]
+        if missing:
+            raise ValueError("The model of area {} needs the maps of {} in 'terrain'".format(area, missing))
+        if self.dataDir:
+            outside = [name for name in [dem, *terrain.values()] if os.path.commonpath([self.dataDir, os.path.realpath(name)]) != self.dataDir]
+            if outside:
+                raise ValueError("Rasters must be under {}: {}".format(self.dataDir, outside))
+        if 'tile' in request:
+            row, col = request['tile']
+            window = Window(col * self.tileSize, row * self.tileSize, self.tileSize, self.tileSize)
+        else:
+            window = Window(*request['window'])
+
+        # 2 Cached or in flight already (the file reads of the key run off the event loop)
+        window, key = await asyncio.to_thread(self._windowKey, area, dem, terrain, window)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.counts['cache_hits'] += 1
+            return self.cache[key], True
+        if key in self.inFlight:
+            self.counts['shared'] += 1
+            return await asyncio.shield(self.inFlight[key]), False
+
+        # 3 Queue it for the batch of its area
+        future = asyncio.get_running_loop().create_future()
+        self.inFlight[key] = future
+        try:
+            await self._queue(area).put(Job(key, dem, terrain, window, future))
+            values = await future
+        finally:
+            self.inFlight.pop(key, None)
+        self.cache[key] = values
+        while len(self.cache) > self.cacheWindows:
+            self.cache.popitem(last=False)
+        return values, False
+
+
+    ## Window of a request clipped to its DEM, and its cache key: the window and the size/mtime of every raster read
+    # (the DEM is only opened when its stamp changed)
+    def _windowKey(self, area, dem, terrain, window):
+        stamps = [(name, os.stat(name).st_size, os.stat(name).st_mtime_ns) for name in [dem] + [terrain[name] for name in sorted(terrain)]]
+        if self.demShapes.get(dem, (None,))[0] != stamps[0]:
+            with rio.open(dem) as src:
+                self.demShapes[dem] = (stamps[0], src.height, src.width)
+        _, height, width = self.demShapes[dem]
+        window = window.intersection(Window(0, 0, width, height))
+        return window, json.dumps([area, stamps, [window.col_off, window.row_off, window.width, window.height]])
+
+
+    ## Queue of an area, with its batcher started on first use
+    def _queue(self, area):
+        if area not in self.queues:
+            self.queues[area] = asyncio.Queue()
+            self.batchers.append(asyncio.create_task(self._batcher(area)))
+        return self.queues[area]
+
+
+    ## Group the jobs of an area that arrive within 'maxDelay' of the first (up to 'maxBatchPixels'), and predict them together
+    async def _batcher(self, area):
+        loop, queue = asyncio.get_running_loop(), self.queues[area]
+        while True:
+            jobs = [await queue.get()]
+            pixels = jobs[0].window.width * jobs[0].window.height
+            deadline = loop.time() + self.maxDelay
+            while pixels < self.maxBatchPixels and loop.time() < deadline:
+                try:
+                    job = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                jobs.append(job)
+                pixels += job.window.width * job.window.height
+
+            # 1 Run the batch on the pool (at most one batch per thread waiting), and go on collecting the next one
+            await self.slots.acquire()
+            task = asyncio.create_task(self._runBatch(area, jobs))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+
+    async def _runBatch(self, area, jobs):
+        try:
+            results, pixels = await asyncio.get_running_loop().run_in_executor(self.pool, self._predictBatch, area, jobs)
+            for job, values in zip(jobs, results):
+                if not job.future.done():
+                    job.future.set_result(values)
+            self.counts['pixels'] += pixels
+            self.counts['batches'] += 1
+            self.counts['batched_windows'] += len(jobs)
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+        finally:
+            self.slots.release()
+
+
+    ## Predict a batch in one call (runs on the pool): the features of every window, stacked
+    # (returns the predicted windows and the pixels predicted; the counts are only updated on the event loop)
+    def _predictBatch(self, area, jobs):
+        tiles, idxs, Xs = [], [], []
+        for job in jobs:
+            for window, tile, _, extraTiles in featureWindows(job.dem, None, self.extras, job.terrain, windows=[job.window]):
+                idx, X = tilePredictors(tile, extraTiles, window.row_off, window.col_off)
+                tiles.append(np.full(tile.shape, np.nan, dtype='float32'))
+                idxs.append(idx)
+                Xs.append(X)
+        X = np.concatenate(Xs)
+        predicted = self.models[area].predict(X) if len(X) else np.empty(0)
+
+        # 1 Split the predictions back into the windows
+        pos = 0
+        for tile, idx in zip(tiles, idxs):
+            tile.ravel()[idx] = predicted[pos:pos+len(idx)]
+            pos += len(idx)
+        return tiles, len(X)
+
+
+    ## Answer one request (a dict), recording its latency
+    async def answer(self, request):
+        start = time.perf_counter()
+        self.counts['requests'] += 1
+        try:
+            if request.get('op') == 'metrics':
+                return self.metrics()
+            values, cached = await self.predict(request)
+            reply = {'shape': list(values.shape), 'values': base64.b64encode(values.tobytes()).decode(), 'cached': cached}
+        except Exception as e:
+            self.counts['errors'] += 1
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+        self.latency.update([1000 * (time.perf_counter() - start)])
+        return reply
+
+
+    ## Counts, latency percentiles (ms) and throughput since the start (latencies are null until a request was answered)
+    def metrics(self):
+        secs = time.time() - self.started
+        latency = dict.fromkeys(['mean', 'p50', 'p95', 'p99', 'max'])
+        if self.latency.count:
+            latency = {'mean': self.latency.mean, 'p50': self.latency.percentile(50), 'p95': self.latency.percentile(95),
+                       'p99': self.latency.percentile(99), 'max': self.latency.max}
+        return {**self.counts, 'uptime_secs': secs, 'requests_per_sec': self.counts['requests'] / secs, 'pixels_per_sec': self.counts['pixels'] / secs,
+                'mean_batch_windows': self.counts['batched_windows'] / self.counts['batches'] if self.counts['batches'] else None,
+                'cache_windows': len(self.cache), 'latency_ms': latency}
+
+
+    ## Serve one connection: one JSON request per line, one JSON reply per line, in order
+    # (the requests of a connection are answered concurrently, so one client can fill a batch)
+    async def handle(self, reader, writer):
+        replies = asyncio.Queue()
+
+        async def send():
+            while True:
+                reply = await replies.get()
+                if reply is None:
+                    break
+                writer.write((json.dumps(await reply, default=float) + '\n').encode())
+                await writer.drain()
+
+        sender = asyncio.create_task(send())
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = asyncio.ensure_future(self.answer(json.loads(line)))
+                except ValueError as e:
+                    reply = asyncio.get_running_loop().create_future()
+                    reply.set_result({'error': 'Invalid request: {}'.format(e)})
+                replies.put_nowait(reply)
+        finally:
+            replies.put_nowait(None)
+            await sender
+            writer.close()
+
+
+    ## Serve on 'host':'port' until cancelled
+    async def serve(self, host='127.0.0.1', port=8765):
+        server = await asyncio.start_server(self.handle, host, port, limit=2**24)
+        async with server:
+            await server.serve_forever()
+
+
+    ## Stop the batchers, the batches still running and the pool
+    def close(self):
+        for task in self.batchers + list(self.running):
+            task.cancel()
+        self.pool.shutdown(wait=False)
+
+
+
+## Send requests to a running service and wait for their replies (decoded: 'values' as float32 arrays)
+async def query(requests, host='127.0.0.1', port=8765):
+    reader, writer = await asyncio.open_connection(host, port, limit=2**24)
+    try:
+        writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        await writer.drain()
+        replies = []
+        for _ in requests:
+            reply = json.loads(await reader.readline())
+            if 'values' in reply:
+                reply['values'] = np.frombuffer(base64.b64decode(reply['values']), dtype='float32').reshape(reply['shape'])
+            replies.append(reply)
+        return replies
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+
+## Models and rasters of the areas trained by pipeline.py under 'root', and the terrain features the models were trained with
+def loadAreas(root):
+    import joblib
+    dirs = studyDirs(root)
+    models, sources, extras = {}, {}, {}
+    for manifestName in sorted(glob.glob(os.path.join(dirs['state'], 'train_*.json'))):
+        area = os.path.splitext(os.path.basename(manifestName))[0].split('_')[1]
+        with open(manifestName) as f:
+            manifest = json.load(f)
+        models[area], extras[area] = joblib.load(manifest['outputs']['model']), manifest['settings']['extras']
+        demName = glob.glob(os.path.join(dirs['clipped'], '{}_*Before_Resampled.tif'.format(area)))[0]
+        baseName = os.path.splitext(os.path.basename(demName))[0]
+        sources[area] = {'dem': demName, 'terrain': {'Slope': os.path.join(dirs['slope'], baseName + '_slope.tif'),
+                                                     'Aspect': os.path.join(dirs['aspect'], baseName + '_aspect.tif')}}
+
+    # One service predicts every area with the same features
+    if len({tuple(names) for names in extras.values()}) > 1:
+        raise ValueError("The areas were trained with different terrain features: {}".format(extras))
+    return models, sources, next(iter(extras.values()), [])
+
+
+
+## Command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve predicted post-flood elevations of DEM windows on localhost")
+    parser.add_argument('--root', default='..', help="study root (the folder holding 02_Data and the models of pipeline.py)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tile-size', type=int, default=256, help="pixels a side of the tiles of 'tile' requests")
+    parser.add_argument('--max-batch', type=int, default=2**20, help="pixels predicted in one call at most")
+    parser.add_argument('--max-delay', type=float, default=5, help="ms a request waits for others to share its batch")
+    parser.add_argument('--cache', type=int, default=256, help="predicted windows kept in the cache")
+    parser.add_argument('--threads', type=int, default=4, help="batches predicted at a time")
+    args = parser.parse_args(argv)
+
+    models, sources, extras = loadAreas(args.root)
+    if not models:
+        sys.exit("No models trained by pipeline.py under {}".format(args.root))
+    print("Serving the models of areas {} on {}:{}".format(', '.join(sorted(models)), args.host, args.port))
+
+    async def run():
+        service = PredictionService(models, sources, extras, args.tile_size, args.max_batch, args.max_delay, args.cache, args.threads,
+                                    dataDir=args.root)
+        try:
+            await service.serve(args.host, args.port)
+        finally:
+            service.close()
+    asyncio.run(run())
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+## About
+# This module clusters the slope change (before - after slope) of every area and relates the clusters to the prediction errors
+# > the slope change is 1-D, so it is streamed once into a fixed-width histogram, and k-means is fitted on the weighted
+#   bin centers instead of on every pixel (memory is set by the number of bins, not by the size of the maps)
+# > clusters are ordered by their center, so the labels go from the largest slope loss to the largest slope gain
+# > the labels are written as a uint8 raster, plus a memory-mapped copy that the error rows (random pixels) are looked up in
+# > the absolute errors of every cluster are summarised in one streaming pass over the error file
+
+
+
+## Libraries
+import pandas as pd, numpy as np, rasterio as rio, os, time
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import KMeans
+from raster_io import readPairWindows, outputProfile
+from error_store import iterErrorColumns
+from stream_stats import StreamingStats
+from profiling import stage
+
+
+
+noLabel = 255  # label of no-data pixels
+
+
+
+## Histogram of the slope change of an area ('valueRange' in degrees; changes outside it are clipped into the end bins)
+def slopeChangeHistogram(slopeBeforeName, slopeAfterName, binWidth=0.01, valueRange=(-90, 90), memBudgetMB=256):
+    nBins = int(round((valueRange[1] - valueRange[0]) / binWidth))
+    counts = np.zeros(nBins, dtype='int64')
+    for window, before, after, _ in readPairWindows(slopeBeforeName, slopeAfterName, memBudgetMB=memBudgetMB, maskNegative=False):
+        diff = before - after
+        diff = diff[~np.isnan(diff)]
+        bins = np.clip(((diff - valueRange[0]) / binWidth).astype('int64'), 0, nBins-1)
+        counts += np.bincount(bins, minlength=nBins)
+    centers = valueRange[0] + (np.arange(nBins) + 0.5) * binWidth
+    return counts, centers
+
+
+
+## Cluster centers (ascending) and the edges between them, from a histogram
+def fitSlopeClusters(counts, centers, nClusters=4, seed=0):
+    used = counts > 0
+    if used.sum() < nClusters:
+        raise ValueError("Only {} distinct slope changes for {} clusters".format(used.sum(), nClusters))
+    model = KMeans(nClusters, n_init=10, random_state=seed)
+    model.fit(centers[used].reshape(-1, 1), sample_weight=counts[used])
+    clusterCenters = np.sort(model.cluster_centers_.ravel())
+
+    # 1 In 1-D the nearest center changes halfway between two centers
+    return clusterCenters, (clusterCenters[1:] + clusterCenters[:-1]) / 2
+
+
+
+## Write the cluster label of every pixel, as a tiled GeoTIFF and as a memory-mapped .npy for the error lookup
+# (returns the number of pixels of every cluster)
+def writeClusterLabels(slopeBeforeName, slopeAfterName, edges, outName, labelsName, memBudgetMB=256, blockSize=256):
+    with rio.open(slopeBeforeName) as src:
+        profile = {**outputProfile(src, blockSize), 'dtype': 'uint8', 'nodata': noLabel, 'predictor': 2}
+        shape = src.shape
+    labels = np.lib.format.open_memmap(labelsName, mode='w+', dtype='uint8', shape=shape)
+    pixels = np.zeros(len(edges)+1, dtype='int64')
+    with rio.open(outName, 'w', **profile) as out:
+        for window, before, after, _ in readPairWindows(slopeBeforeName, slopeAfterName, memBudgetMB=memBudgetMB, maskNegative=False):
+            diff = before - after
+            tile = np.searchsorted(edges, diff).astype('uint8')
+            valid = ~np.isnan(diff)
+            pixels += np.bincount(tile[valid], minlength=len(pixels))
+            tile[~valid] = noLabel
+            out.write(tile, 1, window=window)
+            labels[window.row_off:window.row_off+window.height] = tile
+    labels.flush()
+    del labels
+    return pixels
+
+
+
+## Statistics of the absolute errors of every cluster, in one pass over the error file
+def clusterErrorStats(errorName, labelsName, clusterCenters, edges, relativeAccuracy=0.001, chunkSize=1000000):
+    labels = np.load(labelsName, mmap_mode='r')
+    stats = [StreamingStats(relativeAccuracy) for _ in clusterCenters]
+
+    # 1 Look the error pixels of every chunk up in the labels (in flat index order, so the lookup reads the map forwards)
+    for chunk in iterErrorColumns(errorName, ['Row', 'Col', 'diff'], chunkSize):
+        flat = chunk['Row'].astype('int64') * labels.shape[1] + chunk['Col']
+        order = np.argsort(flat)
+        chunkLabels = labels.reshape(-1)[flat[order]]
+        diff = np.abs(chunk['diff'][order])
+        for k in range(len(clusterCenters)):
+            stats[k].update(diff[chunkLabels == k])
+
+    # 2 One row per cluster, with the range of slope change it covers
+    low, high = np.concatenate([[-np.inf], edges]), np.concatenate([edges, [np.inf]])
+    rows = []
+    for k, s in enumerate(stats):
+        rows.append({'Cluster': k, 'Center': clusterCenters[k], 'Low': low[k], 'High': high[k], **s.describe()})
+    return pd.DataFrame(rows)
+
+
+
+## Cluster the slope change of area 'i' and summarise its errors per cluster
+def clusterArea(i, slopeBeforeName, slopeAfterName, errorName, outDir, nClusters=4, binWidth=0.01, seed=0, memBudgetMB=256, blockSize=256):
+    start = time.time()
+    area = str(i+1).zfill(2)
+    os.makedirs(outDir, exist_ok=True)
+
+    with stage('clusters', i+1) as record:
+
+        # 1 Fit the clusters on the histogram of the slope change
+        counts, centers = slopeChangeHistogram(slopeBeforeName, slopeAfterName, binWidth, memBudgetMB=memBudgetMB)
+        clusterCenters, edges = fitSlopeClusters(counts, centers, nClusters, seed)
+
+        # 2 Write the labels
+        outName = os.path.join(outDir, "Area_{}_Slope_Clusters.tif".format(area))
+        labelsName = os.path.join(outDir, "Area_{}_Slope_Clusters.npy".format(area))
+        pixels = writeClusterLabels(slopeBeforeName, slopeAfterName, edges, outName, labelsName, memBudgetMB, blockSize)
+
+        # 3 Error statistics per cluster
+        stats = clusterErrorStats(errorName, labelsName, clusterCenters, edges)
+        record['Pixels'] = int(pixels.sum())
+    stats.insert(0, 'Area', i+1)
+    stats.insert(2, 'Pixels', pixels)
+    stats['Secs'] = time.time() - start
+    return stats
+
+
+
+## Cluster all areas, one area per worker process
+def clusterAreas(slopeBeforeNames, slopeAfterNames, errorNames, outDir, nWorkers=None, **kwargs):
+    with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+        futures = [pool.submit(clusterArea, i, slopeBeforeNames[i], slopeAfterNames[i], errorNames[i], outDir, **kwargs) for i in range(len(errorNames))]
+        return pd.concat([future.result() for future in futures], ignore_index=True)
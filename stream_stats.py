@@ -0,0 +1,115 @@
+## About
+# This module computes error statistics in one pass over chunked data:
+# > exact count, min, max, mean and std (chunks merged with Chan's parallel update)
+# > percentiles from a log-bucket sketch, within 'relativeAccuracy' of the exact value
+
+
+
+## Libraries
+import numpy as np, math
+from profiling import stage
+
+
+
+## Streaming statistics of one column
+class StreamingStats:
+
+    def __init__(self, relativeAccuracy=0.001):
+        self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        self.min, self.max = math.inf, -math.inf
+
+        # 1 Sketch: values in (gamma^(k-1), gamma^k] are counted in bucket k (negatives mirrored, zeros apart)
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.positive, self.negative, self.zeros = {}, {}, 0
+
+
+    ## Add a chunk of values (NaNs are skipped, as in pandas 'describe')
+    def update(self, values):
+        values = np.asarray(values, dtype='float64').ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+
+        # 1 Exact moments of the chunk, merged into the running ones
+        n, mean = values.size, float(values.mean())
+        m2 = float(((values - mean)**2).sum())
+        delta = mean - self.mean
+        total = self.count + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        # 2 Sketch buckets of the chunk
+        tiny = np.finfo('float64').tiny
+        self.zeros += int(np.count_nonzero(np.abs(values) < tiny))
+        self._addBuckets(self.positive, values[values >= tiny])
+        self._addBuckets(self.negative, -values[values <= -tiny])
+        return self
+
+
+    def _addBuckets(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.logGamma).astype('int64'), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+
+
+    ## Combine with the statistics of another chunk stream (e.g. from another worker)
+    def merge(self, other):
+        if other.count:
+            total = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / total
+            self.m2 += other.m2 + delta**2 * self.count * other.count / total
+            self.count = total
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+            self.zeros += other.zeros
+            for store, otherStore in ((self.positive, other.positive), (self.negative, other.negative)):
+                for key, count in otherStore.items():
+                    store[key] = store.get(key, 0) + count
+        return self
+
+
+    ## Standard deviation (ddof=1, as in pandas)
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+
+    ## Percentile 'q' (0-100) from the sketch
+    def percentile(self, q):
+        if self.count == 0:
+            return math.nan
+
+        # 1 Walk the buckets in value order up to the rank of 'q'
+        rank = q / 100 * (self.count - 1)
+        seen = 0
+        buckets = [(key, count, -1) for key, count in sorted(self.negative.items(), reverse=True)] + [(0, self.zeros, 0)] \
+                + [(key, count, 1) for key, count in sorted(self.positive.items())]
+        for key, count, sign in buckets:
+            seen += count
+            if seen > rank:
+                break
+
+        # 2 Value of the bucket, clipped to the exact min/max
+        value = sign * 2 * self.gamma**key / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+
+    ## Summary in the layout of pandas 'describe'
+    def describe(self):
+        return {'count': self.count, 'mean': self.mean, 'std': self.std(), 'min': self.min, '25%': self.percentile(25),
+                '50%': self.percentile(50), '75%': self.percentile(75), 'max': self.max}
+
+
+
+## Statistics of a column of chunks
+def streamStats(chunks, relativeAccuracy=0.001, transform=None):
+    stats = StreamingStats(relativeAccuracy)
+    with stage('stats') as record:
+        for chunk in chunks:
+            stats.update(transform(chunk) if transform else chunk)
+        record['Pixels'] = stats.count
+    return stats
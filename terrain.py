@@ -0,0 +1,130 @@
+## About
+# This module derives slope, aspect, hillshade and curvature of a DEM in one pass:
+# > the DEM is read once, in strips with a one pixel halo, so rasters larger than memory work
+# > the 3x3 neighbourhood is taken once per strip and shared by all attributes
+#   (Horn gradients for slope/aspect/hillshade, Zevenbergen-Thorne terms for curvature)
+# > strips are computed in parallel threads (numpy releases the GIL), and written in order as they finish
+# > terrainTiles updates the maps of a new survey epoch, recomputing only the tiles whose DEM tiles changed (see change_index.py)
+
+
+
+## Libraries
+import numpy as np, rasterio as rio, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from raster_io import readBand, stripWindows, haloWindow, outputProfile
+from profiling import stage
+from change_index import indexRaster, updateTiles
+
+
+
+## Attributes that can be written
+attributes = ['slope', 'aspect', 'hillshade', 'curvature']
+
+
+
+## Attributes of one strip, from the strip read with its halo (edges of the raster are replicated)
+def stripAttributes(dem, missing, dx, dy, names, azimuth=315, altitude=45):
+
+    # 1 Pad the sides that fell outside the raster by repeating the edge pixels
+    top, bottom, left, right = missing
+    z = np.pad(dem, ((top, bottom), (left, right)), mode='edge')
+
+    # 2 3x3 neighbourhood of every pixel (a b c / d e f / g h i)
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, e, f = z[1:-1, :-2], z[1:-1, 1:-1], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+    out = {}
+
+    # 3 Horn gradients (rows increase southwards)
+    if {'slope', 'aspect', 'hillshade'} & set(names):
+        dzdx = ((c + 2*f + i) - (a + 2*d + g)) / (8*dx)
+        dzdy = ((g + 2*h + i) - (a + 2*b + c)) / (8*dy)
+        slopeRad = np.arctan(np.hypot(dzdx, dzdy))
+        aspectRad = np.arctan2(dzdy, -dzdx)  # mathematical angle, counterclockwise from east
+
+        # 3.1 Slope (degrees)
+        if 'slope' in names:
+            out['slope'] = np.degrees(slopeRad)
+
+        # 3.2 Aspect (degrees clockwise from north, -1 for flat cells, as in richdem)
+        if 'aspect' in names:
+            aspect = np.mod(90 - np.degrees(aspectRad), 360)
+            aspect[(dzdx == 0) & (dzdy == 0)] = -1
+            out['aspect'] = aspect
+
+        # 3.3 Hillshade (0-255)
+        if 'hillshade' in names:
+            zenith, azimuthRad = np.radians(90 - altitude), np.radians(np.mod(450 - azimuth, 360))
+            shade = np.cos(zenith)*np.cos(slopeRad) + np.sin(zenith)*np.sin(slopeRad)*np.cos(azimuthRad - aspectRad)
+            out['hillshade'] = 255 * np.clip(shade, 0, None)
+
+    # 4 Curvature (Zevenbergen-Thorne, 1/100 z-units, as in richdem/ArcGIS)
+    if 'curvature' in names:
+        D = ((d + f)/2 - e) / dx**2
+        E = ((b + h)/2 - e) / dy**2
+        out['curvature'] = -2 * (D + E) * 100
+
+    return {name: value.astype('float32') for name, value in out.items()}
+
+
+
+## Compute one strip (every thread opens the DEM on its own, as rasterio handles are not thread-safe)
+def _computeStrip(demName, window, dx, dy, names):
+    with rio.open(demName) as src:
+        readWin, missing = haloWindow(window, 1, src.height, src.width)
+        dem = readBand(src, readWin)
+    return window, stripAttributes(dem, missing, dx, dy, names)
+
+
+
+## Write the terrain attributes of a DEM ('outNames' maps attribute names to output files)
+def terrainAttributes(demName, outNames, memBudgetMB=256, nWorkers=4, blockSize=256):
+    names = [name for name in attributes if outNames.get(name)]
+    with rio.open(demName) as src:
+        height, width = src.shape
+        dx, dy = abs(src.transform.a), abs(src.transform.e)
+        profile = outputProfile(src, blockSize)
+
+    # 1 Open the outputs
+    dsts = {name: rio.open(outNames[name], 'w', **profile) for name in names}
+    try:
+
+        # 2 Strips aligned to the output tiles (~16 float32 temporaries per pixel, and 'nWorkers' strips in flight)
+        windows = stripWindows(height, width, 16 + len(names), memBudgetMB / (2*nWorkers), blockSize)
+
+        # 3 Compute strips in parallel, with at most two per worker waiting, and write them as they finish
+        with stage('terrain', pixels=height*width):
+            with ThreadPoolExecutor(max_workers=nWorkers) as pool:
+                pending = deque()
+                for window in windows:
+                    pending.append(pool.submit(contextvars.copy_context().run, _computeStrip, demName, window, dx, dy, names))
+                    if len(pending) >= 2*nWorkers:
+                        _writeStrip(dsts, *pending.popleft().result())
+                while pending:
+                    _writeStrip(dsts, *pending.popleft().result())
+    finally:
+        for dst in dsts.values():
+            dst.close()
+
+
+
+def _writeStrip(dsts, window, values):
+    for name, dst in dsts.items():
+        dst.write(values[name], 1, window=window)
+
+
+
+## Update the terrain attributes of one epoch's DEM ('raster': name of the DEM in the index, e.g. 'Area_01_Before';
+# 'previousNames': the maps of the previous epoch, as in 'outNames'; returns the recomputed tiles)
+def terrainTiles(db, epoch, demName, raster, outNames, previousNames=None, tileSize=256, nWorkers=4):
+    names = [name for name in attributes if outNames.get(name)]
+    with rio.open(demName) as src:
+        dx, dy = abs(src.transform.a), abs(src.transform.e)
+        profile = outputProfile(src, tileSize)
+
+    # 1 Checksums of the DEM tiles, then the tiles whose 3x3 neighbourhoods changed
+    indexRaster(db, demName, epoch, raster, tileSize)
+    return updateTiles(db, epoch, {raster: demName}, {name: outNames[name] for name in names}, lambda window: _computeStrip(demName, window, dx, dy, names)[1],
+                       profile, previousNames, settings={'attributes': names}, halo=1, tileSize=tileSize, nWorkers=nWorkers,
+                       rasters={name: '{}_{}'.format(raster, name) for name in names}, maskNegative=False)